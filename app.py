@@ -12,9 +12,26 @@ import os
 
 # Import database initialization
 from database import init_db, migrate_add_delivered_at
+from utils import metrics
+from utils.scheduler import register_job, start_jobs, stop_jobs
+from utils.admission import AdmissionControlMiddleware
+from utils.order_sweeper import sweep_stale_orders, ORDER_SWEEP_INTERVAL_SECONDS
+from utils.recommendations import rebuild_matrix, RECOMMENDATIONS_REBUILD_SECONDS
+from utils.trending import rebuild_scores, TRENDING_REBUILD_SECONDS
+from utils.user_cache import start_listener, stop_listener
+from utils.availability import rebuild as rebuild_availability, AVAILABILITY_REBUILD_SECONDS
+from utils.retention import run_retention, RETENTION_INTERVAL_SECONDS
+from utils.passwords import shutdown as shutdown_password_pool
+from utils.mailer import shutdown as shutdown_mailer
+from utils.outbox import start_dispatcher, stop_dispatcher
+from utils.sessions import refresh_revocations, SESSION_REVOCATION_REFRESH_SECONDS
+from utils.ledger import (
+    reconcile_balances, take_snapshots,
+    LEDGER_RECONCILE_INTERVAL_SECONDS, LEDGER_SNAPSHOT_INTERVAL_SECONDS
+)
 
 # Import all routers
-from routers import auth, menu, profile, orders, payment, favorites, cart, reviews
+from routers import auth, menu, profile, orders, payment, favorites, cart, reviews, analytics, staff
 # Optional routers: import if present
 try:
     from routers import locations  # type: ignore
@@ -41,6 +58,9 @@ class VietnamTimezoneMiddleware(BaseHTTPMiddleware):
         response.headers["X-Vietnam-Time"] = vn_time
         return response
 
+# Admission control sits innermost so shed (503) responses still get CORS headers
+app.add_middleware(AdmissionControlMiddleware)
+
 # Add custom middleware first (before CORS)
 app.add_middleware(VietnamTimezoneMiddleware)
 
@@ -64,8 +84,54 @@ def startup_event():
     except Exception as e:
         print(f"⚠️ Error initializing database: {e}")
         # Don't crash the app, let it try to connect later
+
+    # Warm the in-memory "bought together" matrix from received orders
+    try:
+        result = rebuild_matrix()
+        print(f"✅ Recommendations built from {result['orders']} orders ({result['duration_seconds']:.2f}s)")
+    except Exception as e:
+        print(f"⚠️ Error building recommendations: {e}")
+    try:
+        result = rebuild_scores()
+        print(f"✅ Trending scores built for {result['products']} products ({result['duration_seconds']:.2f}s)")
+    except Exception as e:
+        print(f"⚠️ Error building trending scores: {e}")
+
+    # Load revoked sessions before serving any token
+    try:
+        result = refresh_revocations()
+        print(f"✅ Session revocations loaded ({result['sessions']} sessions, {result['users']} users)")
+    except Exception as e:
+        print(f"⚠️ Error loading session revocations: {e}")
+
+    # Cross-worker invalidation for the balance/profile cache; also builds the
+    # availability filters once connected
+    start_listener()
+
+    # Sends notifications written to the outbox (also woken through the listener)
+    start_dispatcher()
+
+    # Periodic maintenance jobs
+    register_job("order_sweeper", ORDER_SWEEP_INTERVAL_SECONDS, sweep_stale_orders)
+    register_job("recommendations_rebuild", RECOMMENDATIONS_REBUILD_SECONDS, rebuild_matrix)
+    register_job("trending_rebuild", TRENDING_REBUILD_SECONDS, rebuild_scores)
+    register_job("ledger_snapshots", LEDGER_SNAPSHOT_INTERVAL_SECONDS, take_snapshots)
+    register_job("ledger_reconciliation", LEDGER_RECONCILE_INTERVAL_SECONDS, reconcile_balances)
+    register_job("retention_purge", RETENTION_INTERVAL_SECONDS, run_retention)
+    register_job("session_revocations", SESSION_REVOCATION_REFRESH_SECONDS, refresh_revocations)
+    register_job("availability_rebuild", AVAILABILITY_REBUILD_SECONDS, rebuild_availability)
+    start_jobs()
     print("✅ Application ready")
 
+
+@app.on_event("shutdown")
+def shutdown_event():
+    stop_jobs()
+    stop_dispatcher()
+    stop_listener()
+    shutdown_password_pool()
+    shutdown_mailer()
+
 # Include all routers
 app.include_router(auth.router)
 app.include_router(menu.router)
@@ -75,6 +141,8 @@ app.include_router(payment.router)
 app.include_router(favorites.router)
 app.include_router(cart.router, include_in_schema=False)  # Hide from Swagger
 app.include_router(reviews.router, include_in_schema=False)  # Hide from Swagger
+app.include_router(analytics.router)
+app.include_router(staff.router)
 if locations is not None:
     app.include_router(locations.router)
 if transactions is not None:
@@ -98,6 +166,12 @@ def health_check():
     """API health check"""
     return {"status": "online", "message": "Cafe API is running"}
 
+
+@app.get("/health/metrics", tags=["Health"])
+def metrics_snapshot():
+    """In-process counters, gauges and timings (background jobs, caches, limits)"""
+    return metrics.snapshot()
+
 # Root - serve React index.html if built, else fallback to vanilla index.html
 @app.get("/", tags=["Frontend"], include_in_schema=False)
 def root():
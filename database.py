@@ -16,6 +16,9 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD", "cafe_password")
 }
 
+# Connection pool size - request concurrency limits are derived from it
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", "10"))
+
 # Connection pool
 connection_pool = None
 
@@ -26,7 +29,7 @@ def init_connection_pool():
     try:
         connection_pool = psycopg2.pool.SimpleConnectionPool(
             1,  # minconn
-            10,  # maxconn
+            DB_POOL_MAX_CONNECTIONS,  # maxconn
             **DB_CONFIG
         )
         print("✅ PostgreSQL connection pool created")
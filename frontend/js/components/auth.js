@@ -112,6 +112,7 @@ export async function handleLogin(e) {
         
         setCurrentUser(user);
         storage.saveUserToStorage(user);
+        storage.saveSessionToken(result.data.session_token);
         
         showApp();
         await loadMenu();
@@ -198,6 +199,7 @@ export async function handleRegister(e) {
         
         setCurrentUser(user);
         storage.saveUserToStorage(user);
+        storage.saveSessionToken(result.data.session_token);
         
         showApp();
         await loadMenu();
@@ -267,6 +269,10 @@ export function resetForgotForm() {
 }
 
 export function logout() {
+    // Revoke the session token server-side; the local logout does not wait for it
+    if (storage.getSessionToken()) {
+        api.apiCall('/auth/logout', 'POST');
+    }
     storage.clearAllStorage();
     setCurrentUser(null);
     
@@ -1,6 +1,7 @@
 // ========== ORDERS COMPONENT ==========
 import * as api from '../utils/api.js';
 import * as ui from '../utils/ui.js';
+import { authHeaders } from '../utils/storage.js';
 import { state } from '../utils/state.js';
 import { loadFrequentItems } from './menu.js';
 import { icons } from '../utils/icons.js';
@@ -30,7 +31,7 @@ export async function loadOrderHistory() {
 
 async function checkAndHideWriteReviewButton(orderId, userId) {
     try {
-        const response = await fetch(`/api/reviews/order/${orderId}?user_id=${userId}`);
+        const response = await fetch(`/api/reviews/order/${orderId}?user_id=${userId}`, { headers: authHeaders() });
         if (!response.ok) return;
         
         const data = await response.json();
@@ -61,7 +62,7 @@ window.viewOrderReviews = async function(orderId) {
     try {
         const url = `/api/reviews/order/${orderId}?user_id=${userId}`;
         console.log('Fetching reviews from:', url);
-        const response = await fetch(url);
+        const response = await fetch(url, { headers: authHeaders() });
         
         console.log('Response status:', response.status);
         
@@ -1,6 +1,7 @@
 // ========== REVIEWS COMPONENT ==========
 import { loadOrderHistory } from './orders.js';
 import { icons } from '../utils/icons.js';
+import { authHeaders } from '../utils/storage.js';
 
 /**
  * Format item customization details for display
@@ -76,7 +77,7 @@ async function submitReview(productId, rating, reviewText = '') {
     try {
         const response = await fetch('/api/reviews/submit', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 user_id: userId,
                 product_id: productId,
@@ -175,7 +176,8 @@ async function deleteReview(reviewId) {
     
     try {
         const response = await fetch(`/api/reviews/${reviewId}?user_id=${userId}`, {
-            method: 'DELETE'
+            method: 'DELETE',
+            headers: authHeaders()
         });
         
         if (response.ok) {
@@ -487,7 +489,7 @@ async function submitOrderReviews(orderId, orderItems) {
             
             const response = await fetch('/api/reviews/submit', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: authHeaders({ 'Content-Type': 'application/json' }),
                 body: JSON.stringify(reviewData)
             });
             
@@ -1,5 +1,11 @@
 // ========== SETTINGS SYSTEM HANDLERS ==========
 
+// Session token header (this script is not a module, so no storage.js import)
+function sessionHeaders(headers = {}) {
+    const token = localStorage.getItem('sessionToken');
+    return token ? { ...headers, 'Authorization': `Bearer ${token}` } : headers;
+}
+
 // User Dropdown
 window.toggleUserDropdown = function() {
     const dropdown = document.getElementById('userDropdown');
@@ -173,7 +179,7 @@ window.openPersonalInfoModal = async function() {
     const userId = user.id;
     if (userId) {
         try {
-            const res = await fetch(`/api/user/balance?user_id=${userId}`);
+            const res = await fetch(`/api/user/balance?user_id=${userId}`, { headers: sessionHeaders() });
             const data = await res.json();
             const balEl = document.getElementById('displayBalance');
             if (balEl) {
@@ -219,7 +225,10 @@ window.closeTransactionHistoryModal = function(event) {
     }
 };
 
-async function loadTransactions() {
+// Keyset cursor for the next page of wallet transactions
+let transactionsCursor = null;
+
+async function loadTransactions(append = false) {
     const userId = localStorage.getItem('userId');
     const list = document.getElementById('transactionsList');
     if (!list) {
@@ -227,11 +236,19 @@ async function loadTransactions() {
         return;
     }
     try {
-        const response = await fetch(`/api/transactions?user_id=${encodeURIComponent(userId || '')}`);
+        let url = `/api/transactions?user_id=${encodeURIComponent(userId || '')}`;
+        if (append && transactionsCursor) {
+            url += `&cursor=${encodeURIComponent(transactionsCursor)}`;
+        }
+        const response = await fetch(url, { headers: sessionHeaders() });
         const data = await response.json();
+        transactionsCursor = data.next_cursor || null;
+        
+        const loadMore = document.getElementById('transactionsLoadMore');
+        if (loadMore) loadMore.remove();
         
         if (data.transactions && data.transactions.length > 0) {
-            list.innerHTML = data.transactions.map(t => {
+            const html = data.transactions.map(t => {
                 const isPositive = (t.amount || 0) >= 0 || t.type === 'refund';
                 const amountAbs = Math.abs(t.amount || 0);
                 const sign = isPositive ? '+' : '-';
@@ -258,7 +275,16 @@ async function loadTransactions() {
                     </div>
                 </div>`;
             }).join('');
-        } else {
+            if (append) {
+                list.insertAdjacentHTML('beforeend', html);
+            } else {
+                list.innerHTML = html;
+            }
+            if (transactionsCursor) {
+                list.insertAdjacentHTML('beforeend',
+                    '<button id="transactionsLoadMore" class="btn-cancel" style="display:block; margin:12px auto;" onclick="loadTransactions(true)">Load more</button>');
+            }
+        } else if (!append) {
             list.innerHTML = '<p style="color:#999; text-align:center; padding:20px;">No transactions yet</p>';
         }
     } catch (err) {
@@ -350,7 +376,7 @@ window.submitChangeEmailNew = async function(event) {
         // Verify current password first (reuse existing endpoint)
         const verifyResp = await fetch(`/api/user/verify-password?user_id=${user.id}&current_password=${encodeURIComponent(password)}`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' }
+            headers: sessionHeaders({ 'Content-Type': 'application/json' })
         });
         const verifyData = await verifyResp.json();
         if (!verifyResp.ok) {
@@ -499,7 +525,7 @@ window.submitChangePhoneNew = async function(event) {
     try {
         const response = await fetch('/api/user/change-phone', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: sessionHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 user_id: user.id,
                 new_phone: newPhone,
@@ -597,7 +623,7 @@ window.submitChangeUsernameNew = async function(event) {
     try {
         const response = await fetch('/api/user/change-username', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: sessionHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 user_id: user.id,
                 new_username: newUsername,
@@ -708,7 +734,7 @@ window.submitChangePasswordNew = async function(event) {
         // Verify current password first
         const verifyResp = await fetch(`/api/user/verify-password?user_id=${user.id}&current_password=${encodeURIComponent(currentPassword)}`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' }
+            headers: sessionHeaders({ 'Content-Type': 'application/json' })
         });
         const verifyData = await verifyResp.json();
         if (!verifyResp.ok) {
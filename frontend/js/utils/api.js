@@ -1,13 +1,14 @@
 // ========== API UTILITIES ==========
 import { API_URL } from './state.js';
+import { authHeaders } from './storage.js';
 
 // Generic API call wrapper
 export async function apiCall(endpoint, method = 'GET', body = null) {
     const options = {
         method,
-        headers: {
+        headers: authHeaders({
             'Content-Type': 'application/json'
-        }
+        })
     };
 
     if (body) {
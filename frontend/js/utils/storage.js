@@ -22,6 +22,20 @@ export function getUserFromStorage() {
     };
 }
 
+// Session token from login/registration, sent as "Authorization: Bearer <token>"
+export function saveSessionToken(token) {
+    if (token) localStorage.setItem('sessionToken', token);
+}
+
+export function getSessionToken() {
+    return localStorage.getItem('sessionToken');
+}
+
+export function authHeaders(headers = {}) {
+    const token = getSessionToken();
+    return token ? { ...headers, 'Authorization': `Bearer ${token}` } : headers;
+}
+
 export function updateUserInStorage(updates) {
     if (updates.email) localStorage.setItem('userEmail', updates.email);
     if (updates.name) localStorage.setItem('userName', updates.name);
@@ -35,6 +49,7 @@ export function clearUserStorage() {
     localStorage.removeItem('userName');
     localStorage.removeItem('userPhone');
     localStorage.removeItem('userUsername');
+    localStorage.removeItem('sessionToken');
 }
 
 export function clearAllStorage() {
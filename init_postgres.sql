@@ -1,6 +1,15 @@
 -- PostgreSQL Database Schema for Cafe Ordering System
 -- Converted from SQLite
 
+-- Extensions for staff order search (trigram + unaccented names)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+-- unaccent() is only STABLE; an IMMUTABLE wrapper is required to use it in an index
+CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS $$
+    SELECT public.unaccent('public.unaccent'::regdictionary, $1)
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+
 -- Users table
 CREATE TABLE IF NOT EXISTS users (
     id TEXT PRIMARY KEY,
@@ -102,25 +111,157 @@ CREATE TABLE IF NOT EXISTS transactions (
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- Sales rollups (hourly/daily aggregates read by the analytics API)
+CREATE TABLE IF NOT EXISTS sales_rollup_hourly (
+    bucket_start TIMESTAMP NOT NULL,
+    dimension TEXT NOT NULL,
+    dimension_key TEXT NOT NULL,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    item_quantity INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    discount_total DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket_start, dimension, dimension_key)
+);
+
+CREATE TABLE IF NOT EXISTS sales_rollup_daily (
+    bucket_start TIMESTAMP NOT NULL,
+    dimension TEXT NOT NULL,
+    dimension_key TEXT NOT NULL,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    item_quantity INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    discount_total DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket_start, dimension, dimension_key)
+);
+
+-- Wallet ledger: append-only double-entry records behind users.balance
+-- Each txn_id has a 'wallet' entry for the user and a counter-account entry summing to zero
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id BIGSERIAL PRIMARY KEY,
+    txn_id TEXT NOT NULL,
+    account TEXT NOT NULL,
+    user_id TEXT,
+    amount DECIMAL(14,2) NOT NULL,
+    entry_type TEXT NOT NULL,
+    order_id TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'Asia/Ho_Chi_Minh'),
+    CHECK (account <> 'wallet' OR user_id IS NOT NULL)
+);
+
+-- Per-user wallet balance including every entry up to last_entry_id
+CREATE TABLE IF NOT EXISTS wallet_snapshots (
+    user_id TEXT NOT NULL,
+    last_entry_id BIGINT NOT NULL,
+    balance DECIMAL(14,2) NOT NULL,
+    as_of TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, last_entry_id)
+);
+
+-- Revoked session tokens; a NULL session_id revokes every session of user_id
+-- ('*' for all users) issued before revoked_at. Rows are purged after expires_at.
+CREATE TABLE IF NOT EXISTS session_revocations (
+    id SERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    session_id TEXT,
+    revoked_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Notifications written with the change they report, sent by the dispatcher (utils/outbox.py)
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL,
+    last_error TEXT
+);
+
+CREATE OR REPLACE FUNCTION ledger_reject_change() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'ledger_entries is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ledger_check_balanced() RETURNS trigger AS $$
+BEGIN
+    IF (SELECT SUM(amount) FROM ledger_entries WHERE txn_id = NEW.txn_id) <> 0 THEN
+        RAISE EXCEPTION 'Ledger transaction % is not balanced', NEW.txn_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ledger_entries_append_only ON ledger_entries;
+CREATE TRIGGER ledger_entries_append_only
+    BEFORE UPDATE OR DELETE ON ledger_entries
+    FOR EACH ROW EXECUTE FUNCTION ledger_reject_change();
+
+DROP TRIGGER IF EXISTS ledger_entries_balanced ON ledger_entries;
+CREATE CONSTRAINT TRIGGER ledger_entries_balanced
+    AFTER INSERT ON ledger_entries
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION ledger_check_balanced();
+
 -- Create indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone);
+-- Login looks identifiers up case-insensitively (one index probe per field)
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_key ON users (lower(email));
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_lower_key ON users (lower(username));
 CREATE INDEX IF NOT EXISTS idx_otp_email ON otp_codes(email);
 CREATE INDEX IF NOT EXISTS idx_otp_code ON otp_codes(code);
+CREATE INDEX IF NOT EXISTS idx_otp_expires_at ON otp_codes(expires_at);
 CREATE INDEX IF NOT EXISTS idx_promo_code ON promo_codes(code);
 CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
 CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_phone_trgm ON orders USING gin (customer_phone gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_orders_name_trgm ON orders USING gin (f_unaccent(lower(customer_name)) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_orders_id_trgm ON orders USING gin (id gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_orders_pending_payment_created ON orders(created_at) WHERE status = 'pending_payment' AND payment_method = 'balance';
 CREATE INDEX IF NOT EXISTS idx_favorites_user_id ON favorites(user_id);
 CREATE INDEX IF NOT EXISTS idx_favorites_product_id ON favorites(product_id);
 CREATE INDEX IF NOT EXISTS idx_payment_otp_user ON payment_otp(user_id);
 CREATE INDEX IF NOT EXISTS idx_payment_otp_order ON payment_otp(order_id);
+CREATE INDEX IF NOT EXISTS idx_payment_otp_expires_at ON payment_otp(expires_at);
 CREATE INDEX IF NOT EXISTS idx_cart_user_id ON cart(user_id);
-CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id);
+CREATE INDEX IF NOT EXISTS idx_cart_updated_at ON cart(updated_at);
+CREATE INDEX IF NOT EXISTS idx_session_revocations_expires_at ON session_revocations(expires_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(available_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at DESC, id DESC) INCLUDE (type, amount);
 CREATE INDEX IF NOT EXISTS idx_transactions_created_at ON transactions(created_at);
+CREATE INDEX IF NOT EXISTS idx_sales_rollup_hourly_dimension ON sales_rollup_hourly(dimension, bucket_start);
+CREATE INDEX IF NOT EXISTS idx_sales_rollup_daily_dimension ON sales_rollup_daily(dimension, bucket_start);
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_wallet ON ledger_entries(user_id, id) WHERE account = 'wallet';
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_txn_id ON ledger_entries(txn_id);
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_created_at ON ledger_entries(created_at);
 
 -- Insert sample user (from existing data)
 INSERT INTO users (id, email, username, password_hash, full_name, phone, balance, created_at) 
 VALUES ('1', 'huynhnhattien0411@gmail.com', 'hnt_4', '60616f663978719dbbad04dae8af97004b8ca0b9cd9e6c224fa1575a61f635e6', 'Huynh Nhat Tien', '0789925752', 749000.0, '2025-12-05 19:16:57')
 ON CONFLICT (id) DO NOTHING;
+
+-- User IDs come from this sequence in blocks of 20 per worker (utils/id_allocator.py),
+-- starting above the numeric IDs already in use
+CREATE SEQUENCE IF NOT EXISTS user_id_seq INCREMENT BY 20 MINVALUE 1;
+SELECT setval('user_id_seq', GREATEST(
+    COALESCE((SELECT MAX(CAST(id AS BIGINT)) FROM users WHERE id ~ '^[0-9]+$'), 0) + 1,
+    COALESCE((SELECT last_value + increment_by FROM pg_sequences
+              WHERE schemaname = current_schema() AND sequencename = 'user_id_seq'), 1)
+), false);
+
+-- Opening balance entries for users that have no ledger history yet
+INSERT INTO ledger_entries (txn_id, account, user_id, amount, entry_type, created_at)
+SELECT 'OPEN-' || u.id, a.account, CASE WHEN a.account = 'wallet' THEN u.id END,
+       CASE WHEN a.account = 'wallet' THEN u.balance ELSE -u.balance END,
+       'opening_balance', CURRENT_TIMESTAMP AT TIME ZONE 'Asia/Ho_Chi_Minh'
+FROM users u
+CROSS JOIN (VALUES ('wallet'), ('opening_balance')) AS a(account)
+WHERE NOT EXISTS (
+    SELECT 1 FROM ledger_entries e WHERE e.account = 'wallet' AND e.user_id = u.id
+);
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the Cafe Ordering System
+
+Usage:
+    python manage.py rebuild-rollups
+    python manage.py reconcile-ledger
+    python manage.py snapshot-ledger
+    python manage.py export orders --format csv --start 2024-01-01 --status delivered,completed --gzip -o orders.csv.gz
+    python manage.py mass-cancel --status pending_payment,paid --district "Quận 1" --before 2024-06-01
+    python manage.py purge --dry-run
+    python manage.py calibrate-passwords --target-ms 100
+    python manage.py benchmark-mail --messages 500 --workers 1,2,4
+"""
+import argparse
+import contextlib
+import sys
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def cmd_rebuild_rollups(args):
+    """Recompute sales rollups from the orders table"""
+    from utils.sales_rollups import rebuild_rollups
+    result = rebuild_rollups()
+    for table, rows in result["rows"].items():
+        print(f"   {table}: {rows} rows")
+    print(f"✅ Sales rollups rebuilt in {result['duration_seconds']:.2f}s")
+
+
+def cmd_reconcile_ledger(args):
+    """Check users.balance against the wallet ledger"""
+    from utils.ledger import reconcile_balances
+    result = reconcile_balances()
+    for drift in result["drift"]:
+        print(f"   user {drift['user_id']}: balance {drift['balance']:,.2f} "
+              f"ledger {drift['ledger_balance']:,.2f} ({drift['difference']:+,.2f})")
+    status = "❌" if result["drift"] else "✅"
+    print(f"{status} {result['checked']} wallets checked, {len(result['drift'])} drifted "
+          f"({result['duration_seconds']:.2f}s)")
+    if result["drift"]:
+        sys.exit(1)
+
+
+def cmd_snapshot_ledger(args):
+    """Write balance snapshots for wallets that changed"""
+    from utils.ledger import take_snapshots
+    result = take_snapshots()
+    print(f"✅ {result['snapshots']} wallet snapshots written ({result['duration_seconds']:.2f}s)")
+
+
+def cmd_export(args):
+    """Stream a table export to a file (or stdout)"""
+    from utils.exports import build_export_sql, stream_copy
+    statuses = [s.strip() for s in args.status.split(",") if s.strip()] if args.status else None
+    start = datetime.fromisoformat(args.start) if args.start else None
+    end = datetime.fromisoformat(args.end) if args.end else None
+    sql, params = build_export_sql(args.table, args.format, start, end, statuses)
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    written = 0
+    try:
+        # Keep log lines (e.g. pool start-up) out of the exported data
+        with contextlib.redirect_stdout(sys.stderr):
+            for chunk in stream_copy(sql, params, compress=args.gzip):
+                out.write(chunk)
+                written += len(chunk)
+    finally:
+        if args.output:
+            out.close()
+    if args.output:
+        print(f"✅ Exported {args.table} to {args.output} ({written} bytes)")
+
+
+def cmd_mass_cancel(args):
+    """Cancel and refund every open order matching the filters, printing progress"""
+    from utils.mass_refund import start_mass_cancellation, get_job, wait_for_notifications
+    filters = {
+        "statuses": [s.strip() for s in args.status.split(",") if s.strip()] if args.status else None,
+        "created_after": datetime.fromisoformat(args.after) if args.after else None,
+        "created_before": datetime.fromisoformat(args.before) if args.before else None,
+        "delivery_district": args.district,
+        "payment_method": args.payment_method,
+    }
+    job_id = start_mass_cancellation(filters)
+    while True:
+        job = get_job(job_id)
+        print(f"   {job['processed']}/{job['total'] if job['total'] is not None else '?'} cancelled, "
+              f"{job['refunded_orders']} refunded ({job['refunded_amount']:,.0f}), "
+              f"{job['notifications_queued']} emails queued")
+        if job["status"] != "running":
+            break
+        time.sleep(1)
+
+    if job["status"] == "failed":
+        print(f"❌ Mass cancellation failed: {job['error']}")
+        sys.exit(1)
+    print(f"✅ {job['processed']} orders cancelled, {job['refunded_orders']} refunded "
+          f"({job['refunded_amount']:,.0f}) in {job['duration_seconds']:.2f}s; "
+          f"{job['notifications_queued']} refund emails in the outbox")
+    if not args.no_email and job["notifications_queued"]:
+        emails = wait_for_notifications(job_id, timeout=args.email_timeout)
+        print(f"   emails sent {emails['sent']}, failed {emails['failed']}, still pending {emails['pending']}")
+        if emails["pending"]:
+            print("⚠️ Pending refund emails stay in the outbox and are sent by the server's dispatchers")
+    if job["remaining"]:
+        print(f"⚠️ {job['remaining']} matching orders were locked by other requests; run again to finish")
+
+
+def cmd_purge(args):
+    """Apply the retention policies now (or report what they would delete)"""
+    from utils.retention import RETENTION_POLICIES, POLICIES_BY_NAME, count_expired, run_retention
+    unknown = [name for name in args.policy if name not in POLICIES_BY_NAME]
+    if unknown:
+        print(f"❌ Unknown policy: {', '.join(unknown)} (choose from {', '.join(POLICIES_BY_NAME)})")
+        sys.exit(2)
+    policies = [POLICIES_BY_NAME[name] for name in args.policy] if args.policy else RETENTION_POLICIES
+    if args.dry_run:
+        for policy in policies:
+            print(f"   {policy.name}: {count_expired(policy)} rows ({policy.description})")
+        return
+
+    result = run_retention(policies, force=args.force, max_run_seconds=args.max_seconds)
+    if result["skipped"]:
+        print("⏸️ Peak hours: nothing purged (use --force to run anyway)")
+        return
+    for r in result["results"]:
+        status = "error: " + r["error"] if r.get("error") else ("done" if r["complete"] else "more left")
+        print(f"   {r['policy']}: {r['purged']} rows in {r['batches']} batches, "
+              f"{r['duration_seconds']:.2f}s ({status})")
+    print(f"✅ Retention run finished in {result['duration_seconds']:.2f}s")
+
+
+def cmd_calibrate_passwords(args):
+    """Benchmark scrypt on this machine and suggest cost parameters for a target latency"""
+    from utils.passwords import calibrate
+    result = calibrate(args.target_ms, r=args.r, p=args.p, rounds=args.rounds)
+    for t in result["timings"]:
+        print(f"   N={t['n']:>8} r={t['r']} p={t['p']}: {t['median_ms']:>8.1f} ms, {t['memory_mib']} MiB")
+    if result["n"] is None:
+        print(f"❌ Even the smallest N is slower than {args.target_ms} ms")
+        sys.exit(1)
+    print(f"✅ Largest N within {args.target_ms} ms; set in .env:")
+    print(f"PASSWORD_SCRYPT_N={result['n']}")
+    print(f"PASSWORD_SCRYPT_R={result['r']}")
+    print(f"PASSWORD_SCRYPT_P={result['p']}")
+
+
+def cmd_benchmark_mail(args):
+    """Measure email throughput against a local SMTP stand-in, per-message vs reused sessions"""
+    import io
+    from utils.mail_benchmark import benchmark
+    worker_counts = [int(w) for w in args.workers.split(",") if w.strip()]
+    print(f"   Stand-in SMTP server: {args.connect_delay}s connect + {args.auth_delay}s login per session")
+    # Keep the mailer's per-message log lines out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = benchmark(args.messages, worker_counts, args.baseline_messages,
+                           args.connect_delay, args.auth_delay)
+    for run in result["runs"]:
+        label = "one connection per message" if run["workers"] is None else f"pooled, {run['workers']} worker(s)"
+        print(f"   {label:<28} {run['messages']:>5} messages in {run['seconds']:>7.2f}s = "
+              f"{run['per_second']:>7.1f} msg/s")
+    failed = sum(run["messages"] - run["sent"] for run in result["runs"])
+    if failed:
+        print(f"❌ {failed} messages failed to send")
+        sys.exit(1)
+    print(f"✅ {result['received']} messages delivered to the stand-in")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cafe Ordering System maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild-rollups", help="Rebuild sales rollup tables from orders")
+    rebuild.set_defaults(func=cmd_rebuild_rollups)
+
+    reconcile = subparsers.add_parser("reconcile-ledger", help="Verify balances against the wallet ledger")
+    reconcile.set_defaults(func=cmd_reconcile_ledger)
+
+    snapshot = subparsers.add_parser("snapshot-ledger", help="Snapshot wallet balances from the ledger")
+    snapshot.set_defaults(func=cmd_snapshot_ledger)
+
+    export = subparsers.add_parser("export", help="Export orders or transactions as CSV/NDJSON")
+    export.add_argument("table", choices=["orders", "transactions"])
+    export.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    export.add_argument("--start", help="Only rows created at or after this ISO datetime")
+    export.add_argument("--end", help="Only rows created before this ISO datetime")
+    export.add_argument("--status", help="Comma-separated statuses (orders) or types (transactions)")
+    export.add_argument("--gzip", action="store_true", help="gzip-compress the output")
+    export.add_argument("-o", "--output", help="Output file (default: stdout)")
+    export.set_defaults(func=cmd_export)
+
+    mass_cancel = subparsers.add_parser("mass-cancel", help="Cancel and refund open orders in bulk")
+    mass_cancel.add_argument("--status", help="Comma-separated open statuses (default: all open statuses)")
+    mass_cancel.add_argument("--after", help="Only orders created at or after this ISO datetime")
+    mass_cancel.add_argument("--before", help="Only orders created before this ISO datetime")
+    mass_cancel.add_argument("--district", help="Only orders delivered to this district")
+    mass_cancel.add_argument("--payment-method", choices=["balance", "cod"])
+    mass_cancel.add_argument("--no-email", action="store_true",
+                             help="Exit without sending refund emails (the server's outbox dispatchers send them)")
+    mass_cancel.add_argument("--email-timeout", type=float, default=300.0,
+                             help="Seconds to spend sending refund emails before leaving them to the server")
+    mass_cancel.set_defaults(func=cmd_mass_cancel)
+
+    purge = subparsers.add_parser("purge", help="Delete expired OTPs, idle carts and stale frequent items")
+    purge.add_argument("policy", nargs="*", help="Policies to run (default: all)")
+    purge.add_argument("--dry-run", action="store_true", help="Only count the rows each policy would delete")
+    purge.add_argument("--force", action="store_true", help="Run during peak hours too")
+    purge.add_argument("--max-seconds", type=float, help="Time budget for this run")
+    purge.set_defaults(func=cmd_purge)
+
+    calibrate = subparsers.add_parser("calibrate-passwords",
+                                      help="Pick password hashing cost for a target latency")
+    calibrate.add_argument("--target-ms", type=float, default=100.0, help="Target time per hash (ms)")
+    calibrate.add_argument("--r", type=int, default=8, help="scrypt block size")
+    calibrate.add_argument("--p", type=int, default=1, help="scrypt parallelism")
+    calibrate.add_argument("--rounds", type=int, default=5, help="Timed hashes per candidate")
+    calibrate.set_defaults(func=cmd_calibrate_passwords)
+
+    bench_mail = subparsers.add_parser("benchmark-mail",
+                                       help="Measure email throughput against a local SMTP stand-in")
+    bench_mail.add_argument("--messages", type=int, default=500, help="Messages per pooled run")
+    bench_mail.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to try")
+    bench_mail.add_argument("--baseline-messages", type=int, default=20,
+                            help="Messages sent one connection each (0 skips the baseline)")
+    bench_mail.add_argument("--connect-delay", type=float, default=0.15,
+                            help="Stand-in delay before its greeting (TLS handshake), seconds")
+    bench_mail.add_argument("--auth-delay", type=float, default=0.15, help="Stand-in delay for LOGIN, seconds")
+    bench_mail.set_defaults(func=cmd_benchmark_mail)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
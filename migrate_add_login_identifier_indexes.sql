@@ -0,0 +1,24 @@
+-- Migration: Case-insensitive unique indexes for login identifiers
+-- Login looks users up by lower(email) / lower(username), one index probe each, instead of
+-- `email = %s OR username = %s` (a BitmapOr or sequential scan that also missed addresses
+-- stored with capitals by the email change). They also make addresses and usernames that
+-- differ only in case count as the same.
+
+-- Fails (listing the clashes) if existing accounts differ only in case; resolve those first
+DO $$
+DECLARE
+    clashes TEXT;
+BEGIN
+    SELECT string_agg(value, ', ') INTO clashes FROM (
+        SELECT 'email ' || lower(email) AS value FROM users GROUP BY lower(email) HAVING COUNT(*) > 1
+        UNION ALL
+        SELECT 'username ' || lower(username) FROM users
+        WHERE username IS NOT NULL GROUP BY lower(username) HAVING COUNT(*) > 1
+    ) duplicates;
+    IF clashes IS NOT NULL THEN
+        RAISE EXCEPTION 'Accounts differ only in case: %', clashes;
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_key ON users (lower(email));
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_lower_key ON users (lower(username));
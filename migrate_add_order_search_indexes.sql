@@ -0,0 +1,14 @@
+-- Migration: Trigram indexes for staff order search
+-- Run this to support partial phone, unaccented name and order-ID lookups without sequential scans
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+-- unaccent() is only STABLE; an IMMUTABLE wrapper is required to use it in an index
+CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS $$
+    SELECT public.unaccent('public.unaccent'::regdictionary, $1)
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+
+CREATE INDEX IF NOT EXISTS idx_orders_phone_trgm ON orders USING gin (customer_phone gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_orders_name_trgm ON orders USING gin (f_unaccent(lower(customer_name)) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_orders_id_trgm ON orders USING gin (id gin_trgm_ops);
@@ -0,0 +1,6 @@
+-- Migration: Partial index for the stale pending_payment order sweeper
+-- Run this to let the sweeper find unpaid balance orders without scanning idx_orders_status
+
+CREATE INDEX IF NOT EXISTS idx_orders_pending_payment_created
+    ON orders(created_at)
+    WHERE status = 'pending_payment' AND payment_method = 'balance';
@@ -0,0 +1,19 @@
+-- Migration: Transactional outbox for notifications
+-- Emails are inserted here in the same transaction as the change they report and sent by
+-- the dispatcher on every worker (utils/outbox.py). Sent rows are deleted; rows that ran
+-- out of attempts stay as 'failed' until the retention job purges them.
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL,
+    last_error TEXT
+);
+
+-- Dispatcher: due pending rows, oldest first
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(available_at) WHERE status = 'pending';
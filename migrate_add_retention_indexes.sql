@@ -0,0 +1,7 @@
+-- Migration: Indexes for the retention purge job
+-- Lets each purge batch read the oldest expired rows from an index instead of scanning the table
+-- (frequent_items already has idx_frequent_items_last_ordered)
+
+CREATE INDEX IF NOT EXISTS idx_otp_expires_at ON otp_codes(expires_at);
+CREATE INDEX IF NOT EXISTS idx_payment_otp_expires_at ON payment_otp(expires_at);
+CREATE INDEX IF NOT EXISTS idx_cart_updated_at ON cart(updated_at);
@@ -0,0 +1,27 @@
+-- Migration: Add sales rollup tables for the analytics API
+-- Run this, then `python manage.py rebuild-rollups` to backfill from existing orders
+
+CREATE TABLE IF NOT EXISTS sales_rollup_hourly (
+    bucket_start TIMESTAMP NOT NULL,
+    dimension TEXT NOT NULL,
+    dimension_key TEXT NOT NULL,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    item_quantity INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    discount_total DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket_start, dimension, dimension_key)
+);
+
+CREATE TABLE IF NOT EXISTS sales_rollup_daily (
+    bucket_start TIMESTAMP NOT NULL,
+    dimension TEXT NOT NULL,
+    dimension_key TEXT NOT NULL,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    item_quantity INTEGER NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    discount_total DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket_start, dimension, dimension_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_sales_rollup_hourly_dimension ON sales_rollup_hourly(dimension, bucket_start);
+CREATE INDEX IF NOT EXISTS idx_sales_rollup_daily_dimension ON sales_rollup_daily(dimension, bucket_start);
@@ -0,0 +1,12 @@
+-- Migration: Revocation list for signed session tokens
+-- Workers load the unexpired rows into memory; the retention job purges expired ones
+
+CREATE TABLE IF NOT EXISTS session_revocations (
+    id SERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    session_id TEXT,
+    revoked_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_revocations_expires_at ON session_revocations(expires_at);
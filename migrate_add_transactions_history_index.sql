@@ -0,0 +1,10 @@
+-- Migration: Covering index for paginated wallet transaction history
+-- Serves keyset pages (user_id, created_at DESC, id DESC) and the spent/refunded
+-- totals as index-only scans; replaces the plain user_id index
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created
+    ON transactions(user_id, created_at DESC, id DESC) INCLUDE (type, amount);
+
+DROP INDEX IF EXISTS idx_transactions_user_id;
+
+ANALYZE transactions;
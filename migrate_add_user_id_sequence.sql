@@ -0,0 +1,14 @@
+-- Migration: Sequence for user IDs
+-- Registration used SELECT MAX(CAST(id AS INTEGER)) (a full scan with a regex per row, and
+-- racy between concurrent sign-ups). Each nextval now reserves a block of 20 IDs for one
+-- worker (utils/id_allocator.py); change the block size with ALTER SEQUENCE ... INCREMENT BY.
+
+CREATE SEQUENCE IF NOT EXISTS user_id_seq INCREMENT BY 20 MINVALUE 1;
+
+-- Start above every numeric ID in use, and never move back over blocks already handed out
+-- (safe to re-run)
+SELECT setval('user_id_seq', GREATEST(
+    COALESCE((SELECT MAX(CAST(id AS BIGINT)) FROM users WHERE id ~ '^[0-9]+$'), 0) + 1,
+    COALESCE((SELECT last_value + increment_by FROM pg_sequences
+              WHERE schemaname = current_schema() AND sequencename = 'user_id_seq'), 1)
+), false);
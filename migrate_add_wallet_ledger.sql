@@ -0,0 +1,64 @@
+-- Migration: Add the double-entry wallet ledger and balance snapshots
+-- Existing balances are recorded as opening entries, so the ledger starts in balance
+
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id BIGSERIAL PRIMARY KEY,
+    txn_id TEXT NOT NULL,
+    account TEXT NOT NULL,
+    user_id TEXT,
+    amount DECIMAL(14,2) NOT NULL,
+    entry_type TEXT NOT NULL,
+    order_id TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'Asia/Ho_Chi_Minh'),
+    CHECK (account <> 'wallet' OR user_id IS NOT NULL)
+);
+
+-- Per-user wallet balance including every entry up to last_entry_id
+CREATE TABLE IF NOT EXISTS wallet_snapshots (
+    user_id TEXT NOT NULL,
+    last_entry_id BIGINT NOT NULL,
+    balance DECIMAL(14,2) NOT NULL,
+    as_of TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, last_entry_id)
+);
+
+CREATE OR REPLACE FUNCTION ledger_reject_change() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'ledger_entries is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ledger_check_balanced() RETURNS trigger AS $$
+BEGIN
+    IF (SELECT SUM(amount) FROM ledger_entries WHERE txn_id = NEW.txn_id) <> 0 THEN
+        RAISE EXCEPTION 'Ledger transaction % is not balanced', NEW.txn_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ledger_entries_append_only ON ledger_entries;
+CREATE TRIGGER ledger_entries_append_only
+    BEFORE UPDATE OR DELETE ON ledger_entries
+    FOR EACH ROW EXECUTE FUNCTION ledger_reject_change();
+
+DROP TRIGGER IF EXISTS ledger_entries_balanced ON ledger_entries;
+CREATE CONSTRAINT TRIGGER ledger_entries_balanced
+    AFTER INSERT ON ledger_entries
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION ledger_check_balanced();
+
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_wallet ON ledger_entries(user_id, id) WHERE account = 'wallet';
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_txn_id ON ledger_entries(txn_id);
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_created_at ON ledger_entries(created_at);
+
+-- Opening balance entries for users that have no ledger history yet
+INSERT INTO ledger_entries (txn_id, account, user_id, amount, entry_type, created_at)
+SELECT 'OPEN-' || u.id, a.account, CASE WHEN a.account = 'wallet' THEN u.id END,
+       CASE WHEN a.account = 'wallet' THEN u.balance ELSE -u.balance END,
+       'opening_balance', CURRENT_TIMESTAMP AT TIME ZONE 'Asia/Ho_Chi_Minh'
+FROM users u
+CROSS JOIN (VALUES ('wallet'), ('opening_balance')) AS a(account)
+WHERE NOT EXISTS (
+    SELECT 1 FROM ledger_entries e WHERE e.account = 'wallet' AND e.user_id = u.id
+);
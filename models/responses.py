@@ -3,6 +3,7 @@ Response models for API documentation
 """
 from pydantic import BaseModel
 from typing import List, Optional, Any, Union
+from datetime import datetime
 
 
 class StatusResponse(BaseModel):
@@ -44,6 +45,8 @@ class UserResponse(BaseModel):
     name: str
     username: Optional[str] = None
     phone: Optional[str] = None
+    session_token: Optional[str] = None  # Send as "Authorization: Bearer <token>"
+    session_expires_at: Optional[datetime] = None
     
     class Config:
         json_schema_extra = {
@@ -52,7 +55,9 @@ class UserResponse(BaseModel):
                 "email": "user@example.com",
                 "name": "John Doe",
                 "username": "johndoe",
-                "phone": "0123456789"
+                "phone": "0123456789",
+                "session_token": "v1.eyJzdWIiOiIxIn0.c2lnbmF0dXJl",
+                "session_expires_at": "2025-01-08T10:00:00"
             }
         }
 
@@ -79,6 +84,22 @@ class UserDetailResponse(BaseModel):
         }
 
 
+class AvailabilityResponse(BaseModel):
+    """Whether each checked value is free (null for fields not checked)"""
+    email: Optional[bool] = None
+    username: Optional[bool] = None
+    phone: Optional[bool] = None
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "email": None,
+                "username": False,
+                "phone": None
+            }
+        }
+
+
 class BalanceResponse(BaseModel):
     """User balance response"""
     balance: float
@@ -375,9 +396,18 @@ class Transaction(BaseModel):
         }
 
 
+class TransactionTotals(BaseModel):
+    """Totals over the whole filtered range (first page only)"""
+    spent: float
+    refunded: float
+    count: int
+
+
 class TransactionHistoryResponse(BaseModel):
-    """List of user transactions"""
+    """One page of user transactions"""
     transactions: List[Transaction]
+    next_cursor: Optional[str] = None
+    totals: Optional[TransactionTotals] = None
     
     class Config:
         json_schema_extra = {
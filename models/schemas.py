@@ -3,6 +3,7 @@ Pydantic models for request/response validation
 """
 from pydantic import BaseModel, EmailStr, model_validator
 from typing import List, Optional
+from datetime import datetime
 
 
 class OTPRequest(BaseModel):
@@ -120,6 +121,84 @@ class CheckoutRequest(BaseModel):
         }
 
 
+class BulkOrderLine(BaseModel):
+    product_id: str
+    quantity: int = 1
+    size: Optional[str] = "M"
+    temperature: Optional[str] = None
+    sugar: Optional[str] = None
+    milk: Optional[str] = None
+    upsells: Optional[List[str]] = []
+    toppings: Optional[List[str]] = []
+    recipient_name: Optional[str] = None
+    recipient_phone: Optional[str] = None
+    note: Optional[str] = None
+
+
+class BulkOrderRequest(BaseModel):
+    user_id: str
+    customer_name: str
+    customer_phone: str
+    customer_email: str
+    payment_method: str
+    lines: List[BulkOrderLine]
+    split_by_recipient: Optional[bool] = False  # True: one order per recipient, False: one order
+    allow_partial: Optional[bool] = False  # True: create valid lines, report invalid ones
+    delivery_district: Optional[str] = ""
+    delivery_ward: Optional[str] = ""
+    delivery_street: Optional[str] = ""
+    special_notes: Optional[str] = ""
+    promo_code: Optional[str] = ""
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "user_id": "1",
+                "customer_name": "ACME Office",
+                "customer_phone": "0123456789",
+                "customer_email": "office@acme.vn",
+                "payment_method": "balance",
+                "split_by_recipient": False,
+                "lines": [
+                    {"product_id": "cf_6", "quantity": 1, "size": "L", "sugar": "50", "recipient_name": "Lan"},
+                    {"product_id": "t_6", "quantity": 2, "upsells": ["pearls"], "recipient_name": "Minh"}
+                ],
+                "delivery_district": "Quận 1",
+                "delivery_ward": "Phường Bến Nghé",
+                "delivery_street": "123 Nguyễn Huệ"
+            }
+        }
+
+
+class ReorderRequest(BaseModel):
+    user_id: str
+    order_id: Optional[str] = None  # Reorder everything from a previous order...
+    frequent_item_ids: Optional[List[int]] = None  # ...or these /api/frequent-items entries
+    payment_method: str
+    customer_name: Optional[str] = None  # Defaults: previous order, then profile
+    customer_phone: Optional[str] = None
+    delivery_district: Optional[str] = None  # Defaults: previous order's address
+    delivery_ward: Optional[str] = None
+    delivery_street: Optional[str] = None
+    special_notes: Optional[str] = ""
+    promo_code: Optional[str] = ""
+    
+    @model_validator(mode='after')
+    def check_source(self):
+        if bool(self.order_id) == bool(self.frequent_item_ids):
+            raise ValueError('Provide either order_id or frequent_item_ids')
+        return self
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "user_id": "1",
+                "order_id": "A1B2C3D4",
+                "payment_method": "balance"
+            }
+        }
+
+
 class PromoCodeRequest(BaseModel):
     code: str
     
@@ -275,6 +354,30 @@ class OrderActionRequest(BaseModel):
         }
 
 
+class MassCancelRequest(BaseModel):
+    statuses: Optional[List[str]] = None  # Default: every open status
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    delivery_district: Optional[str] = None
+    payment_method: Optional[str] = None
+
+    @model_validator(mode='after')
+    def check_statuses(self):
+        closed = {'delivered', 'completed', 'cancelled'}
+        if self.statuses and closed.intersection(self.statuses):
+            raise ValueError('Only open orders can be cancelled')
+        return self
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "statuses": ["pending_payment", "paid", "preparing"],
+                "created_after": "2024-01-01T00:00:00+07:00",
+                "delivery_district": "Quận 1"
+            }
+        }
+
+
 # ========== REVIEW MODELS ==========
 
 class ReviewSubmit(BaseModel):
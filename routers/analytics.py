@@ -0,0 +1,115 @@
+"""
+Analytics routes: Revenue, districts, top products, payment methods, promos.
+Reads only the sales rollup tables - never the orders table. Management only (requires X-Staff-Key).
+"""
+from fastapi import APIRouter, HTTPException, Depends
+from utils.security import require_staff
+from utils.sales_rollups import query_rollups
+from utils.timezone import get_vietnam_time, to_vietnam_naive
+from datetime import datetime, timedelta
+from typing import Optional
+
+router = APIRouter(prefix="/api/analytics", tags=["📊 Analytics"], dependencies=[Depends(require_staff)])
+
+DEFAULT_RANGE_DAYS = 30
+
+
+def _resolve_range(start: Optional[datetime], end: Optional[datetime]):
+    """Default to the last 30 days; timestamps are naive Vietnam time like orders.created_at"""
+    start, end = to_vietnam_naive(start), to_vietnam_naive(end)
+    end = end or get_vietnam_time().replace(tzinfo=None)
+    start = start or (end - timedelta(days=DEFAULT_RANGE_DAYS))
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+
+def _check_grain(grain: str):
+    if grain not in ("hour", "day"):
+        raise HTTPException(status_code=400, detail="grain must be 'hour' or 'day'")
+
+
+def _serialize(rows):
+    result = []
+    for row in rows:
+        item = {
+            "key": row['dimension_key'],
+            "order_count": int(row['order_count']),
+            "item_quantity": int(row['item_quantity']),
+            "revenue": float(row['revenue']),
+            "discount_total": float(row['discount_total'])
+        }
+        if 'bucket_start' in row:
+            item["bucket_start"] = row['bucket_start'].isoformat()
+        result.append(item)
+    return result
+
+
+@router.get("/revenue", summary="Revenue Time Series")
+def revenue(grain: str = "day", start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Revenue and order counts per hour or day.
+
+    - **grain**: `hour` or `day` (default: day)
+    - **start** / **end**: ISO datetimes (default: last 30 days)
+
+    Returns one bucket per hour/day that had sales.
+    """
+    _check_grain(grain)
+    start, end = _resolve_range(start, end)
+    rows = query_rollups(grain, "total", start, end)
+    return {"grain": grain, "start": start.isoformat(), "end": end.isoformat(), "buckets": _serialize(rows)}
+
+
+@router.get("/districts", summary="Orders and Revenue per District")
+def districts(grain: str = "day", start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Orders and revenue per delivery district, ranked by revenue.
+
+    - **grain**: rollup table to read, `hour` or `day` (default: day)
+    - **start** / **end**: ISO datetimes (default: last 30 days)
+    """
+    _check_grain(grain)
+    start, end = _resolve_range(start, end)
+    rows = query_rollups(grain, "district", start, end, order_by_revenue=True)
+    return {"start": start.isoformat(), "end": end.isoformat(), "districts": _serialize(rows)}
+
+
+@router.get("/products/top", summary="Top Products by Revenue")
+def top_products(limit: int = 10, grain: str = "day", start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Best-selling products ranked by revenue.
+
+    - **limit**: Number of products to return (default: 10)
+    - **start** / **end**: ISO datetimes (default: last 30 days)
+    """
+    _check_grain(grain)
+    start, end = _resolve_range(start, end)
+    rows = query_rollups(grain, "product", start, end, order_by_revenue=True, limit=max(1, min(limit, 100)))
+    return {"start": start.isoformat(), "end": end.isoformat(), "products": _serialize(rows)}
+
+
+@router.get("/payment-methods", summary="Revenue per Payment Method")
+def payment_methods(grain: str = "day", start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Orders and revenue per payment method.
+
+    - **start** / **end**: ISO datetimes (default: last 30 days)
+    """
+    _check_grain(grain)
+    start, end = _resolve_range(start, end)
+    rows = query_rollups(grain, "payment_method", start, end, order_by_revenue=True)
+    return {"start": start.isoformat(), "end": end.isoformat(), "payment_methods": _serialize(rows)}
+
+
+@router.get("/promos", summary="Promo Code Effectiveness")
+def promos(grain: str = "day", start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    Orders, revenue and total discount given per promo code.
+
+    - **start** / **end**: ISO datetimes (default: last 30 days)
+    """
+    _check_grain(grain)
+    start, end = _resolve_range(start, end)
+    rows = query_rollups(grain, "promo", start, end, order_by_revenue=True)
+    return {"start": start.isoformat(), "end": end.isoformat(), "promos": _serialize(rows)}
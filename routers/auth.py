@@ -1,22 +1,60 @@
 """
 Authentication routes: OTP registration, login, password reset
 """
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Request, Depends, Header
 from models.schemas import OTPRequest, VerifyOTPRequest, LoginRequest, ResetPasswordRequest
-from models.responses import OTPSentResponse, UserResponse, UserDetailResponse, StatusResponse
+from models.responses import OTPSentResponse, UserResponse, UserDetailResponse, StatusResponse, AvailabilityResponse
 from database import get_db
-from utils.security import hash_password, verify_password, generate_otp, send_email
-from utils.timezone import get_vietnam_time
+from utils.passwords import hash_password, verify_password, verify_dummy, needs_rehash
+from utils import otp as otp_service
+from utils import outbox
+from utils.otp import OTPPurpose, OTPError, otp_http_error
+from utils.ledger import post_wallet_entry, SIGNUP_CREDIT_ACCOUNT
+from utils.user_cache import get_profile
+from utils.id_allocator import next_user_id
+from utils.rate_limit import check_rate_limit
+from utils import availability
+from utils.availability import check as check_identifiers, publish_identifiers, remember as remember_identifiers
+from utils.sessions import (
+    issue_session, check_session, revoke_session, revoke_user_sessions, apply_user_revocation,
+)
 import re
 import secrets
-from datetime import datetime, timedelta
 import psycopg2.extras
 
 router = APIRouter(prefix="/api/auth", tags=["1️⃣ Authentication"])
 
+# Unknown and already-used codes look the same to the client
+_AUTH_OTP_ERRORS = {
+    "not_found": (400, "Invalid OTP code"),
+    "used": (400, "Invalid OTP code"),
+    "invalid": (400, "Invalid OTP code"),
+}
+
+# Unique constraints on users -> response when registration hits one
+_REGISTRATION_CONFLICTS = {
+    "users_email_key": (400, "Email '{email}' is already registered. Please login instead."),
+    "users_username_key": (400, "Username already taken"),
+    "users_phone_key": (400, "Phone number '{phone}' is already registered with another account."),
+    "users_email_lower_key": (400, "Email '{email}' is already registered. Please login instead."),
+    "users_username_lower_key": (400, "Username already taken"),
+}
+_ID_COLLISION_RETRIES = 3
+
+# Login lookups: one probe on the lower(email) / lower(username) unique indexes
+# per field the identifier can match (an email match wins and ends the scan)
+_LOGIN_COLUMNS = "id, full_name, password_hash, email, username, phone"
+_LOGIN_BY_EMAIL_OR_USERNAME = f"""
+    SELECT {_LOGIN_COLUMNS} FROM users WHERE lower(email) = %(identifier)s
+    UNION ALL
+    SELECT {_LOGIN_COLUMNS} FROM users WHERE lower(username) = %(identifier)s
+    LIMIT 1
+"""
+_LOGIN_BY_USERNAME = f"SELECT {_LOGIN_COLUMNS} FROM users WHERE lower(username) = %(identifier)s"
+
 
 @router.post("/send-otp", summary="Send OTP for Registration", response_model=OTPSentResponse)
-def send_otp(request: OTPRequest, background_tasks: BackgroundTasks):
+def send_otp(request: OTPRequest, http_request: Request):
     """
     Send OTP to email for registration.
     
@@ -30,30 +68,23 @@ def send_otp(request: OTPRequest, background_tasks: BackgroundTasks):
     if not re.match(r"^[^@]+@[^@]+\.[^@]+$", email):
         raise HTTPException(status_code=400, detail="Invalid email format")
     
+    check_rate_limit("send_otp", http_request, email=email)
+    
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
     # Check if email already registered - STOP before sending OTP
-    c.execute("SELECT id, email FROM users WHERE email = %s", (email,))
+    c.execute("SELECT id, email FROM users WHERE lower(email) = %s", (email,))
     existing = c.fetchone()
     if existing:
         conn.close()
         raise HTTPException(status_code=400, detail=f"Email '{email}' is already registered. Please login instead.")
     
-    # Generate OTP
-    otp = generate_otp()
-    # Save expires_at as naive datetime in Vietnam timezone
-    expires_at = (get_vietnam_time() + timedelta(minutes=10)).replace(tzinfo=None)
-    
-    # Save OTP
-    c.execute("""
-        INSERT INTO otp_codes (email, code, expires_at)
-        VALUES (%s, %s, %s)
-    """, (email, otp, expires_at))
-    
-    conn.commit()
     conn.close()
     
+    # Generate OTP (held by the OTP service, not the database)
+    otp = otp_service.issue(OTPPurpose.REGISTRATION, email)
+    
     # Prepare email HTML
     html_body = f"""
     <html>
@@ -68,8 +99,9 @@ def send_otp(request: OTPRequest, background_tasks: BackgroundTasks):
     </html>
     """
     
-    # Send email in background
-    background_tasks.add_task(send_email, email, "Your Cafe Ordering OTP Code", html_body)
+    # Sent by the outbox dispatcher; dropped if still unsent when the code expires
+    outbox.submit("email", {"to_email": email, "subject": "Your Cafe Ordering OTP Code", "html_body": html_body},
+                  expires_in_seconds=otp_service.OTP_TTL_SECONDS)
     
     return {
         "status": "success",
@@ -96,68 +128,54 @@ def verify_otp(request: VerifyOTPRequest):
     email = request.email.lower().strip()
     otp_code = request.otp_code.strip()
     
-    conn = get_db()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    # Check OTP validity and expiration in one query (compare with Vietnam time)
-    c.execute("""
-        SELECT code, expires_at,
-               CASE WHEN expires_at > (NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh') THEN TRUE ELSE FALSE END as is_valid
-        FROM otp_codes 
-        WHERE email = %s AND code = %s AND verified = FALSE
-        ORDER BY created_at DESC LIMIT 1
-    """, (email, otp_code))
-    
-    result = c.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Invalid OTP code")
-    
-    if not result['is_valid']:
-        conn.close()
-        raise HTTPException(status_code=400, detail="OTP expired")
+    try:
+        otp_service.verify(OTPPurpose.REGISTRATION, email, otp_code)
+    except OTPError as e:
+        raise otp_http_error(e, **_AUTH_OTP_ERRORS)
     
-    # Check if email already exists
-    c.execute("SELECT id, email FROM users WHERE email = %s", (email,))
-    existing_user = c.fetchone()
-    if existing_user:
-        conn.close()
-        raise HTTPException(status_code=400, detail=f"Email '{email}' is already registered. Please login instead.")
-    
-    # Check if username already exists (if provided)
-    if request.username:
-        username = request.username.lower().strip()
-        c.execute("SELECT id FROM users WHERE username = %s", (username,))
-        if c.fetchone():
-            conn.close()
-            raise HTTPException(status_code=400, detail="Username already taken")
-    
-    # Check if phone already exists
-    if request.phone:
-        c.execute("SELECT id FROM users WHERE phone = %s", (request.phone,))
-        if c.fetchone():
-            conn.close()
-            raise HTTPException(status_code=400, detail=f"Phone number '{request.phone}' is already registered with another account.")
-    
-    # Create new user with auto-increment ID
-    c.execute("SELECT MAX(CAST(id AS INTEGER)) FROM users WHERE id ~ '^[0-9]+$'")
-    result = c.fetchone()
-    max_id = result['max'] if result else None
-    user_id = str((max_id or 0) + 1)
-    
-    # Use provided password or generate random one
+    # Use provided password or generate random one (hashed before taking a DB connection)
     password_hash = hash_password(request.password) if request.password else hash_password(secrets.token_hex(16))
-    c.execute("""
-        INSERT INTO users (id, email, username, full_name, phone, password_hash)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (user_id, email, request.username.lower().strip() if request.username else None, request.full_name, request.phone, password_hash))
     
-    # Mark OTP as verified
-    c.execute("UPDATE otp_codes SET verified = TRUE WHERE email = %s AND code = %s", (email, otp_code))
+    username = request.username.lower().strip() if request.username else None
     
-    conn.commit()
-    conn.close()
+    # No pre-checks: the unique constraints decide, atomically, whether the
+    # email, username and phone are free (see _REGISTRATION_CONFLICTS)
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        for attempt in range(_ID_COLLISION_RETRIES):
+            # Next ID from this worker's block
+            user_id = next_user_id(c)
+            try:
+                c.execute("""
+                    INSERT INTO users (id, email, username, full_name, phone, password_hash)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING balance
+                """, (user_id, email, username, request.full_name, request.phone, password_hash))
+                break
+            except psycopg2.errors.UniqueViolation as e:
+                conn.rollback()
+                constraint = e.diag.constraint_name
+                # An ID taken outside the sequence (e.g. inserted by hand): take the next one
+                if constraint == "users_pkey" and attempt < _ID_COLLISION_RETRIES - 1:
+                    continue
+                status_code, detail = _REGISTRATION_CONFLICTS.get(constraint, (409, "Account already exists"))
+                raise HTTPException(status_code=status_code,
+                                    detail=detail.format(email=email, phone=request.phone))
+        
+        # Starting balance comes from the column default - record it in the ledger
+        signup_balance = c.fetchone()['balance']
+        if signup_balance:
+            post_wallet_entry(c, f"SIGNUP-{user_id}-{secrets.token_hex(4)}", user_id, signup_balance, SIGNUP_CREDIT_ACCOUNT, "signup_credit")
+        publish_identifiers(c, email=email, username=username, phone=request.phone)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    otp_service.consume(OTPPurpose.REGISTRATION, email)
+    remember_identifiers(email=email, username=username, phone=request.phone)
     
     return {
         "status": "success",
@@ -165,13 +183,40 @@ def verify_otp(request: VerifyOTPRequest):
         "user_id": user_id,
         "email": email,
         "name": request.full_name,
-        "username": request.username.lower().strip() if request.username else None,
-        "phone": request.phone
+        "username": username,
+        "phone": request.phone,
+        **issue_session(user_id)
     }
 
 
+def _rehash_password(user_id: str, password: str, old_hash: str):
+    """Upgrade a legacy or outdated hash now that the password is known"""
+    try:
+        new_hash = hash_password(password)
+    except HTTPException:
+        return  # Hashing pool busy: upgrade on a later login
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        # Skip if the password changed meanwhile
+        c.execute("UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                  (new_hash, user_id, old_hash))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️ Password rehash failed for user {user_id}: {e}")
+    finally:
+        conn.close()
+
+
+def _login_failed(http_request: Request, identifier: str):
+    """Count a failed attempt against the identifier (unknown ones too, so limits do not reveal accounts) and 401"""
+    check_rate_limit("login_failure", http_request, identifier=identifier)
+    raise HTTPException(status_code=401, detail="Invalid credentials")
+
+
 @router.post("/login", summary="Login with Email or Username", response_model=UserResponse)
-def login(request: LoginRequest):
+def login(request: LoginRequest, http_request: Request):
     """
     Login with email or username and password.
     
@@ -186,25 +231,38 @@ def login(request: LoginRequest):
     if not identifier:
         raise HTTPException(status_code=400, detail="Email or username is required")
     
+    check_rate_limit("login", http_request)
+    # Refuse an identifier that used up its failed attempts (only failures count, below)
+    check_rate_limit("login_failure", http_request, count=False, identifier=identifier)
+    
     password = request.password.strip()
     
+    # Unknown identifiers (most of a credential-stuffing list) never reach the DB, but
+    # still pay for a password check so they answer as slowly as a wrong password
+    if availability.is_unknown_login(identifier):
+        verify_dummy(password)
+        _login_failed(http_request, identifier)
+    
+    looked_up_at = availability.version()
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Check if identifier is email or username
-    c.execute("""
-        SELECT id, full_name, password_hash, email, username, phone 
-        FROM users 
-        WHERE email = %s OR username = %s
-    """, (identifier, identifier))
+    # Only usernames lack an @, so most logins are a single index probe
+    query = _LOGIN_BY_EMAIL_OR_USERNAME if "@" in identifier else _LOGIN_BY_USERNAME
+    c.execute(query, {"identifier": identifier})
     result = c.fetchone()
     conn.close()
     
     if not result:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+        availability.remember_unknown_login(identifier, looked_up_at)
+        verify_dummy(password)
+        _login_failed(http_request, identifier)
     
     if not verify_password(password, result['password_hash']):
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+        _login_failed(http_request, identifier)
+    
+    if needs_rehash(result['password_hash']):
+        _rehash_password(result['id'], password, result['password_hash'])
     
     return {
         "status": "success",
@@ -212,28 +270,26 @@ def login(request: LoginRequest):
         "email": result['email'],
         "name": result['full_name'],
         "username": result['username'],
-        "phone": result['phone']
+        "phone": result['phone'],
+        **issue_session(result['id'])
     }
 
 
 @router.get("/me", summary="Get Current User Info", response_model=UserDetailResponse)
-def get_current_user(user_id: str):
+def get_current_user(user_id: str = None, session_user_id: str = Depends(check_session)):
     """
     Get current user's detailed information.
     
-    - **user_id**: User ID (query parameter, required)
+    - **user_id**: User ID (query parameter; optional with a session token)
     
     Returns detailed user info including balance, phone, and username.
     """
+    user_id = session_user_id or user_id
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    conn = get_db()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    c.execute("SELECT id, email, full_name, phone, balance, username FROM users WHERE id = %s", (user_id,))
-    result = c.fetchone()
-    conn.close()
+    # Polled on most pages: served from the per-user cache
+    result = get_profile(user_id)
     
     if not result:
         raise HTTPException(status_code=404, detail="User not found")
@@ -248,8 +304,28 @@ def get_current_user(user_id: str):
     }
 
 
+@router.get("/availability", summary="Check Email/Username/Phone Availability", response_model=AvailabilityResponse)
+def check_availability(http_request: Request, email: str = None, username: str = None, phone: str = None):
+    """
+    Check as-you-type whether an email, username or phone number is still free.
+    
+    - **email**: Email to check (optional)
+    - **username**: Username to check (optional)
+    - **phone**: Phone number to check (optional)
+    
+    Returns true (available) or false (taken) for each field given. Advisory
+    only: registration and profile changes still enforce uniqueness.
+    """
+    values = {field: value for field, value in (("email", email), ("username", username), ("phone", phone))
+              if value and value.strip()}
+    if not values:
+        raise HTTPException(status_code=400, detail="Provide email, username or phone")
+    check_rate_limit("availability", http_request)
+    return check_identifiers(values)
+
+
 @router.post("/send-reset-otp", summary="Send OTP for Password Reset", response_model=OTPSentResponse)
-def send_reset_otp(request: OTPRequest, background_tasks: BackgroundTasks):
+def send_reset_otp(request: OTPRequest, http_request: Request):
     """
     Send OTP code to email for password reset.
     
@@ -258,32 +334,23 @@ def send_reset_otp(request: OTPRequest, background_tasks: BackgroundTasks):
     Returns OTP sent confirmation.
     """
     email = request.email.lower().strip()
+    check_rate_limit("send_reset_otp", http_request, email=email)
     
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
     # Check if user exists
-    c.execute("SELECT id FROM users WHERE email = %s", (email,))
+    c.execute("SELECT id FROM users WHERE lower(email) = %s", (email,))
     user = c.fetchone()
     
     if not user:
         conn.close()
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Generate OTP
-    otp = generate_otp()
-    # Save expires_at as naive datetime in Vietnam timezone
-    expires_at = (get_vietnam_time() + timedelta(minutes=10)).replace(tzinfo=None)
-    
-    # Save OTP
-    c.execute("""
-        INSERT INTO otp_codes (email, code, expires_at)
-        VALUES (%s, %s, %s)
-    """, (email, otp, expires_at))
-    
-    conn.commit()
     conn.close()
     
+    otp = otp_service.issue(OTPPurpose.PASSWORD_RESET, email)
+    
     # Email HTML
     html_body = f"""
     <html>
@@ -295,7 +362,8 @@ def send_reset_otp(request: OTPRequest, background_tasks: BackgroundTasks):
     </html>
     """
     
-    background_tasks.add_task(send_email, email, "Password Reset OTP", html_body)
+    outbox.submit("email", {"to_email": email, "subject": "Password Reset OTP", "html_body": html_body},
+                  expires_in_seconds=otp_service.OTP_TTL_SECONDS)
     
     return {"status": "success", "message": "OTP sent to email", "email": email}
 
@@ -314,36 +382,40 @@ def reset_password(request: ResetPasswordRequest):
     email = request.email.lower().strip()
     otp_code = request.otp_code.strip()
     
-    conn = get_db()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    # Verify OTP and check expiration in one query (compare with Vietnam time)
-    c.execute("""
-        SELECT code, expires_at, 
-               CASE WHEN expires_at > (NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh') THEN TRUE ELSE FALSE END as is_valid
-        FROM otp_codes 
-        WHERE email = %s AND code = %s AND verified = FALSE
-        ORDER BY created_at DESC LIMIT 1
-    """, (email, otp_code))
-    
-    result = c.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Invalid OTP code")
-    
-    if not result['is_valid']:
-        conn.close()
-        raise HTTPException(status_code=400, detail="OTP expired")
+    try:
+        otp_service.verify(OTPPurpose.PASSWORD_RESET, email, otp_code)
+    except OTPError as e:
+        raise otp_http_error(e, **_AUTH_OTP_ERRORS)
     
-    # Update password
+    # Hash before taking a DB connection
     new_hash = hash_password(request.new_password)
-    c.execute("UPDATE users SET password_hash = %s WHERE email = %s", (new_hash, email))
     
-    # Mark OTP as verified
-    c.execute("UPDATE otp_codes SET verified = TRUE WHERE email = %s AND code = %s", (email, otp_code))
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    
+    # Update password and log out every existing session
+    c.execute("UPDATE users SET password_hash = %s WHERE lower(email) = %s RETURNING id", (new_hash, email))
+    row = c.fetchone()
+    revoked_at = revoke_user_sessions(c, row['id']) if row else None
     
     conn.commit()
     conn.close()
+    otp_service.consume(OTPPurpose.PASSWORD_RESET, email)
+    if row:
+        apply_user_revocation(row['id'], revoked_at)
     
     return {"status": "success", "message": "Password reset successfully"}
+
+
+@router.post("/logout", summary="Log Out (Revoke Session Token)", response_model=StatusResponse)
+def logout(authorization: str = Header(default="")):
+    """
+    Revoke the session token sent in the Authorization header.
+    
+    Returns success status; the token is rejected from then on.
+    """
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    revoke_session(token.strip())
+    return {"status": "success", "message": "Logged out"}
@@ -1,14 +1,15 @@
 """
 Cart routes: Add items, view cart, clear cart, remove items
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from models.schemas import AddToCartRequest
 from models.responses import StatusResponse, CartResponse
 from database import get_db
+from utils.sessions import check_session
 import json
 import psycopg2.extras
 
-router = APIRouter(prefix="/api/cart", tags=["8️⃣ Cart (Optional)"])
+router = APIRouter(prefix="/api/cart", tags=["8️⃣ Cart (Optional)"], dependencies=[Depends(check_session)])
 
 
 @router.post("/add", summary="Add Item to Cart", response_model=StatusResponse)
@@ -153,7 +154,7 @@ def remove_from_cart(product_id: str, user_id: str):
         raise HTTPException(status_code=404, detail="Item not found in cart")
     
     if items:
-        c.execute("UPDATE cart SET items = %s WHERE user_id = %s", (json.dumps(items), user_id))
+        c.execute("UPDATE cart SET items = %s, updated_at = CURRENT_TIMESTAMP WHERE user_id = %s", (json.dumps(items), user_id))
     else:
         c.execute("DELETE FROM cart WHERE user_id = %s", (user_id,))
     
@@ -1,13 +1,14 @@
 """
 Favorites routes: Add, remove, and list favorite products
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from models.schemas import FavoriteRequest
 from models.responses import StatusResponse, FavoritesResponse
 from database import get_db
+from utils.sessions import check_session
 import psycopg2.extras
 
-router = APIRouter(prefix="/api/favorites", tags=["7️⃣ Favorites"])
+router = APIRouter(prefix="/api/favorites", tags=["7️⃣ Favorites"], dependencies=[Depends(check_session)])
 
 
 @router.post("/add", summary="Add Product to Favorites", response_model=StatusResponse)
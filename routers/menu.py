@@ -9,6 +9,8 @@ from utils.menu_data import (
     get_milk_options, has_sugar_option, has_size_option,
     SIZE_OPTIONS, COFFEE_UPSELLS, TEA_UPSELLS, FOOD_TOPPINGS, MILK_OPTIONS
 )
+from utils.trending import get_trending
+from typing import Optional
 
 router = APIRouter(prefix="/api/menu", tags=["2️⃣ Menu"])
 
@@ -36,6 +38,21 @@ def search_menu(q: str):
     return {"items": results, "count": len(results)}
 
 
+@router.get("/trending", summary="Get Trending Menu Items")
+def get_trending_menu(category: Optional[str] = None, limit: int = 10):
+    """
+    Get the products ordered most recently and most often ("Trending now").
+    
+    - **category**: Only return products in this category (optional)
+      - Options: `coffee`, `tea`, `juice`, `food`
+    - **limit**: Maximum number of items (default: 10, max: 20)
+    
+    Scores are order counts that decay exponentially over time (24h half-life),
+    kept in memory - no database query per request.
+    """
+    return {"items": get_trending(category, limit)}
+
+
 @router.get("/{category}", summary="Get Menu Items by Category", response_model=MenuResponse)
 def get_menu_by_category(category: str):
     """
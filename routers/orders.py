@@ -1,19 +1,33 @@
 """
 Orders routes: Create orders, view history, cancel, mark received
 """
-from fastapi import APIRouter, HTTPException
-from models.schemas import CheckoutRequest, PromoCodeRequest, OrderActionRequest
+from fastapi import APIRouter, HTTPException, Depends
+from models.schemas import CheckoutRequest, PromoCodeRequest, OrderActionRequest, BulkOrderRequest, ReorderRequest
 from models.responses import PromoValidationResponse, CheckoutResponse, OrderHistoryResponse, StatusResponse
 from database import get_db
 from utils.timezone import get_vietnam_time
-from utils.email_service import send_refund_email
-from utils.menu_data import MENU_PRODUCTS
+from utils import outbox
+from utils.menu_data import MENU_PRODUCTS, get_product_by_id, price_item
+from utils.sales_rollups import record_order_sale
+from utils.user_cache import publish_user_change, set_balance
+from utils.recommendations import record_received_order, recommend_for_cart
+from utils.trending import record_checkout, record_delivery
+from utils.ledger import post_wallet_entry, SALES_ACCOUNT
+from utils.sessions import check_session
 import json
 import uuid
+from collections import OrderedDict
 from datetime import datetime
+from typing import Optional
 import psycopg2.extras
 
-router = APIRouter(prefix="/api", tags=["3️⃣ Checkout & Promo", "5️⃣ Orders & History"])
+router = APIRouter(prefix="/api", tags=["3️⃣ Checkout & Promo", "5️⃣ Orders & History"], dependencies=[Depends(check_session)])
+
+# Shipping fee - fixed at 30,000 VND per delivery
+SHIPPING_FEE = 30000
+
+# Upper bound for one bulk submission
+BULK_ORDER_MAX_LINES = 2000
 
 
 @router.post("/promo/validate", summary="Validate Promo Code", response_model=PromoValidationResponse)
@@ -93,8 +107,7 @@ def checkout(request: CheckoutRequest):
         # price already includes size modifier and milk extras
         total += price * quantity
     
-    # Shipping fee - fixed at 30,000 VND
-    shipping_fee = 30000
+    shipping_fee = SHIPPING_FEE
     
     discount = 0
     promo_code = request.promo_code.upper().strip() if request.promo_code else None
@@ -199,6 +212,8 @@ def checkout(request: CheckoutRequest):
     conn.commit()
     conn.close()
     
+    record_checkout(request.items)
+    
     return {
         "status": "success",
         "order_id": order_id,
@@ -209,15 +224,369 @@ def checkout(request: CheckoutRequest):
     }
 
 
+def _reserve_promo(c, promo_code: Optional[str], uses: int, now) -> float:
+    """
+    Validate and reserve promo uses in one conditional UPDATE.
+    Returns the discount percent, or 0 if the code is missing, expired or used up.
+    """
+    if not promo_code:
+        return 0
+    c.execute("""
+        UPDATE promo_codes SET used_count = used_count + %s
+        WHERE code = %s
+          AND (max_uses IS NULL OR used_count + %s <= max_uses)
+          AND (expires_at IS NULL OR expires_at > %s)
+        RETURNING discount_percent
+    """, (uses, promo_code, uses, now.replace(tzinfo=None)))
+    promo = c.fetchone()
+    return float(promo['discount_percent']) if promo else 0
+
+
+@router.post("/orders/bulk", summary="Create Bulk/Corporate Orders")
+def bulk_checkout(request: BulkOrderRequest):
+    """
+    Create one large order (or one order per recipient) from many lines in a single request.
+    
+    - **user_id**: User ID (required)
+    - **lines**: Order lines with product_id, quantity, size, milk, upsells, toppings and optional recipient (required)
+    - **split_by_recipient**: Create one order per recipient instead of one order (default: false)
+    - **allow_partial**: Create valid lines and report invalid ones instead of rejecting the request (default: false)
+    - **customer_name** / **customer_phone** / **customer_email**: Contact for the delivery (required)
+    - **payment_method**: Payment method (`balance` or `cod`, required)
+    - **delivery_district** / **delivery_ward** / **delivery_street**: Delivery address (optional)
+    - **promo_code**: Promo code applied to every order (optional)
+    
+    Lines are priced server-side from menu data and all orders are inserted in one
+    multi-row statement inside a single transaction. Returns per-line results.
+    """
+    if not request.lines:
+        raise HTTPException(status_code=400, detail="No order lines")
+    if len(request.lines) > BULK_ORDER_MAX_LINES:
+        raise HTTPException(status_code=400, detail=f"Too many lines (max {BULK_ORDER_MAX_LINES})")
+    
+    # Validate and price every line in one pass
+    results = []
+    valid_lines = []
+    for index, line in enumerate(request.lines):
+        try:
+            if line.quantity < 1:
+                raise ValueError("Quantity must be at least 1")
+            unit_price = price_item(line.product_id, line.size, line.milk, line.upsells, line.toppings)
+        except ValueError as e:
+            results.append({"line": index, "status": "error", "product_id": line.product_id, "error": str(e)})
+            continue
+        
+        # Same item shape as the cart checkout, so history/received/reorder understand it
+        item = {
+            "product_id": line.product_id,
+            "product_name": get_product_by_id(line.product_id)["name"],
+            "quantity": line.quantity,
+            "size": line.size or "M",
+            "sugar": line.sugar,
+            "temperature": line.temperature,
+            "milk": line.milk,
+            "upsells": line.upsells or [],
+            "toppings": line.toppings or [],
+            "price": unit_price
+        }
+        if line.recipient_name:
+            item["recipient_name"] = line.recipient_name
+        if line.recipient_phone:
+            item["recipient_phone"] = line.recipient_phone
+        if line.note:
+            item["note"] = line.note
+        
+        result = {
+            "line": index,
+            "status": "ok",
+            "product_id": line.product_id,
+            "unit_price": unit_price,
+            "line_total": unit_price * line.quantity
+        }
+        results.append(result)
+        valid_lines.append((line, item, result))
+    
+    invalid_count = len(results) - len(valid_lines)
+    if not valid_lines or (invalid_count and not request.allow_partial):
+        raise HTTPException(status_code=400, detail={
+            "message": f"{invalid_count} invalid line(s)",
+            "results": results
+        })
+    
+    # Group lines into orders: one order, or one per recipient
+    groups = OrderedDict()
+    for line, item, result in valid_lines:
+        if request.split_by_recipient:
+            key = (line.recipient_name or request.customer_name, line.recipient_phone or request.customer_phone)
+        else:
+            key = (request.customer_name, request.customer_phone)
+        groups.setdefault(key, []).append((item, result))
+    
+    promo_code = request.promo_code.upper().strip() if request.promo_code else None
+    delivery_district = (request.delivery_district or "").strip() or None
+    delivery_ward = (request.delivery_ward or "").strip() or None
+    delivery_street = (request.delivery_street or "").strip() or None
+    now = get_vietnam_time()
+    created_at = now.isoformat()
+    
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        # One promo use per order created
+        discount_percent = _reserve_promo(c, promo_code, len(groups), now)
+        
+        order_rows = []
+        orders = []
+        for index, ((customer_name, customer_phone), entries) in enumerate(groups.items()):
+            order_id = str(uuid.uuid4())[:8].upper()
+            items = [item for item, _ in entries]
+            subtotal = sum(item["price"] * item["quantity"] for item in items)
+            discount = subtotal * (discount_percent / 100)
+            # All orders go out in one delivery - charge shipping once
+            shipping_fee = SHIPPING_FEE if index == 0 else 0
+            total = subtotal - discount + shipping_fee
+            
+            order_rows.append((
+                order_id,
+                request.user_id,
+                json.dumps(items),
+                total,
+                request.special_notes,
+                promo_code if discount_percent else None,
+                discount,
+                shipping_fee,
+                request.payment_method,
+                customer_name,
+                customer_phone,
+                delivery_district,
+                delivery_ward,
+                delivery_street,
+                "pending_payment",
+                created_at
+            ))
+            for _, result in entries:
+                result["order_id"] = order_id
+            orders.append({
+                "order_id": order_id,
+                "customer_name": customer_name,
+                "customer_phone": customer_phone,
+                "line_count": len(items),
+                "total": total,
+                "discount": discount,
+                "shipping_fee": shipping_fee
+            })
+        
+        grand_total = sum(order["total"] for order in orders)
+        
+        if request.payment_method == "balance":
+            c.execute("SELECT balance FROM users WHERE id = %s", (request.user_id,))
+            user = c.fetchone()
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            if user['balance'] < grand_total:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Insufficient balance. You need {grand_total:,.0f}đ but only have {user['balance']:,.0f}đ"
+                )
+        
+        # One multi-row INSERT for every order
+        psycopg2.extras.execute_values(c, """
+            INSERT INTO orders
+            (id, user_id, items, total, special_notes, promo_code, discount, shipping_fee, payment_method, customer_name, customer_phone, delivery_district, delivery_ward, delivery_street, status, created_at)
+            VALUES %s
+        """, order_rows, page_size=len(order_rows))
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    record_checkout([item for _, item, _ in valid_lines])
+    
+    return {
+        "status": "success",
+        "message": f"{len(orders)} order(s) created. Please confirm payment with OTP." if request.payment_method == "balance"
+                   else f"{len(orders)} order(s) created.",
+        "orders": orders,
+        "grand_total": grand_total,
+        "created_lines": len(valid_lines),
+        "invalid_lines": invalid_count,
+        "results": results
+    }
+
+
+def _reprice_item(source: dict, quantity: int) -> dict:
+    """Rebuild a stored order/frequent item against current menu data (ValueError if no longer valid)"""
+    product_id = source.get('product_id')
+    milk = source.get('milk')
+    # Old orders stored milks as an array
+    if not milk and source.get('milks'):
+        milk = source['milks'][0]
+    size = source.get('size') or "M"
+    upsells = source.get('upsells') or []
+    toppings = source.get('toppings') or []
+    
+    unit_price = price_item(product_id, size, milk, upsells, toppings)
+    return {
+        "product_id": product_id,
+        "product_name": get_product_by_id(product_id)["name"],
+        "quantity": quantity,
+        "size": size,
+        "sugar": source.get('sugar'),
+        "temperature": source.get('temperature'),
+        "milk": milk,
+        "upsells": upsells,
+        "toppings": toppings,
+        "price": unit_price
+    }
+
+
+@router.post("/orders/reorder", summary="Reorder from a Previous Order or Frequent Items")
+def reorder(request: ReorderRequest):
+    """
+    Create a new order from a previous order or from frequent items in one call.
+    
+    - **user_id**: User ID (required)
+    - **order_id**: Previous order to repeat (either this or frequent_item_ids)
+    - **frequent_item_ids**: IDs from `/api/frequent-items`, one of each (either this or order_id)
+    - **payment_method**: Payment method (`balance` or `cod`, required)
+    - **customer_name** / **customer_phone**: Contact (optional - defaults to the previous order, then the profile)
+    - **delivery_district** / **delivery_ward** / **delivery_street**: Address (optional - defaults to the previous order)
+    - **special_notes** / **promo_code**: As in checkout (optional)
+    
+    Items are re-priced server-side against the current menu; items that are no
+    longer available are skipped and listed in `skipped_items`. The order is
+    created in a single transaction and the response matches `/api/checkout`.
+    """
+    now = get_vietnam_time()
+    promo_code = request.promo_code.upper().strip() if request.promo_code else None
+    
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        c.execute("SELECT full_name, email, phone, balance FROM users WHERE id = %s", (request.user_id,))
+        user = c.fetchone()
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        # Collect (source item, quantity) pairs and contact/address defaults
+        sources = []
+        defaults = {}
+        if request.order_id:
+            c.execute("""
+                SELECT user_id, items, customer_name, customer_phone,
+                       delivery_district, delivery_ward, delivery_street
+                FROM orders WHERE id = %s
+            """, (request.order_id,))
+            previous = c.fetchone()
+            if not previous:
+                raise HTTPException(status_code=404, detail="Order not found")
+            if previous['user_id'] != request.user_id:
+                raise HTTPException(status_code=403, detail="Not authorized")
+            items = json.loads(previous['items']) if isinstance(previous['items'], str) else previous['items']
+            for item in items or []:
+                sources.append((item, item.get('quantity', 1)))
+            defaults = previous
+        else:
+            c.execute("""
+                SELECT id, product_id, customization FROM frequent_items
+                WHERE user_id = %s AND id = ANY(%s)
+            """, (request.user_id, request.frequent_item_ids))
+            for row in c.fetchall():
+                customization = json.loads(row['customization']) if row['customization'] else {}
+                sources.append(({**customization, "product_id": row['product_id']}, 1))
+        
+        items = []
+        skipped = []
+        for source, quantity in sources:
+            try:
+                quantity = int(quantity or 1)
+                if quantity < 1:
+                    raise ValueError("Invalid quantity")
+                items.append(_reprice_item(source, quantity))
+            except (ValueError, TypeError) as e:
+                skipped.append({"product_id": source.get('product_id'), "error": str(e)})
+        
+        if not items:
+            raise HTTPException(status_code=400, detail={
+                "message": "No items available to reorder",
+                "skipped_items": skipped
+            })
+        
+        subtotal = sum(item["price"] * item["quantity"] for item in items)
+        discount_percent = _reserve_promo(c, promo_code, 1, now)
+        discount = subtotal * (discount_percent / 100)
+        shipping_fee = SHIPPING_FEE
+        final_total = subtotal - discount + shipping_fee
+        
+        if request.payment_method == "balance" and user['balance'] < final_total:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient balance. You need {final_total:,.0f}đ but only have {user['balance']:,.0f}đ"
+            )
+        
+        def pick(value, field, fallback=None):
+            value = (value or "").strip()
+            return value or defaults.get(field) or fallback
+        
+        order_id = str(uuid.uuid4())[:8].upper()
+        c.execute("""
+            INSERT INTO orders
+            (id, user_id, items, total, special_notes, promo_code, discount, shipping_fee, payment_method, customer_name, customer_phone, delivery_district, delivery_ward, delivery_street, status, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            order_id,
+            request.user_id,
+            json.dumps(items),
+            final_total,
+            request.special_notes,
+            promo_code if discount_percent else None,
+            discount,
+            shipping_fee,
+            request.payment_method,
+            pick(request.customer_name, 'customer_name', user['full_name']),
+            pick(request.customer_phone, 'customer_phone', user['phone']),
+            pick(request.delivery_district, 'delivery_district'),
+            pick(request.delivery_ward, 'delivery_ward'),
+            pick(request.delivery_street, 'delivery_street'),
+            "pending_payment",
+            now.isoformat()
+        ))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    record_checkout(items)
+    
+    return {
+        "status": "success",
+        "order_id": order_id,
+        "total": final_total,
+        "discount": discount,
+        "shipping_fee": shipping_fee,
+        "items": items,
+        "skipped_items": skipped,
+        "message": "Order created. Please confirm payment with OTP."
+    }
+
+
 @router.get("/orders", summary="Get User's Order History")
-def get_orders(user_id: str):
+def get_orders(user_id: str = None, session_user_id: str = Depends(check_session)):
     """
     Get all orders for a user.
     
-    - **user_id**: User ID (query parameter, required)
+    - **user_id**: User ID (query parameter; optional with a session token)
     
     Returns array of user's orders sorted by creation date (newest first).
     """
+    user_id = session_user_id or user_id
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
@@ -307,6 +676,24 @@ def get_frequent_items(user_id: str, limit: int = 5):
     return {"items": items}
 
 
+@router.get("/frequent-items/together", summary="Get Products Frequently Bought Together")
+def get_bought_together(product_ids: str, limit: int = 3):
+    """
+    Suggest products that are often ordered together with the items in the cart.
+
+    - **product_ids**: Comma-separated product IDs in the cart, e.g. `cf_1,t_2` (query parameter, required)
+    - **limit**: Maximum number of suggestions (default: 3, max: 10)
+
+    Suggestions come from an in-memory co-occurrence matrix of received orders,
+    ranked by how likely each product is to be bought with the cart.
+    Products already in the cart are never suggested.
+    """
+    cart = [pid.strip() for pid in product_ids.split(",") if pid.strip()]
+    if not cart:
+        raise HTTPException(status_code=400, detail="product_ids is required")
+    return {"items": recommend_for_cart(cart, limit)}
+
+
 @router.post("/orders/{order_id}/cancel", summary="Cancel Order and Refund")
 def cancel_order(order_id: str, request: OrderActionRequest):
     """
@@ -326,12 +713,14 @@ def cancel_order(order_id: str, request: OrderActionRequest):
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Get order details and user info
+    # Get order details and user info. The row lock makes a concurrent cancel (another
+    # request or the mass-cancel job) finish first, so the status checked below is final.
     c.execute("""
         SELECT o.user_id, o.total, o.status, o.payment_method, u.email, u.full_name 
         FROM orders o
         JOIN users u ON o.user_id = u.id
         WHERE o.id = %s
+        FOR UPDATE OF o
     """, (order_id,))
     order = c.fetchone()
     
@@ -363,13 +752,10 @@ def cancel_order(order_id: str, request: OrderActionRequest):
         needs_refund = True
         refund_amount = total
         
-        # Get current balance
-        c.execute("SELECT balance FROM users WHERE id = %s", (user_id,))
-        result = c.fetchone()
-        current_balance = result['balance'] if result else 0
-        new_balance = current_balance + refund_amount
-        
-        c.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (refund_amount, user_id))
+        # Credit and read back in one statement so the history row matches the balance
+        c.execute("UPDATE users SET balance = balance + %s WHERE id = %s RETURNING balance", (refund_amount, user_id))
+        new_balance = c.fetchone()['balance']
+        current_balance = new_balance - refund_amount
         
         # Record transaction
         import uuid
@@ -392,6 +778,13 @@ def cancel_order(order_id: str, request: OrderActionRequest):
             f"Refund for cancelled Order #{order_id}",
             transaction_time
         ))
+        post_wallet_entry(c, transaction_id, user_id, refund_amount, SALES_ACCOUNT, "refund", order_id, transaction_time)
+        # Refunded order no longer counts as a sale
+        record_order_sale(c, order_id, sign=-1)
+        publish_user_change(c, user_id)
+        # Refund notice is sent by the outbox dispatcher once this commits
+        outbox.enqueue(c, "refund_email", {"recipient_email": user_email, "recipient_name": user_name,
+                                           "order_id": order_id, "refund_amount": float(refund_amount)})
     
     # COD orders or unpaid balance orders - no refund needed
     # Just cancel the order
@@ -401,18 +794,8 @@ def cancel_order(order_id: str, request: OrderActionRequest):
     
     conn.commit()
     conn.close()
-    
-    # Send refund email notification only if refund was processed
     if needs_refund:
-        try:
-            send_refund_email(
-                recipient_email=user_email,
-                recipient_name=user_name,
-                order_id=order_id,
-                refund_amount=refund_amount
-            )
-        except Exception as e:
-            print(f"⚠️ Email sending failed but refund was successful: {str(e)}")
+        set_balance(user_id, new_balance)
     
     message = "Order cancelled and refunded" if needs_refund else "Order cancelled"
     
@@ -474,6 +857,10 @@ def mark_order_received(order_id: str, request: OrderActionRequest):
             (current_time, order_id)
         )
     
+    # Unpaid orders become a sale on delivery; paid ones were counted at payment
+    if order['status'] == 'pending_payment':
+        record_order_sale(c, order_id)
+    
     # Save items to frequent_items table with their customization options
     try:
         items = json.loads(order['items']) if isinstance(order['items'], str) else order['items']
@@ -548,6 +935,12 @@ def mark_order_received(order_id: str, request: OrderActionRequest):
     conn.commit()
     conn.close()
     
+    # Count each order once in the bought-together matrix
+    if order['status'] not in ('delivered', 'completed'):
+        items = json.loads(order['items']) if isinstance(order['items'], str) else order['items']
+        record_received_order(items)
+        record_delivery(items)
+    
     return {
         "status": "success",
         "message": "Order marked as completed"
@@ -1,21 +1,52 @@
 """
 Payment OTP routes: Request and verify payment OTP
 """
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Request, Depends
 from models.schemas import PaymentOTPRequest, VerifyPaymentOTPRequest
 from models.responses import PaymentOTPResponse, PaymentVerificationResponse
 from database import get_db
-from utils.security import generate_otp, send_email
-from utils.email_service import send_simple_email
+from utils import otp as otp_service
+from utils import outbox
+from utils.otp import OTPPurpose, OTPError, otp_http_error
 from utils.timezone import get_vietnam_time
-from datetime import timedelta
+from utils.sales_rollups import record_order_sale
+from utils.user_cache import publish_user_change, set_balance
+from utils.rate_limit import check_rate_limit
+from utils.ledger import post_wallet_entry, SALES_ACCOUNT
+from utils.sessions import check_session
 import psycopg2.extras
 
-router = APIRouter(prefix="/api/payment", tags=["4️⃣ Payment"])
+router = APIRouter(prefix="/api/payment", tags=["4️⃣ Payment"], dependencies=[Depends(check_session)])
+
+
+def _payment_receipt(user_email: str, order_id: str, order_total, new_balance):
+    """(outbox kind, payload) of the payment success email"""
+    try:
+        html_body = f"""
+        <html>
+            <body style="font-family: Arial, sans-serif; background-color: #f5f5f5; padding: 20px;">
+                <div style="max-width: 520px; margin: 0 auto; background-color: white; padding: 24px; border-radius: 10px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
+                    <h2 style="color: #2e7d32; text-align: center;">✅ Payment Successful</h2>
+                    <p style="color: #333;">Your payment for order <strong>#{order_id}</strong> has been completed.</p>
+                    <div style="background-color: #f9f9f9; padding: 12px; border-radius: 6px; margin: 16px 0;">
+                        <p style="margin: 6px 0; color: #666;"><strong>Order ID:</strong> {order_id}</p>
+                        <p style="margin: 6px 0; color: #666;"><strong>Amount Paid:</strong> ₫{order_total:,.0f}</p>
+                        <p style="margin: 6px 0; color: #666;"><strong>New Balance:</strong> ₫{new_balance:,.0f}</p>
+                    </div>
+                    <p style="color: #999; font-size: 12px; text-align: center;">Thank you for your purchase!</p>
+                </div>
+            </body>
+        </html>
+        """
+        return "email", {"to_email": user_email, "subject": "✅ Payment Successful", "html_body": html_body}
+    except Exception:
+        # Fallback to plain text
+        return "simple_email", {"recipient_email": user_email, "subject": "Payment Successful",
+                                "body": f"Order #{order_id} paid. Amount: {order_total}. New balance: {new_balance}."}
 
 
 @router.post("/send-otp", summary="Send Payment OTP")
-def send_payment_otp(request: PaymentOTPRequest, background_tasks: BackgroundTasks):
+def send_payment_otp(request: PaymentOTPRequest, http_request: Request):
     """
     Generate and send OTP for payment confirmation.
     
@@ -27,6 +58,7 @@ def send_payment_otp(request: PaymentOTPRequest, background_tasks: BackgroundTas
     """
     order_id = request.order_id
     user_id = request.user_id
+    check_rate_limit("send_payment_otp", http_request, user=user_id)
     
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
@@ -63,22 +95,11 @@ def send_payment_otp(request: PaymentOTPRequest, background_tasks: BackgroundTas
         conn.close()
         raise HTTPException(status_code=400, detail=f"Insufficient balance. Need {order_total}, have {user_balance}")
     
-    # Generate OTP
-    otp_code = generate_otp()
-    created_at = get_vietnam_time()
-    # Save expires_at as naive datetime in Vietnam timezone
-    expires_at = (created_at + timedelta(minutes=10)).replace(tzinfo=None)
-    created_at = created_at.replace(tzinfo=None)
-    
-    # Store OTP
-    c.execute("""
-        INSERT INTO payment_otp (order_id, user_id, code, amount, created_at, expires_at)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (order_id, user_id, otp_code, order_total, created_at.isoformat(), expires_at.isoformat()))
-    
-    conn.commit()
     conn.close()
     
+    # Generate OTP (held by the OTP service, not the database)
+    otp_code = otp_service.issue(OTPPurpose.PAYMENT, f"{user_id}:{order_id}", {"amount": float(order_total)})
+    
     # Prepare email HTML
     html_body = f"""
     <html>
@@ -101,15 +122,12 @@ def send_payment_otp(request: PaymentOTPRequest, background_tasks: BackgroundTas
     </html>
     """
     
-    # Send email in background (non-blocking)
-    background_tasks.add_task(
-        send_email,
-        user_email,
-        "🔐 Payment OTP - Confirm Your Order",
-        html_body
-    )
+    # Sent by the outbox dispatcher; dropped if still unsent when the code expires
+    outbox.submit("email", {"to_email": user_email, "subject": "🔐 Payment OTP - Confirm Your Order",
+                            "html_body": html_body},
+                  expires_in_seconds=otp_service.OTP_TTL_SECONDS)
     
-    print(f"✉️  Payment OTP queued for {user_email}: {otp_code}")
+    print(f"✉️  Payment OTP queued for {user_email}")
     
     return {
         "status": "success",
@@ -120,7 +138,8 @@ def send_payment_otp(request: PaymentOTPRequest, background_tasks: BackgroundTas
 
 
 @router.post("/verify-otp", summary="Verify Payment OTP and Complete Payment")
-def verify_payment_otp(request: VerifyPaymentOTPRequest, background_tasks: BackgroundTasks):
+def verify_payment_otp(request: VerifyPaymentOTPRequest, http_request: Request,
+                       session_user_id: str = Depends(check_session)):
     """
     Verify OTP code and process payment from user balance.
     
@@ -133,138 +152,91 @@ def verify_payment_otp(request: VerifyPaymentOTPRequest, background_tasks: Backg
     order_id = request.order_id
     user_id = request.user_id
     otp = request.otp_code
+    check_rate_limit("verify_payment_otp", http_request, user=user_id)
+    
+    otp_subject = f"{user_id}:{order_id}"
+    try:
+        otp_service.verify(OTPPurpose.PAYMENT, otp_subject, otp)
+    except OTPError as e:
+        raise otp_http_error(e, not_found=(404, "No OTP found for this order"))
     
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Check OTP
-    c.execute("""
-        SELECT code, expires_at, verified
-        FROM payment_otp
-        WHERE order_id = %s AND user_id = %s
-        ORDER BY created_at DESC LIMIT 1
-    """, (order_id, user_id))
-    
-    result = c.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="No OTP found for this order")
-    
-    stored_otp = result['code']
-    expires_at = result['expires_at']
-    verified = result['verified']
-    
-    if verified:
-        conn.close()
-        raise HTTPException(status_code=400, detail="OTP already used")
-    
-    # Check expiration using naive datetime comparison
-    from datetime import datetime
-    current_time = get_vietnam_time().replace(tzinfo=None)
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if current_time > expires_at:
-        conn.close()
-        raise HTTPException(status_code=400, detail="OTP expired")
-    
-    if otp != stored_otp:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Invalid OTP")
-    
-    # Get order total
-    c.execute("SELECT total, status FROM orders WHERE id = %s", (order_id,))
-    order = c.fetchone()
-    
-    if not order:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    order_total = order['total']
-    order_status = order['status']
-    
-    if order_status != "pending_payment":
-        conn.close()
-        raise HTTPException(status_code=400, detail="Order is not pending payment")
-    
-    # Deduct from user balance
-    c.execute("SELECT email, balance FROM users WHERE id = %s", (user_id,))
-    user = c.fetchone()
-    
-    if not user:
-        conn.close()
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_email = user['email']
-    user_balance = user['balance']
-    
-    if user_balance < order_total:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    
-    # Process payment
-    new_balance = user_balance - order_total
-    c.execute("UPDATE users SET balance = balance - %s WHERE id = %s", (order_total, user_id))
-    
     payment_time = get_vietnam_time().isoformat()
-    c.execute("""
-        UPDATE orders
-        SET status = 'paid', payment_time = %s
-        WHERE id = %s
-    """, (payment_time, order_id))
-    
-    # Mark OTP as verified
-    c.execute("""
-        UPDATE payment_otp
-        SET verified = TRUE
-        WHERE order_id = %s AND user_id = %s AND code = %s
-    """, (order_id, user_id, otp))
-    
-    # Record transaction
-    import uuid
-    transaction_id = str(uuid.uuid4())[:12].upper()
-    c.execute("""
-        INSERT INTO transactions 
-        (id, user_id, type, amount, balance_before, balance_after, order_id, description, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """, (
-        transaction_id,
-        user_id,
-        "payment",
-        -order_total,
-        user_balance,
-        new_balance,
-        order_id,
-        f"Payment for Order #{order_id}",
-        payment_time
-    ))
-    
-    conn.commit()
-    conn.close()
-
-    # Send payment success email asynchronously
     try:
-        html_body = f"""
-        <html>
-            <body style="font-family: Arial, sans-serif; background-color: #f5f5f5; padding: 20px;">
-                <div style="max-width: 520px; margin: 0 auto; background-color: white; padding: 24px; border-radius: 10px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-                    <h2 style="color: #2e7d32; text-align: center;">✅ Payment Successful</h2>
-                    <p style="color: #333;">Your payment for order <strong>#{order_id}</strong> has been completed.</p>
-                    <div style="background-color: #f9f9f9; padding: 12px; border-radius: 6px; margin: 16px 0;">
-                        <p style="margin: 6px 0; color: #666;"><strong>Order ID:</strong> {order_id}</p>
-                        <p style="margin: 6px 0; color: #666;"><strong>Amount Paid:</strong> ₫{order_total:,.0f}</p>
-                        <p style="margin: 6px 0; color: #666;"><strong>New Balance:</strong> ₫{new_balance:,.0f}</p>
-                    </div>
-                    <p style="color: #999; font-size: 12px; text-align: center;">Thank you for your purchase!</p>
-                </div>
-            </body>
-        </html>
-        """
-        background_tasks.add_task(send_email, user_email, "✅ Payment Successful", html_body)
+        # Lock the order so concurrent verifications of it run one at a time
+        c.execute("SELECT total, status FROM orders WHERE id = %s FOR UPDATE", (order_id,))
+        order = c.fetchone()
+        
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        order_total = order['total']
+        
+        if order['status'] != "pending_payment":
+            raise HTTPException(status_code=400, detail="Order is not pending payment")
+        
+        c.execute("""
+            UPDATE orders
+            SET status = 'paid', payment_time = %s
+            WHERE id = %s
+        """, (payment_time, order_id))
+        record_order_sale(c, order_id)
+        
+        # Check and debit in one statement; done last so the user row stays
+        # locked only until commit. The ledger row uses the balance it returns.
+        c.execute("""
+            UPDATE users SET balance = balance - %s
+            WHERE id = %s AND balance >= %s
+            RETURNING email, balance
+        """, (order_total, user_id, order_total))
+        user = c.fetchone()
+        
+        if not user:
+            # A valid session token already proves the user exists
+            if session_user_id is None:
+                c.execute("SELECT 1 FROM users WHERE id = %s", (user_id,))
+                if not c.fetchone():
+                    raise HTTPException(status_code=404, detail="User not found")
+            raise HTTPException(status_code=400, detail="Insufficient balance")
+        
+        user_email = user['email']
+        new_balance = user['balance']
+        
+        # Record transaction
+        import uuid
+        transaction_id = str(uuid.uuid4())[:12].upper()
+        c.execute("""
+            INSERT INTO transactions 
+            (id, user_id, type, amount, balance_before, balance_after, order_id, description, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            transaction_id,
+            user_id,
+            "payment",
+            -order_total,
+            new_balance + order_total,
+            new_balance,
+            order_id,
+            f"Payment for Order #{order_id}",
+            payment_time
+        ))
+        post_wallet_entry(c, transaction_id, user_id, -order_total, SALES_ACCOUNT, "payment", order_id, payment_time)
+        publish_user_change(c, user_id)
+        # Receipt is sent by the outbox dispatcher once this commits
+        outbox.enqueue(c, *_payment_receipt(user_email, order_id, order_total, new_balance))
+        
+        conn.commit()
     except Exception:
-        # Fallback to plain text
-        background_tasks.add_task(send_simple_email, user_email, "Payment Successful", f"Order #{order_id} paid. Amount: {order_total}. New balance: {new_balance}.")
-    
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    # The order is paid now, so a replayed code would fail anyway; consume it for a clear error
+    otp_service.consume(OTPPurpose.PAYMENT, otp_subject)
+    set_balance(user_id, new_balance)
+
     return {
         "status": "success",
         "message": "Payment successful!",
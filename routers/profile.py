@@ -1,18 +1,44 @@
 """
 User Profile routes: Change email, phone, password
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from models.schemas import ChangeEmailRequest, ChangePhoneRequest, ChangePasswordRequest, ChangeUsernameRequest
 from models.responses import StatusResponse, BalanceResponse
 from database import get_db
-from utils.security import hash_password, verify_password
+from utils.passwords import hash_password, verify_password
 from utils.timezone import get_vietnam_time
-from utils.email_service import send_simple_email
+from utils import otp as otp_service
+from utils import outbox
+from utils.otp import OTPPurpose, OTPError, otp_http_error
+from utils.ledger import post_wallet_entry, CLOSED_ACCOUNTS_ACCOUNT
+from utils.user_cache import get_balance as get_cached_balance, publish_user_change, invalidate, ALL_USERS
+from utils.availability import publish_identifiers, remember as remember_identifiers
+from utils.sessions import (
+    check_session, revoke_user_sessions, apply_user_revocation, ALL_USERS as ALL_SESSION_USERS,
+)
 import uuid
 import json
 import psycopg2.extras
 
-router = APIRouter(prefix="/api/user", tags=["6️⃣ User Profile"])
+router = APIRouter(prefix="/api/user", tags=["6️⃣ User Profile"], dependencies=[Depends(check_session)])
+
+# A used code is reported like a missing one
+_PROFILE_OTP_USED = (404, "No OTP found")
+
+
+def _check_password(user_id: str, password: str):
+    """404/401 unless user_id exists and password is theirs (hashed after the connection is released)"""
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    c.execute("SELECT password_hash FROM users WHERE id = %s", (user_id,))
+    result = c.fetchone()
+    conn.close()
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    if not verify_password(password, result['password_hash']):
+        raise HTTPException(status_code=401, detail="Invalid password")
 
 
 @router.post("/change-username", summary="Change Username", response_model=StatusResponse)
@@ -26,31 +52,25 @@ def change_username(request: ChangeUsernameRequest):
     
     Returns success status and message.
     """
+    _check_password(request.user_id, request.password)
+    
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Verify user and password
-    c.execute("SELECT password_hash FROM users WHERE id = %s", (request.user_id,))
-    result = c.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    if not verify_password(request.password, result['password_hash']):
-        conn.close()
-        raise HTTPException(status_code=401, detail="Invalid password")
-    
     # Check if new username already exists
-    c.execute("SELECT id FROM users WHERE username = %s AND id != %s", (request.new_username, request.user_id))
+    c.execute("SELECT id FROM users WHERE lower(username) = lower(%s) AND id != %s", (request.new_username, request.user_id))
     if c.fetchone():
         conn.close()
         raise HTTPException(status_code=400, detail="Username already taken")
     
     # Update username
     c.execute("UPDATE users SET username = %s WHERE id = %s", (request.new_username, request.user_id))
+    publish_user_change(c, request.user_id)
+    publish_identifiers(c, username=request.new_username)
     conn.commit()
     conn.close()
+    invalidate(request.user_id)
+    remember_identifiers(username=request.new_username)
     
     return {"status": "success", "message": "Username updated successfully"}
 
@@ -70,22 +90,15 @@ def change_phone(request: ChangePhoneRequest):
     max_retries = 5
     retry_delay = 0.05  # 50ms
     
+    # Once, outside the retry loop
+    _check_password(request.user_id, request.password)
+    
     for attempt in range(max_retries):
         conn = None
         try:
             conn = get_db()
             c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
             
-            # Verify user and password
-            c.execute("SELECT password_hash FROM users WHERE id = %s", (request.user_id,))
-            result = c.fetchone()
-            
-            if not result:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            if not verify_password(request.password, result['password_hash']):
-                raise HTTPException(status_code=401, detail="Invalid password")
-            
             # Check if new phone already exists (excluding current user)
             c.execute("SELECT id FROM users WHERE phone = %s AND id != %s", (request.new_phone, request.user_id))
             if c.fetchone():
@@ -93,9 +106,15 @@ def change_phone(request: ChangePhoneRequest):
             
             # Update phone
             c.execute("UPDATE users SET phone = %s WHERE id = %s", (request.new_phone, request.user_id))
+            publish_user_change(c, request.user_id)
+            publish_identifiers(c, phone=request.new_phone)
             conn.commit()
+            invalidate(request.user_id)
+            remember_identifiers(phone=request.new_phone)
             
             return {"status": "success", "message": "Phone updated successfully"}
+        except HTTPException:
+            raise
         except Exception as e:
             if "deadlock" in str(e).lower() and attempt < max_retries - 1:
                 time.sleep(retry_delay * (1.5 ** attempt))  # Slower exponential backoff
@@ -137,70 +156,35 @@ def send_change_password_otp(user_id: str):
         conn.close()
         raise HTTPException(status_code=404, detail="User not found")
     email = row['email']
-
-    # generate OTP
-    code = str(uuid.uuid4().int)[:6]
-    expires = get_vietnam_time().replace(microsecond=0)
-    from datetime import timedelta
-    expires = (expires + timedelta(minutes=10)).isoformat()
-
-    # store OTP in payment_otp-like table; reuse payment_otp for generic OTPs
-    c.execute("""
-        INSERT INTO payment_otp (user_id, order_id, code, amount, expires_at, verified)
-        VALUES (%s, %s, %s, 0.0, %s, FALSE)
-    """, (user_id, f"PWD-{uuid.uuid4().hex[:8]}", code, expires))
-    conn.commit()
     conn.close()
 
-    # send email via helper
-    try:
-        send_simple_email(email, "Password Change OTP", f"Your OTP code is: {code}")
-    except Exception:
-        pass
+    code = otp_service.issue(OTPPurpose.PASSWORD_CHANGE, user_id)
+
+    # Sent by the outbox dispatcher; dropped if still unsent when the code expires
+    outbox.submit("simple_email", {"recipient_email": email, "subject": "Password Change OTP",
+                                   "body": f"Your OTP code is: {code}"},
+                  expires_in_seconds=otp_service.OTP_TTL_SECONDS)
 
     return {"status": "success", "message": "OTP sent to current email"}
 
 @router.post("/verify-change-password-otp", summary="Verify OTP and change password")
 def verify_change_password_otp(user_id: str, otp_code: str, new_password: str):
-    conn = get_db()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    # get latest password reset otp for user
-    c.execute("""
-        SELECT code, expires_at, verified FROM payment_otp
-        WHERE user_id = %s AND verified = FALSE AND order_id ~ '^PWD-'
-        ORDER BY created_at DESC LIMIT 1
-        """,
-        (user_id,)
-    )
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="No OTP found")
-    
-    code = row['code']
-    expires_at = row['expires_at']
-    verified = row['verified']
-    
-    from datetime import datetime
-    # verified rows are excluded above; no need to recheck here
-    # Use naive datetime comparison
-    current_time = get_vietnam_time().replace(tzinfo=None)
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if current_time > expires_at:
-        conn.close()
-        raise HTTPException(status_code=400, detail="OTP expired")
-    if otp_code != code:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Invalid OTP")
+    try:
+        otp_service.verify(OTPPurpose.PASSWORD_CHANGE, user_id, otp_code)
+    except OTPError as e:
+        raise otp_http_error(e, used=_PROFILE_OTP_USED)
 
-    # update password
+    # update password (hash before taking a DB connection)
     new_hash = hash_password(new_password)
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     c.execute("UPDATE users SET password_hash = %s WHERE id = %s", (new_hash, user_id))
-    # mark otp used
-    c.execute("UPDATE payment_otp SET verified = TRUE WHERE user_id = %s AND code = %s", (user_id, code))
+    # Log out every session, including the current one
+    revoked_at = revoke_user_sessions(c, user_id)
     conn.commit()
     conn.close()
+    otp_service.consume(OTPPurpose.PASSWORD_CHANGE, user_id)
+    apply_user_revocation(user_id, revoked_at)
     return {"status": "success", "message": "Password changed successfully"}
 
 # ====== EMAIL CHANGE VIA OTP ======
@@ -211,96 +195,64 @@ def send_change_email_otp(user_id: str, new_email: str):
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     # Ensure new email not used
-    c.execute("SELECT id FROM users WHERE email = %s", (new_email,))
+    c.execute("SELECT id FROM users WHERE lower(email) = lower(%s)", (new_email,))
     if c.fetchone():
         conn.close()
         raise HTTPException(status_code=400, detail="Email already in use")
-
-    code = str(uuid.uuid4().int)[:6]
-    from datetime import timedelta
-    expires = (get_vietnam_time() + timedelta(minutes=10)).isoformat()
-
-    c.execute("""
-        INSERT INTO payment_otp (user_id, order_id, code, amount, expires_at, verified)
-        VALUES (%s, %s, %s, 0.0, %s, FALSE)
-    """, (user_id, f"EML-{uuid.uuid4().hex[:8]}", code, expires))
-    conn.commit()
     conn.close()
 
-    try:
-        send_simple_email(new_email, "Email Change OTP", f"Your OTP code is: {code}")
-    except Exception:
-        pass
+    # The code is only valid for the address it was sent to
+    code = otp_service.issue(OTPPurpose.EMAIL_CHANGE, user_id, {"new_email": new_email})
+
+    outbox.submit("simple_email", {"recipient_email": new_email, "subject": "Email Change OTP",
+                                   "body": f"Your OTP code is: {code}"},
+                  expires_in_seconds=otp_service.OTP_TTL_SECONDS)
     return {"status": "success", "message": "OTP sent to new email"}
 
 @router.post("/verify-change-email-otp", summary="Verify OTP and change email")
 def verify_change_email_otp(user_id: str, new_email: str, otp_code: str):
-    conn = get_db()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    # latest email change otp
-    c.execute("""
-        SELECT code, expires_at, verified FROM payment_otp
-        WHERE user_id = %s AND verified = FALSE AND order_id ~ '^EML-'
-        ORDER BY created_at DESC LIMIT 1
-        """,
-        (user_id,)
-    )
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="No OTP found")
-    
-    code = row['code']
-    expires_at = row['expires_at']
-    verified = row['verified']
-    
-    from datetime import datetime
-    # verified rows are excluded above
-    # Use naive datetime comparison
-    current_time = get_vietnam_time().replace(tzinfo=None)
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if current_time > expires_at:
-        conn.close()
-        raise HTTPException(status_code=400, detail="OTP expired")
-    if otp_code != code:
-        conn.close()
+    try:
+        context = otp_service.verify(OTPPurpose.EMAIL_CHANGE, user_id, otp_code)
+    except OTPError as e:
+        raise otp_http_error(e, used=_PROFILE_OTP_USED)
+    if context.get("new_email") != new_email:
         raise HTTPException(status_code=400, detail="Invalid OTP")
 
     # change email
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     c.execute("UPDATE users SET email = %s WHERE id = %s", (new_email, user_id))
-    # mark used
-    c.execute("UPDATE payment_otp SET verified = TRUE WHERE user_id = %s AND code = %s", (user_id, code))
+    publish_user_change(c, user_id)
+    publish_identifiers(c, email=new_email)
     conn.commit()
     conn.close()
+    otp_service.consume(OTPPurpose.EMAIL_CHANGE, user_id)
+    invalidate(user_id)
+    remember_identifiers(email=new_email)
     return {"status": "success", "message": "Email changed successfully"}
 
 
 @router.get("/balance", summary="Get User Balance", response_model=BalanceResponse)
-def get_balance(user_id: str):
+def get_balance(user_id: str = None, session_user_id: str = Depends(check_session)):
     """
     Get user's current account balance.
     
-    - **user_id**: User ID (query parameter, required)
+    - **user_id**: User ID (query parameter; optional with a session token)
     
     Returns current balance amount.
     """
     """Get user's current balance"""
+    user_id = session_user_id or user_id
     if not user_id:
         raise HTTPException(status_code=400, detail="user_id query parameter required")
     
-    conn = get_db()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    c.execute("SELECT balance FROM users WHERE id = %s", (user_id,))
-    result = c.fetchone()
-    
-    conn.close()
+    # Polled on most pages: served from the per-user cache
+    balance = get_cached_balance(user_id)
     
-    if not result:
+    if balance is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return {"balance": result['balance']}
+    return {"balance": balance}
 
 
 # ====== DEV RESET UTILITIES (LOCAL USE ONLY) ======
@@ -316,12 +268,21 @@ def delete_user_dev(user_id: str):
         c.execute("DELETE FROM reviews WHERE user_id = %s", (user_id,))
         c.execute("DELETE FROM payment_otp WHERE user_id = %s", (user_id,))
         c.execute("DELETE FROM frequent_items WHERE user_id = %s", (user_id,))
-        c.execute("SELECT email FROM users WHERE id = %s", (user_id,))
+        c.execute("SELECT email, balance FROM users WHERE id = %s", (user_id,))
         row = c.fetchone()
         if row and row['email']:
             c.execute("DELETE FROM otp_codes WHERE email = %s", (row['email'],))
+        # The ledger is append-only: zero the wallet so a reused user ID starts clean
+        if row and row['balance']:
+            post_wallet_entry(c, f"CLOSE-{user_id}-{uuid.uuid4().hex[:8]}", user_id, -row['balance'],
+                              CLOSED_ACCOUNTS_ACCOUNT, "account_closed")
         c.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        publish_user_change(c, user_id)
+        # User IDs are reused: old tokens must not carry over to the next account
+        revoked_at = revoke_user_sessions(c, user_id)
         conn.commit()
+        invalidate(user_id)
+        apply_user_revocation(user_id, revoked_at)
         return {"status": "success", "message": "User deleted"}
     finally:
         conn.close()
@@ -346,6 +307,17 @@ def reset_database_dev():
         "users",
     ]
     try:
+        # Close every wallet in the append-only ledger before users are wiped
+        c.execute("""
+            INSERT INTO ledger_entries (txn_id, account, user_id, amount, entry_type, created_at)
+            SELECT 'CLOSE-' || u.id || '-' || txid_current(), a.account,
+                   CASE WHEN a.account = 'wallet' THEN u.id END,
+                   CASE WHEN a.account = 'wallet' THEN -u.balance ELSE u.balance END,
+                   'account_closed', %s
+            FROM users u
+            CROSS JOIN (VALUES ('wallet'), (%s)) AS a(account)
+            WHERE u.balance <> 0
+        """, (get_vietnam_time().isoformat(), CLOSED_ACCOUNTS_ACCOUNT))
         for t in tables:
             try:
                 c.execute(f"DELETE FROM {t}")
@@ -355,7 +327,11 @@ def reset_database_dev():
                     continue
                 else:
                     raise
+        publish_user_change(c, ALL_USERS)
+        revoked_at = revoke_user_sessions(c, ALL_SESSION_USERS)
         conn.commit()
+        invalidate(ALL_USERS)
+        apply_user_revocation(ALL_SESSION_USERS, revoked_at)
         return {"status": "success", "message": "All data reset"}
     finally:
         conn.close()
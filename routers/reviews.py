@@ -1,15 +1,16 @@
 """
 Reviews routes: Submit, view, delete product reviews
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from models.schemas import ReviewSubmit, ReviewResponse, ProductReviewsResponse
 from models.responses import StatusResponse
 from database import get_db
 from utils.timezone import get_vietnam_time
+from utils.sessions import check_session
 from datetime import datetime
 import psycopg2.extras
 
-router = APIRouter(prefix="/api/reviews", tags=["Reviews"])
+router = APIRouter(prefix="/api/reviews", tags=["Reviews"], dependencies=[Depends(check_session)])
 
 
 @router.post("/submit", summary="Submit Product + Service Review", response_model=StatusResponse)
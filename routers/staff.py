@@ -0,0 +1,245 @@
+"""
+Staff routes: Order search, bulk exports and wallet audits for support (requires X-Staff-Key)
+"""
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from database import get_db
+from utils.security import require_staff
+from utils.exports import build_export_sql, stream_copy
+from utils.ledger import balance_at, reconcile_balances
+from utils.mass_refund import start_mass_cancellation, get_job
+from models.schemas import MassCancelRequest
+from utils.timezone import get_vietnam_time, to_vietnam_naive
+from typing import Optional
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import re
+import psycopg2.extras
+
+router = APIRouter(prefix="/api/staff", tags=["🛠️ Staff"], dependencies=[Depends(require_staff)])
+
+# Trigram indexes need at least 3 characters to narrow the search
+SEARCH_MIN_LENGTH = 3
+SEARCH_MAX_LIMIT = 100
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _parse_cursor(cursor: str):
+    """Cursor format: '<rank>:<order_id>' as returned in next_cursor"""
+    try:
+        rank, order_id = cursor.split(":", 1)
+        return Decimal(rank), order_id
+    except (ValueError, InvalidOperation):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/orders/search", summary="Search Orders by Phone, Name or Order ID")
+def search_orders(q: str, limit: int = 20, cursor: Optional[str] = None):
+    """
+    Search orders by partial phone number, customer name (accents ignored) or order-ID prefix.
+
+    - **q**: Search text, at least 3 characters (query parameter, required)
+    - **limit**: Page size (default: 20, max: 100)
+    - **cursor**: `next_cursor` from the previous page (optional)
+
+    Results are ranked by match quality (exact ID prefix first, then trigram similarity)
+    and paginated with a keyset cursor. Every predicate is served by a pg_trgm GIN index.
+    """
+    q = q.strip()
+    if len(q) < SEARCH_MIN_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Search text must be at least {SEARCH_MIN_LENGTH} characters")
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+
+    digits = re.sub(r"\D", "", q)
+    params = {
+        "q": q,
+        "id_prefix": _escape_like(q.upper()) + "%",
+        "name_pattern": "%" + _escape_like(q.lower()) + "%",
+        # Only search phones when the text looks like a phone fragment
+        "phone_pattern": "%" + _escape_like(digits) + "%" if len(digits) >= SEARCH_MIN_LENGTH else None,
+        "digits": digits,
+        "limit": limit + 1
+    }
+
+    cursor_filter = ""
+    if cursor:
+        params["cursor_rank"], params["cursor_id"] = _parse_cursor(cursor)
+        cursor_filter = "WHERE rank < %(cursor_rank)s OR (rank = %(cursor_rank)s AND id > %(cursor_id)s)"
+
+    # Each OR branch matches one GIN trigram index (BitmapOr); rank is rounded so the
+    # keyset cursor round-trips exactly
+    sql = f"""
+        SELECT * FROM (
+            SELECT id, user_id, customer_name, customer_phone, total, status, payment_method,
+                   delivery_district, created_at,
+                   ROUND(GREATEST(
+                       CASE WHEN id LIKE %(id_prefix)s THEN 1.0 ELSE 0.0 END,
+                       CASE WHEN %(phone_pattern)s IS NOT NULL AND customer_phone LIKE %(phone_pattern)s
+                            THEN 0.5 + similarity(customer_phone, %(digits)s) / 2 ELSE 0.0 END,
+                       word_similarity(f_unaccent(lower(%(q)s)), f_unaccent(lower(customer_name)))
+                   )::numeric, 4) AS rank
+            FROM orders
+            WHERE id LIKE %(id_prefix)s
+               OR customer_phone LIKE %(phone_pattern)s
+               OR f_unaccent(lower(customer_name)) LIKE f_unaccent(%(name_pattern)s)
+        ) matches
+        {cursor_filter}
+        ORDER BY rank DESC, id
+        LIMIT %(limit)s
+    """
+
+    conn = get_db()
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    c.execute(sql, params)
+    rows = c.fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    orders = []
+    for row in rows:
+        created_at = row['created_at']
+        if hasattr(created_at, 'isoformat'):
+            created_at = created_at.isoformat()
+        orders.append({
+            "id": row['id'],
+            "user_id": row['user_id'],
+            "customer_name": row['customer_name'],
+            "customer_phone": row['customer_phone'],
+            "total": row['total'],
+            "status": row['status'],
+            "payment_method": row['payment_method'],
+            "delivery_district": row['delivery_district'],
+            "created_at": created_at,
+            "rank": float(row['rank'])
+        })
+
+    next_cursor = f"{rows[-1]['rank']}:{rows[-1]['id']}" if has_more and rows else None
+
+    return {"orders": orders, "next_cursor": next_cursor}
+
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _export_response(table: str, format: str, start: Optional[datetime], end: Optional[datetime],
+                     status: Optional[str], gzip: bool):
+    statuses = [s.strip() for s in status.split(",") if s.strip()] if status else None
+    try:
+        sql, params = build_export_sql(table, format, to_vietnam_naive(start), to_vietnam_naive(end), statuses)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    filename = f"{table}-{get_vietnam_time().strftime('%Y%m%d-%H%M%S')}.{format}"
+    media_type = EXPORT_MEDIA_TYPES[format]
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    return StreamingResponse(
+        stream_copy(sql, params, compress=gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@router.get("/export/orders", summary="Export Orders (CSV / NDJSON)")
+def export_orders(format: str = "csv", start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  status: Optional[str] = None, gzip: bool = False):
+    """
+    Stream orders straight from PostgreSQL `COPY ... TO STDOUT`.
+
+    - **format**: `csv` (with header) or `ndjson` (one JSON object per line)
+    - **start** / **end**: Filter on created_at, ISO datetimes (optional)
+    - **status**: Comma-separated order statuses, e.g. `delivered,completed` (optional)
+    - **gzip**: Compress the stream (default: false)
+
+    Rows are streamed in chunks as the database produces them, so exports of any size
+    use constant memory.
+    """
+    return _export_response("orders", format, start, end, status, gzip)
+
+
+@router.get("/export/transactions", summary="Export Transactions (CSV / NDJSON)")
+def export_transactions(format: str = "csv", start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        status: Optional[str] = None, gzip: bool = False):
+    """
+    Stream wallet transactions straight from PostgreSQL `COPY ... TO STDOUT`.
+
+    - **format**: `csv` (with header) or `ndjson` (one JSON object per line)
+    - **start** / **end**: Filter on created_at, ISO datetimes (optional)
+    - **status**: Comma-separated transaction types, e.g. `topup,payment` (optional)
+    - **gzip**: Compress the stream (default: false)
+    """
+    return _export_response("transactions", format, start, end, status, gzip)
+
+
+@router.get("/wallets/{user_id}/balance", summary="Wallet Balance at a Point in Time")
+def wallet_balance_at(user_id: str, at: Optional[datetime] = None):
+    """
+    Wallet balance from the ledger as of a given time.
+    
+    - **user_id**: User ID (path parameter, required)
+    - **at**: ISO datetime (default: now)
+    
+    Computed as the latest balance snapshot before `at` plus the ledger entries after it.
+    """
+    at = to_vietnam_naive(at) or get_vietnam_time().replace(tzinfo=None)
+    return balance_at(user_id, at)
+
+
+@router.post("/wallets/reconcile", summary="Reconcile Balances with the Ledger")
+def reconcile_wallets():
+    """
+    Compare every user's balance with the ledger now and list the accounts that drifted.
+    
+    The same check runs periodically in the background (see `ledger.drift_users` in /health/metrics).
+    """
+    result = reconcile_balances()
+    return {"checked": result["checked"], "drift_count": len(result["drift"]), "drift": result["drift"]}
+
+
+@router.post("/orders/mass-cancel", summary="Cancel and Refund Orders in Bulk")
+def mass_cancel_orders(request: MassCancelRequest):
+    """
+    Start a background job that cancels every open order matching the filters.
+
+    - **statuses**: Order statuses to cancel (default: all open statuses)
+    - **created_after** / **created_before**: Filter on created_at, ISO datetimes (optional)
+    - **delivery_district**: Only orders delivered to this district (optional)
+    - **payment_method**: `balance` or `cod` (optional)
+
+    Orders are cancelled in chunked transactions; paid balance orders are refunded to the
+    wallet in the same transaction and refund emails are queued after each chunk commits.
+    Poll `GET /api/staff/orders/mass-cancel/{job_id}` for progress.
+    """
+    filters = {
+        "statuses": request.statuses,
+        "created_after": to_vietnam_naive(request.created_after),
+        "created_before": to_vietnam_naive(request.created_before),
+        "delivery_district": request.delivery_district,
+        "payment_method": request.payment_method,
+    }
+    job_id = start_mass_cancellation(filters)
+    return {"job_id": job_id, "status": "running"}
+
+
+@router.get("/orders/mass-cancel/{job_id}", summary="Mass Cancellation Progress")
+def mass_cancel_progress(job_id: str):
+    """
+    Progress of a mass cancellation job: orders cancelled and refunded so far,
+    refund emails queued/sent/failed, and the final status.
+
+    - **job_id**: Job ID returned when the job was started (path parameter, required)
+    """
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -1,52 +1,116 @@
 """
 Transaction history routes: View wallet balance transaction history
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from models.responses import TransactionHistoryResponse
 from database import get_db
-import json
+from utils.timezone import to_vietnam_naive
+from utils.sessions import check_session
+from datetime import datetime
+from typing import Optional
 import psycopg2.extras
 
-router = APIRouter(prefix="/api/transactions", tags=["💳 Transaction History"])
+router = APIRouter(prefix="/api/transactions", tags=["💳 Transaction History"], dependencies=[Depends(check_session)])
+
+TRANSACTIONS_MAX_LIMIT = 100
+
+
+def _parse_cursor(cursor: str):
+    """Cursor format: '<created_at>|<transaction_id>' as returned in next_cursor"""
+    try:
+        created_at, transaction_id = cursor.split("|", 1)
+        return datetime.fromisoformat(created_at), transaction_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @router.get("", summary="Get Transaction History", response_model=TransactionHistoryResponse)
-def get_transactions(user_id: str):
+def get_transactions(user_id: str, limit: int = 20, cursor: Optional[str] = None, type: Optional[str] = None,
+                     start: Optional[datetime] = None, end: Optional[datetime] = None):
     """
-    Get wallet balance transaction history for a user.
-    
+    Get wallet balance transaction history for a user, one page at a time.
+
     - **user_id**: User ID (query parameter, required)
-    
-    Returns array of transactions sorted by date (newest first).
-    Only includes balance-related transactions (payments, refunds).
+    - **limit**: Page size (default: 20, max: 100)
+    - **cursor**: `next_cursor` from the previous page (optional)
+    - **type**: Comma-separated transaction types, e.g. `payment,refund` (optional)
+    - **start** / **end**: Only transactions in this ISO datetime range (optional)
+
+    Returns transactions sorted by date (newest first) and `next_cursor` for the next page.
+    The first page also includes `totals` (spent, refunded, count) for the whole filtered range.
+    Served by the (user_id, created_at DESC) covering index.
     """
     if not user_id:
         raise HTTPException(status_code=400, detail="user_id required")
-    
+    limit = max(1, min(limit, TRANSACTIONS_MAX_LIMIT))
+
+    conditions = ["user_id = %(user_id)s"]
+    params = {"user_id": user_id, "limit": limit + 1}
+    types = [t.strip() for t in type.split(",") if t.strip()] if type else None
+    if types:
+        conditions.append("type = ANY(%(types)s)")
+        params["types"] = types
+    if start:
+        conditions.append("created_at >= %(start)s")
+        params["start"] = to_vietnam_naive(start)
+    if end:
+        conditions.append("created_at < %(end)s")
+        params["end"] = to_vietnam_naive(end)
+    where = " AND ".join(conditions)
+
+    page_conditions = where
+    if cursor:
+        params["cursor_created_at"], params["cursor_id"] = _parse_cursor(cursor)
+        page_conditions += " AND (created_at, id) < (%(cursor_created_at)s, %(cursor_id)s)"
+
+    # Totals are only needed for the first page; later pages read just `limit` index entries
+    if cursor:
+        totals_sql = "SELECT NULL::numeric AS spent, NULL::numeric AS refunded, NULL::bigint AS total_count"
+    else:
+        totals_sql = f"""
+            SELECT COALESCE(SUM(-amount) FILTER (WHERE type = 'payment'), 0) AS spent,
+                   COALESCE(SUM(amount) FILTER (WHERE type = 'refund'), 0) AS refunded,
+                   COUNT(*) AS total_count
+            FROM transactions WHERE {where}
+        """
+
     conn = get_db()
     c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    # Verify user exists
-    c.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    # Get transactions
-    c.execute("""
-        SELECT id, type, amount, balance_before, balance_after, 
-               order_id, description, created_at
-        FROM transactions
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-    """, (user_id,))
-    
+    c.execute(f"""
+        WITH totals AS ({totals_sql}),
+        page AS (
+            SELECT id, type, amount, balance_before, balance_after,
+                   order_id, description, created_at
+            FROM transactions
+            WHERE {page_conditions}
+            ORDER BY created_at DESC, id DESC
+            LIMIT %(limit)s
+        )
+        SELECT page.*, totals.spent, totals.refunded, totals.total_count
+        FROM totals LEFT JOIN page ON TRUE
+        ORDER BY page.created_at DESC, page.id DESC
+    """, params)
+    rows = c.fetchall()
+    conn.close()
+
+    totals = None
+    if rows and not cursor:
+        totals = {
+            "spent": float(rows[0]['spent']),
+            "refunded": float(rows[0]['refunded']),
+            "count": rows[0]['total_count']
+        }
+
+    rows = [row for row in rows if row['id'] is not None]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
     transactions = []
-    for row in c.fetchall():
+    for row in rows:
         created_at = row['created_at']
         if hasattr(created_at, 'isoformat'):
             created_at = created_at.isoformat()
-        
+
         transactions.append({
             "id": row['id'],
             "type": row['type'],
@@ -57,7 +121,7 @@ def get_transactions(user_id: str):
             "description": row['description'],
             "created_at": created_at
         })
-    
-    conn.close()
-    
-    return {"transactions": transactions}
+
+    next_cursor = f"{rows[-1]['created_at'].isoformat()}|{rows[-1]['id']}" if has_more and rows else None
+
+    return {"transactions": transactions, "next_cursor": next_cursor, "totals": totals}
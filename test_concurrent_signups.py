@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Concurrency test for registration (POST /api/auth/verify-otp)
+
+Fires parallel sign-ups that collide on the same email, the same username and
+the same phone number, released together by a barrier, and checks that the
+unique constraints let exactly one of each through: one users row, one signup
+ledger credit, and the mapped 400 for every loser.
+
+Runs the app in-process (FastAPI TestClient) against the database configured
+in .env, so run it against a development database. OTP verification is
+stubbed out; the accounts it creates carry a random tag and are left in place
+(the ledger is append-only).
+
+Usage:
+    python test_concurrent_signups.py [--parallel 20]
+"""
+import argparse
+import secrets
+import sys
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def race(client, payloads):
+    """POST every payload at once; Counter of 'created' / '<status> <detail>'"""
+    barrier = threading.Barrier(len(payloads))
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    def sign_up(payload):
+        barrier.wait()
+        response = client.post("/api/auth/verify-otp", json=payload)
+        outcome = "created" if response.status_code == 200 else f"{response.status_code} {response.json().get('detail')}"
+        with lock:
+            outcomes[outcome] += 1
+
+    threads = [threading.Thread(target=sign_up, args=(payload,)) for payload in payloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def count_accounts(where: str, params: tuple):
+    """(users rows, signup ledger credits to those users)"""
+    from database import get_db
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute(f"SELECT array_agg(id) FROM users WHERE {where}", params)
+        user_ids = c.fetchone()[0] or []
+        c.execute("""
+            SELECT count(*) FROM ledger_entries
+            WHERE entry_type = 'signup_credit' AND user_id = ANY(%s)
+        """, (user_ids,))
+        return len(user_ids), c.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def check(name, outcomes, expected_loser, accounts, parallel, failures):
+    users, credits = accounts
+    print(f"   {name}: {dict(outcomes)}; users rows {users}, signup credits {credits}")
+    if outcomes["created"] != 1 or outcomes[expected_loser] != parallel - 1:
+        failures.append(f"{name}: expected 1 created and {parallel - 1} x '{expected_loser}'")
+    if users != 1:
+        failures.append(f"{name}: expected 1 users row, found {users}")
+    if credits != 1:
+        failures.append(f"{name}: expected 1 signup ledger credit, found {credits}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parallel", type=int, default=20, help="Concurrent sign-ups per race")
+    args = parser.parse_args()
+    parallel = args.parallel
+
+    from fastapi.testclient import TestClient
+    from app import app
+    from utils import otp as otp_service
+
+    # Every code is valid: the race under test is the INSERT, not OTP checking
+    otp_service.verify = lambda purpose, subject, code: None
+    otp_service.consume = lambda purpose, subject: None
+
+    tag = secrets.token_hex(4)
+    failures = []
+    with TestClient(app) as client:
+        print(f"🏁 {parallel} parallel sign-ups per race (tag {tag})")
+
+        email = f"race-{tag}@example.test"
+        payloads = [{"email": email, "otp_code": "000000", "full_name": "Race Email", "password": "secret1"}
+                    for _ in range(parallel)]
+        check("same email", race(client, payloads),
+              f"400 Email '{email}' is already registered. Please login instead.",
+              count_accounts("lower(email) = %s", (email,)), parallel, failures)
+
+        username = f"race_{tag}"
+        payloads = [{"email": f"user{i}-{tag}@example.test", "otp_code": "000000", "full_name": "Race Username",
+                     "password": "secret1", "username": username.upper() if i % 2 else username}
+                    for i in range(parallel)]
+        check("same username", race(client, payloads), "400 Username already taken",
+              count_accounts("lower(username) = %s", (username,)), parallel, failures)
+
+        phone = "09" + str(secrets.randbelow(10 ** 8)).zfill(8)
+        payloads = [{"email": f"phone{i}-{tag}@example.test", "otp_code": "000000", "full_name": "Race Phone",
+                     "password": "secret1", "phone": phone}
+                    for i in range(parallel)]
+        check("same phone", race(client, payloads),
+              f"400 Phone number '{phone}' is already registered with another account.",
+              count_accounts("phone = %s", (phone,)), parallel, failures)
+
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        sys.exit(1)
+    print("✅ Each race created exactly one account")
+
+
+if __name__ == "__main__":
+    main()
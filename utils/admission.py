@@ -0,0 +1,172 @@
+"""
+Admission control: bound in-flight API requests to what the DB pool can serve.
+
+Every /api request belongs to a route group with a priority, a concurrency
+limit and a bounded wait queue. When a slot frees up it goes to the
+highest-priority waiter (checkout/payment before browsing). Requests that
+find the queue full, or wait longer than the group's timeout, get a fast 503
+with Retry-After instead of piling up in the threadpool.
+"""
+import asyncio
+import itertools
+import os
+import time
+from fastapi.responses import JSONResponse
+from database import DB_POOL_MAX_CONNECTIONS
+from utils import metrics
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# Requests allowed to run at once; keeps a couple of connections for background jobs
+ADMISSION_MAX_CONCURRENCY = int(os.getenv(
+    "ADMISSION_MAX_CONCURRENCY", str(max(DB_POOL_MAX_CONNECTIONS - 2, 1))
+))
+
+
+class RouteGroup:
+    """Routes sharing a priority (lower runs first), concurrency limit and wait queue"""
+    def __init__(self, name: str, priority: int, max_concurrency: int, max_queue: int,
+                 queue_timeout: float, retry_after: int, prefixes: tuple = ()):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.prefixes = prefixes
+        self.active = 0
+        self.waiting = 0
+
+
+# Matched in order: first group with a matching prefix wins; other /api routes are "default"
+ROUTE_GROUPS = [
+    RouteGroup("checkout", 0, ADMISSION_MAX_CONCURRENCY, max_queue=50, queue_timeout=5.0, retry_after=1,
+               prefixes=("/api/checkout", "/api/orders/bulk", "/api/orders/reorder", "/api/payment")),
+    RouteGroup("browse", 2, max(ADMISSION_MAX_CONCURRENCY // 2, 1), max_queue=10, queue_timeout=1.0, retry_after=2,
+               prefixes=("/api/menu", "/api/frequent-items", "/api/reviews", "/api/locations",
+                         "/api/analytics", "/api/staff")),
+]
+DEFAULT_GROUP = RouteGroup("default", 1, max(ADMISSION_MAX_CONCURRENCY - 1, 1), max_queue=20,
+                           queue_timeout=2.0, retry_after=1)
+
+
+def classify(path: str):
+    """Route group for a request path, or None for paths that are never limited"""
+    if not path.startswith("/api/"):
+        return None
+    for group in ROUTE_GROUPS:
+        if path.startswith(group.prefixes):
+            return group
+    return DEFAULT_GROUP
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Priority gate over a fixed number of request slots (runs on the event loop)"""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.active = 0
+        self._waiters = []  # [priority, sequence, group, future]
+        self._sequence = itertools.count()
+
+    def _can_run(self, group: RouteGroup) -> bool:
+        return self.active < self.capacity and group.active < group.max_concurrency
+
+    def _grant(self, group: RouteGroup):
+        self.active += 1
+        group.active += 1
+
+    def _dispatch(self):
+        """Hand free slots to the best eligible waiters"""
+        for waiter in sorted(self._waiters, key=lambda w: (w[0], w[1])):
+            if self.active >= self.capacity:
+                break
+            group, future = waiter[2], waiter[3]
+            if group.active < group.max_concurrency:
+                self._waiters.remove(waiter)
+                group.waiting -= 1
+                self._grant(group)
+                future.set_result(None)
+
+    async def acquire(self, group: RouteGroup):
+        # Any waiter left in the queue is blocked by its own group limit, so a
+        # request that can run now is not jumping ahead of anyone eligible
+        if self._can_run(group):
+            self._grant(group)
+            return
+
+        if group.waiting >= group.max_queue:
+            raise Overloaded("queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = [group.priority, next(self._sequence), group, future]
+        self._waiters.append(waiter)
+        group.waiting += 1
+        self._publish(group)
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait({future}, timeout=group.queue_timeout)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Slot was granted just before the request was cancelled
+                self.release(group)
+            raise
+        finally:
+            if not future.done():
+                # Timed out (or the client went away) - leave the queue
+                self._waiters.remove(waiter)
+                group.waiting -= 1
+                future.cancel()
+            metrics.observe(f"admission.{group.name}.queue_wait", time.perf_counter() - start)
+            self._publish(group)
+
+        if future.cancelled():
+            raise Overloaded("timeout")
+
+    def release(self, group: RouteGroup):
+        self.active -= 1
+        group.active -= 1
+        self._dispatch()
+        self._publish(group)
+
+    def _publish(self, group: RouteGroup):
+        metrics.set_gauge("admission.active", self.active)
+        metrics.set_gauge("admission.queued", len(self._waiters))
+        metrics.set_gauge(f"admission.{group.name}.active", group.active)
+        metrics.set_gauge(f"admission.{group.name}.queued", group.waiting)
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware that admits, queues or sheds /api requests"""
+    def __init__(self, app, capacity: int = ADMISSION_MAX_CONCURRENCY):
+        self.app = app
+        self.controller = AdmissionController(capacity)
+
+    async def __call__(self, scope, receive, send):
+        group = classify(scope["path"]) if scope["type"] == "http" and ADMISSION_ENABLED else None
+        if group is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await self.controller.acquire(group)
+        except Overloaded as e:
+            metrics.increment(f"admission.{group.name}.shed_{e.reason}")
+            response = JSONResponse(
+                {"detail": "Server is busy, please retry shortly"},
+                status_code=503,
+                headers={"Retry-After": str(group.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        metrics.increment(f"admission.{group.name}.admitted")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(group)
@@ -0,0 +1,281 @@
+"""
+Availability of emails, usernames and phone numbers for as-you-type form checks.
+
+Each field has an in-memory Bloom filter of the normalized values in `users`.
+A Bloom filter never misses a value it was given, so "not in the filter" is a
+definite "available" answered in microseconds; only "maybe present" (taken
+values and the odd false positive) is confirmed with an indexed lookup.
+
+Filters are built when this worker's notification listener connects (see
+utils.user_cache) and rebuilt every AVAILABILITY_REBUILD_SECONDS, which drops
+values changed away since and resizes them as the table grows. Write paths
+publish new values with pg_notify in their transaction, so every worker adds
+them when the write commits. Until the filters are built, or while the
+listener is disconnected, every check goes to the database.
+
+Login uses the same filters to turn away identifiers no account has, and
+remembers identifiers the database did not know for a few seconds
+(LOGIN_NEGATIVE_CACHE_TTL_SECONDS), so credential-stuffing bursts of unknown
+addresses do not reach the database either way.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from database import get_db
+from utils import metrics
+from utils.user_cache import subscribe, is_listening
+
+AVAILABILITY_FILTERS_ENABLED = os.getenv("AVAILABILITY_FILTERS_ENABLED", "1") == "1"
+AVAILABILITY_REBUILD_SECONDS = int(os.getenv("AVAILABILITY_REBUILD_SECONDS", "3600"))
+# Target false positive rate at capacity (each false positive costs one DB lookup)
+AVAILABILITY_ERROR_RATE = float(os.getenv("AVAILABILITY_ERROR_RATE", "0.01"))
+# Filters are sized for users * headroom so sign-ups between rebuilds keep the error rate
+AVAILABILITY_HEADROOM = float(os.getenv("AVAILABILITY_HEADROOM", "2"))
+AVAILABILITY_MIN_CAPACITY = int(os.getenv("AVAILABILITY_MIN_CAPACITY", "10000"))
+LOGIN_NEGATIVE_CACHE_TTL_SECONDS = float(os.getenv("LOGIN_NEGATIVE_CACHE_TTL_SECONDS", "30"))
+LOGIN_NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("LOGIN_NEGATIVE_CACHE_MAX_ENTRIES", "10000"))
+
+NOTIFY_CHANNEL = "user_identifiers"
+# Payload "<field>:<value>"; fields are also the users columns
+FIELDS = ("email", "username", "phone")
+
+_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
+_filters = None  # field -> BloomFilter, None until the first build
+_connection = 0  # bumped on every listener (re)connect
+_built_for = -1  # listener connection the current filters are complete for
+_pending = None  # (field, value) added while a rebuild reads the table
+_unknown_logins = OrderedDict()  # login identifier -> monotonic time the DB did not know it
+_version = 0  # bumped by every remember(); a lookup older than the last one must not be cached
+
+
+class BloomFilter:
+    """Bit array with `hashes` positions per value, derived from one blake2b digest"""
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value: str):
+        """Not thread-safe: callers hold the module lock"""
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+def login_fields(identifier: str):
+    """Fields a login identifier can match: only usernames lack an @"""
+    return ("email", "username") if "@" in identifier else ("username",)
+
+
+def normalize(field: str, value: str) -> str:
+    """Form values are compared in: emails and usernames are unique case-insensitively"""
+    value = (value or "").strip()
+    return value if field == "phone" else value.lower()
+
+
+def _current_filters():
+    """Filters if they reflect every committed value, else None"""
+    with _lock:
+        complete = _filters is not None and _built_for == _connection
+        filters = _filters
+    return filters if complete and is_listening() else None
+
+
+def check(values: dict) -> dict:
+    """
+    {field: value} -> {field: True if available}. Values the filters have never
+    seen are available outright; the rest are looked up in one connection.
+    """
+    values = {field: normalize(field, value) for field, value in values.items() if field in FIELDS}
+    results = {}
+    filters = _current_filters() if AVAILABILITY_FILTERS_ENABLED else None
+    to_query = {}
+    for field, value in values.items():
+        if filters is not None and value not in filters[field]:
+            results[field] = True
+            metrics.increment("availability.filter_answers")
+        else:
+            to_query[field] = value
+    if not to_query:
+        return results
+
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        for field, value in to_query.items():
+            column = field if field == "phone" else f"lower({field})"
+            c.execute(f"SELECT EXISTS (SELECT 1 FROM users WHERE {column} = %s)", (value,))
+            results[field] = not c.fetchone()[0]
+            metrics.increment("availability.db_lookups")
+            if filters is not None and results[field]:
+                metrics.increment("availability.false_positives")
+    finally:
+        conn.close()
+    return results
+
+
+def is_unknown_login(identifier: str) -> bool:
+    """
+    True if no account can have this (lowercased) email or username: the
+    filters do not contain it, or the database recently did not know it.
+    """
+    filters = _current_filters() if AVAILABILITY_FILTERS_ENABLED else None
+    if filters is not None and all(identifier not in filters[field] for field in login_fields(identifier)):
+        metrics.increment("availability.login_filter_rejects")
+        return True
+    if LOGIN_NEGATIVE_CACHE_TTL_SECONDS <= 0 or not is_listening():
+        return False
+    with _lock:
+        seen_at = _unknown_logins.get(identifier)
+        if seen_at is None:
+            return False
+        if time.monotonic() - seen_at > LOGIN_NEGATIVE_CACHE_TTL_SECONDS:
+            del _unknown_logins[identifier]
+            return False
+    metrics.increment("availability.login_negative_hits")
+    return True
+
+
+def version() -> int:
+    """Take before a login lookup and pass to remember_unknown_login()"""
+    with _lock:
+        return _version
+
+
+def remember_unknown_login(identifier: str, looked_up_at: int):
+    """Cache that the database has no account for identifier (dropped when one is created)"""
+    if LOGIN_NEGATIVE_CACHE_TTL_SECONDS <= 0:
+        return
+    with _lock:
+        if _version != looked_up_at:
+            return  # An account may have been created since the lookup's snapshot
+        _unknown_logins[identifier] = time.monotonic()
+        _unknown_logins.move_to_end(identifier)
+        while len(_unknown_logins) > LOGIN_NEGATIVE_CACHE_MAX_ENTRIES:
+            _unknown_logins.popitem(last=False)
+
+
+# ---- Write paths ----
+
+def publish_identifiers(cursor, **values):
+    """Tell every worker about new field values when the caller's transaction commits"""
+    items = [(field, normalize(field, value)) for field, value in values.items() if value]
+    if items:
+        cursor.execute(
+            "SELECT pg_notify(%s, field || ':' || value) FROM unnest(%s::text[], %s::text[]) AS t(field, value)",
+            (NOTIFY_CHANNEL, [field for field, _ in items], [value for _, value in items]),
+        )
+
+
+def remember(**values):
+    """Add committed values to this worker's filters without waiting for the notification"""
+    global _version
+    with _lock:
+        _version += 1
+        for field, value in values.items():
+            if not value or field not in FIELDS:
+                continue
+            value = normalize(field, value)
+            _unknown_logins.pop(value, None)
+            if _filters is not None:
+                _filters[field].add(value)
+            if _pending is not None:
+                _pending.append((field, value))
+
+
+def _handle(payload: str):
+    # The writing worker gets its own notification too; adding a value twice is harmless
+    field, _, value = payload.partition(":")
+    remember(**{field: value})
+    metrics.increment("availability.remote_updates")
+
+
+# ---- Building ----
+
+def rebuild() -> dict:
+    """Build fresh filters from `users` and swap them in (listener connect and background job)"""
+    global _filters, _built_for, _pending
+    if not AVAILABILITY_FILTERS_ENABLED:
+        return {"skipped": "disabled"}
+    with _rebuild_lock:
+        start = time.perf_counter()
+        with _lock:
+            connection = _connection
+            # Values committed after the SELECT's snapshot arrive as notifications meanwhile
+            _pending = []
+        try:
+            conn = get_db()
+            try:
+                c = conn.cursor()
+                c.execute("SELECT count(*) FROM users")
+                users = c.fetchone()[0]
+                capacity = max(users * AVAILABILITY_HEADROOM, AVAILABILITY_MIN_CAPACITY)
+                filters = {field: BloomFilter(capacity, AVAILABILITY_ERROR_RATE) for field in FIELDS}
+                # Named (server-side) cursor streams users instead of loading them all
+                c = conn.cursor(name="availability_rebuild")
+                c.itersize = 5000
+                c.execute("SELECT email, username, phone FROM users")
+                for row in c:
+                    for field, value in zip(FIELDS, row):
+                        if value:
+                            filters[field].add(normalize(field, value))
+                c.close()
+            finally:
+                conn.rollback()
+                conn.close()
+        except Exception:
+            with _lock:
+                _pending = None
+            raise
+
+        with _lock:
+            for field, value in _pending:
+                filters[field].add(value)
+            _pending = None
+            _filters = filters
+            _built_for = connection
+
+    duration = time.perf_counter() - start
+    metrics.observe("availability.rebuild_duration", duration)
+    metrics.set_gauge("availability.users", users)
+    metrics.set_gauge("availability.filter_bytes", sum(len(f._bits) for f in filters.values()))
+    return {"users": users, "capacity": int(capacity), "duration_seconds": duration}
+
+
+def _on_connect():
+    global _connection, _version
+    with _lock:
+        # Values committed while disconnected were missed: checks use the DB until rebuilt
+        _connection += 1
+        _version += 1
+        _unknown_logins.clear()
+    threading.Thread(target=_rebuild_after_connect, name="availability-rebuild", daemon=True).start()
+
+
+def _rebuild_after_connect():
+    try:
+        rebuild()
+    except Exception as e:
+        metrics.increment("availability.rebuild_errors")
+        print(f"⚠️ Availability filter rebuild failed: {e}")
+
+
+if AVAILABILITY_FILTERS_ENABLED:
+    subscribe(NOTIFY_CHANNEL, _handle, _on_connect)
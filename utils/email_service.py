@@ -1,18 +1,16 @@
 """
 Email Service - Send notification emails to users
 """
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 import os
 from dotenv import load_dotenv
+from utils import mailer
 
 load_dotenv()
 
-# Email configuration
-SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+# Email configuration (SMTP server and sessions: utils/mailer.py)
 SENDER_EMAIL = os.getenv("SENDER_EMAIL", "")
 SENDER_PASSWORD = os.getenv("SENDER_PASSWORD", "")
 SENDER_NAME = os.getenv("SENDER_NAME", "Cafe Ordering System")
@@ -23,7 +21,8 @@ def format_currency(amount):
     return f"₫{amount:,.0f}"
 
 
-def send_refund_email(recipient_email: str, recipient_name: str, order_id: str, refund_amount: float, order_items: str = ""):
+def send_refund_email(recipient_email: str, recipient_name: str, order_id: str, refund_amount: float, order_items: str = "",
+                      wait: bool = False):
     """
     Send refund confirmation email when order is cancelled.
     
@@ -33,10 +32,15 @@ def send_refund_email(recipient_email: str, recipient_name: str, order_id: str,
         order_id: Cancelled order ID
         refund_amount: Amount refunded to balance
         order_items: Optional order items summary
+        wait: Block until sent (default: return once queued)
     """
+    # Without credentials (dev), log it and report success like send_email, so the
+    # outbox does not keep retrying it
     if not SENDER_EMAIL or not SENDER_PASSWORD:
-        print("⚠️ Email credentials not configured. Skipping email.")
-        return False
+        print("⚠️ Email credentials not configured. Would send refund email:")
+        print(f"   To: {recipient_email}")
+        print(f"   Order #{order_id}, refund {format_currency(refund_amount)}")
+        return True
     
     try:
         # Create email message
@@ -209,14 +213,8 @@ def send_refund_email(recipient_email: str, recipient_name: str, order_id: str,
         html_part = MIMEText(html_content, 'html')
         msg.attach(html_part)
         
-        # Connect to SMTP server and send email
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
-        
-        print(f"✅ Refund email sent to {recipient_email}")
-        return True
+        # Delivered over a shared SMTP session (utils/mailer.py)
+        return mailer.send(msg, wait=wait)
         
     except Exception as e:
         print(f"❌ Failed to send email: {str(e)}")
@@ -238,11 +236,15 @@ def send_order_confirmation_email(recipient_email: str, recipient_name: str, ord
     pass
 
 
-def send_simple_email(recipient_email: str, subject: str, body: str) -> bool:
-    """Send a simple text email. Returns True on success, False otherwise."""
+def send_simple_email(recipient_email: str, subject: str, body: str, wait: bool = False) -> bool:
+    """Send a simple text email. Returns True once queued (or sent, with wait), False otherwise."""
+    # Without credentials (dev), log it (OTP codes included) and report success like send_email
     if not SENDER_EMAIL or not SENDER_PASSWORD:
-        print("⚠️ Email credentials not configured. Skipping email.")
-        return False
+        print("⚠️ Email credentials not configured. Would send email:")
+        print(f"   To: {recipient_email}")
+        print(f"   Subject: {subject}")
+        print(f"   Body: {body}")
+        return True
     try:
         msg = MIMEMultipart('alternative')
         msg['Subject'] = subject
@@ -250,12 +252,7 @@ def send_simple_email(recipient_email: str, subject: str, body: str) -> bool:
         msg['To'] = recipient_email
         text_part = MIMEText(body, 'plain')
         msg.attach(text_part)
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
-        print(f"✅ Email sent to {recipient_email}: {subject}")
-        return True
+        return mailer.send(msg, wait=wait)
     except Exception as e:
         print(f"❌ Failed to send email: {str(e)}")
         return False
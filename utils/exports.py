@@ -0,0 +1,135 @@
+"""
+Bulk exports: stream orders/transactions as CSV or NDJSON straight from COPY ... TO STDOUT.
+
+The COPY runs on a worker thread and writes into a small bounded queue; the
+consumer yields chunks as they arrive, so memory stays constant no matter how
+many rows are exported. Used by the staff export endpoints and manage.py.
+"""
+import queue
+import threading
+import zlib
+from database import get_db
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Chunks buffered between the COPY thread and the HTTP response (~1 MB)
+EXPORT_QUEUE_CHUNKS = 16
+
+EXPORT_COLUMNS = {
+    "orders": """id, user_id, status, payment_method, total, discount, shipping_fee, promo_code,
+                 customer_name, customer_phone, delivery_district, delivery_ward, delivery_street,
+                 special_notes, items, created_at, payment_time, delivered_at""",
+    "transactions": """id, user_id, type, amount, balance_before, balance_after, order_id,
+                       description, created_at""",
+}
+
+# Column each table's status filter applies to
+STATUS_COLUMNS = {
+    "orders": "status",
+    "transactions": "type",
+}
+
+FORMATS = ("csv", "ndjson")
+
+
+class _QueueWriter:
+    """File-like object for copy_expert that hands fixed-size chunks to a queue"""
+    def __init__(self, chunks: queue.Queue, cancelled: threading.Event):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self._buffer = bytearray()
+
+    def write(self, data):
+        if self._cancelled.is_set():
+            # Aborts the COPY when the client has gone away
+            raise IOError("Export cancelled")
+        self._buffer += data.encode() if isinstance(data, str) else data
+        if len(self._buffer) >= EXPORT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._chunks.put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+def build_export_sql(table: str, fmt: str, start=None, end=None, statuses=None):
+    """Build the COPY statement (and its parameters) for a table with optional filters"""
+    if table not in EXPORT_COLUMNS:
+        raise ValueError(f"Unknown export '{table}'")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'")
+
+    conditions = []
+    params = []
+    if start:
+        conditions.append("created_at >= %s")
+        params.append(start)
+    if end:
+        conditions.append("created_at < %s")
+        params.append(end)
+    if statuses:
+        conditions.append(f"{STATUS_COLUMNS[table]} = ANY(%s)")
+        params.append(list(statuses))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    select = f"SELECT {EXPORT_COLUMNS[table]} FROM {table} {where} ORDER BY created_at"
+
+    if fmt == "csv":
+        return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)", params
+    # One JSON document per line. CSV mode with quote/delimiter bytes that never occur
+    # in JSON output avoids the backslash escaping of COPY's text format.
+    sql = (
+        f"COPY (SELECT row_to_json(t) FROM ({select}) t) TO STDOUT "
+        f"WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+    )
+    return sql, params
+
+
+def stream_copy(sql: str, params=None, compress: bool = False):
+    """Generator yielding the COPY output in chunks (gzip-compressed if requested)"""
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    done = object()
+    errors = []
+
+    def produce():
+        conn = get_db()
+        try:
+            writer = _QueueWriter(chunks, cancelled)
+            c = conn.cursor()
+            # COPY cannot take bind parameters, so render them with psycopg2's quoting
+            c.copy_expert(c.mogrify(sql, params or []).decode(), writer, size=EXPORT_CHUNK_SIZE)
+            writer.flush()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.rollback()
+            conn.close()
+            chunks.put(done)
+
+    thread = threading.Thread(target=produce, name="export-copy", daemon=True)
+    thread.start()
+
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 -> gzip container
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        if errors:
+            raise errors[0]
+        if compressor:
+            yield compressor.flush()
+    finally:
+        # Client disconnected (or finished): stop the COPY and drain so it can exit
+        cancelled.set()
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,56 @@
+"""
+ID allocation from PostgreSQL sequences.
+
+A sequence created with INCREMENT BY N hands out blocks: each nextval()
+reserves [value, value + N) for the calling worker, which then serves IDs
+from memory and only goes back to the database when the block runs out.
+IDs are unique across workers but not gap-free (a restarted worker drops the
+rest of its block), and never depend on the size of the table.
+"""
+import threading
+from database import get_db
+
+
+class SequenceAllocator:
+    """Serves IDs from blocks reserved on a sequence whose increment is the block size"""
+    def __init__(self, sequence: str):
+        self.sequence = sequence
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0  # exclusive end of the current block
+
+    def _reserve_block(self, cursor):
+        cursor.execute("""
+            SELECT nextval(%s::regclass), s.increment_by
+            FROM pg_sequences s
+            WHERE s.schemaname = current_schema() AND s.sequencename = %s
+        """, (self.sequence, self.sequence))
+        row = cursor.fetchone()
+        if row is None:
+            raise RuntimeError(f"Sequence {self.sequence} does not exist (run its migration)")
+        start, size = (row["nextval"], row["increment_by"]) if isinstance(row, dict) else row
+        self._next, self._limit = start, start + size
+
+    def next_id(self, cursor=None) -> int:
+        """Next ID; cursor (any open one) avoids checking out a connection when a block must be reserved"""
+        with self._lock:
+            if self._next >= self._limit:
+                if cursor is not None:
+                    self._reserve_block(cursor)
+                else:
+                    conn = get_db()
+                    try:
+                        self._reserve_block(conn.cursor())
+                    finally:
+                        conn.close()
+            value = self._next
+            self._next += 1
+            return value
+
+
+user_ids = SequenceAllocator("user_id_seq")
+
+
+def next_user_id(cursor=None) -> str:
+    """users.id is TEXT: numeric IDs are stored as strings"""
+    return str(user_ids.next_id(cursor))
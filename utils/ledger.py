@@ -0,0 +1,206 @@
+"""
+Wallet ledger: append-only double-entry records behind users.balance.
+
+Every balance change posts one ledger transaction of two entries that sum to
+zero: the user's 'wallet' entry and the counter account (sales, refunds,
+signup credit, ...). A deferred constraint trigger rejects unbalanced
+transactions and another trigger rejects UPDATE/DELETE.
+
+Periodic per-user snapshots store the wallet balance up to a ledger entry id,
+so "balance at time T" and reconciliation are a snapshot plus a small delta.
+A background job compares users.balance with the ledger in batches and
+reports drift.
+"""
+import os
+import time
+from datetime import timedelta
+import psycopg2.extras
+from database import get_db
+from utils import metrics
+from utils.timezone import get_vietnam_time
+
+WALLET_ACCOUNT = "wallet"
+
+# Counter accounts
+SALES_ACCOUNT = "sales"
+SIGNUP_CREDIT_ACCOUNT = "signup_credit"
+OPENING_BALANCE_ACCOUNT = "opening_balance"
+CLOSED_ACCOUNTS_ACCOUNT = "closed_accounts"
+
+LEDGER_RECONCILE_INTERVAL_SECONDS = int(os.getenv("LEDGER_RECONCILE_INTERVAL_SECONDS", "900"))
+LEDGER_RECONCILE_BATCH_SIZE = int(os.getenv("LEDGER_RECONCILE_BATCH_SIZE", "500"))
+LEDGER_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL_SECONDS", "21600"))
+# Snapshots only cover entries older than this, so a transaction that took a
+# lower entry id but commits late is never skipped
+LEDGER_SNAPSHOT_HORIZON_MINUTES = int(os.getenv("LEDGER_SNAPSHOT_HORIZON_MINUTES", "10"))
+
+
+def post_wallet_entry(cursor, txn_id: str, user_id: str, amount, counter_account: str,
+                      entry_type: str, order_id: str = None, created_at=None):
+    """
+    Record a wallet movement of `amount` (positive = credit to the user) against
+    counter_account, in the caller's transaction.
+    """
+    created_at = created_at or get_vietnam_time().isoformat()
+    cursor.execute("""
+        INSERT INTO ledger_entries (txn_id, account, user_id, amount, entry_type, order_id, created_at)
+        VALUES (%(txn_id)s, %(wallet)s, %(user_id)s, %(amount)s, %(entry_type)s, %(order_id)s, %(created_at)s),
+               (%(txn_id)s, %(counter)s, NULL, -%(amount)s, %(entry_type)s, %(order_id)s, %(created_at)s)
+    """, {
+        "txn_id": txn_id,
+        "wallet": WALLET_ACCOUNT,
+        "counter": counter_account,
+        "user_id": user_id,
+        "amount": amount,
+        "entry_type": entry_type,
+        "order_id": order_id,
+        "created_at": created_at,
+    })
+
+
+# Latest snapshot per user in the batch, plus wallet entries after it
+_RECONCILE_BATCH_SQL = """
+    WITH batch AS (
+        SELECT id, balance FROM users
+        WHERE id > %(after)s
+        ORDER BY id
+        LIMIT %(limit)s
+    ), snap AS (
+        SELECT DISTINCT ON (s.user_id) s.user_id, s.balance, s.last_entry_id
+        FROM wallet_snapshots s
+        JOIN batch b ON b.id = s.user_id
+        ORDER BY s.user_id, s.last_entry_id DESC
+    )
+    SELECT b.id AS user_id, b.balance AS user_balance,
+           COALESCE(snap.balance, 0) + COALESCE((
+               SELECT SUM(e.amount) FROM ledger_entries e
+               WHERE e.account = 'wallet' AND e.user_id = b.id
+                 AND e.id > COALESCE(snap.last_entry_id, 0)
+           ), 0) AS ledger_balance
+    FROM batch b
+    LEFT JOIN snap ON snap.user_id = b.id
+    ORDER BY b.id
+"""
+
+
+def reconcile_balances(batch_size: int = None) -> dict:
+    """
+    Compare users.balance with snapshot + ledger delta for every user, in batches.
+
+    Each batch is one statement, so a payment committing concurrently is seen
+    either entirely (balance and entry) or not at all. Returns the drifted users.
+    """
+    batch_size = batch_size or LEDGER_RECONCILE_BATCH_SIZE
+    start = time.perf_counter()
+    checked = 0
+    drift = []
+    after = ""
+
+    while True:
+        conn = get_db()
+        try:
+            c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            c.execute(_RECONCILE_BATCH_SQL, {"after": after, "limit": batch_size})
+            rows = c.fetchall()
+        finally:
+            conn.close()
+
+        for row in rows:
+            if row['user_balance'] != row['ledger_balance']:
+                drift.append({
+                    "user_id": row['user_id'],
+                    "balance": float(row['user_balance']),
+                    "ledger_balance": float(row['ledger_balance']),
+                    "difference": float(row['user_balance'] - row['ledger_balance']),
+                })
+        checked += len(rows)
+        if len(rows) < batch_size:
+            break
+        after = rows[-1]['user_id']
+
+    duration = time.perf_counter() - start
+    metrics.set_gauge("ledger.drift_users", len(drift))
+    metrics.increment("ledger.users_reconciled", checked)
+    metrics.observe("ledger.reconcile_duration", duration)
+
+    if drift:
+        print(f"⚠️ Ledger drift for {len(drift)} of {checked} users: "
+              + ", ".join(f"{d['user_id']} ({d['difference']:+,.0f})" for d in drift[:10]))
+
+    return {"checked": checked, "drift": drift, "duration_seconds": duration}
+
+
+# New snapshot = previous snapshot + wallet entries up to the horizon entry id,
+# for every user with entries since their last snapshot
+_SNAPSHOT_SQL = """
+    INSERT INTO wallet_snapshots (user_id, last_entry_id, balance, as_of)
+    SELECT e.user_id, MAX(e.id), COALESCE(prev.balance, 0) + SUM(e.amount), MAX(e.created_at)
+    FROM ledger_entries e
+    LEFT JOIN LATERAL (
+        SELECT s.balance, s.last_entry_id FROM wallet_snapshots s
+        WHERE s.user_id = e.user_id
+        ORDER BY s.last_entry_id DESC
+        LIMIT 1
+    ) prev ON TRUE
+    WHERE e.account = 'wallet'
+      AND e.id > COALESCE(prev.last_entry_id, 0)
+      AND e.id <= %(horizon_id)s
+    GROUP BY e.user_id, prev.balance
+"""
+
+
+def take_snapshots() -> dict:
+    """Snapshot every wallet that changed since its last snapshot"""
+    start = time.perf_counter()
+    horizon = get_vietnam_time().replace(tzinfo=None) - timedelta(minutes=LEDGER_SNAPSHOT_HORIZON_MINUTES)
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT MAX(id) FROM ledger_entries WHERE created_at < %s", (horizon,))
+        horizon_id = c.fetchone()[0]
+        snapshots = 0
+        if horizon_id:
+            c.execute(_SNAPSHOT_SQL, {"horizon_id": horizon_id})
+            snapshots = c.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    duration = time.perf_counter() - start
+    metrics.increment("ledger.snapshots_taken", snapshots)
+    metrics.observe("ledger.snapshot_duration", duration)
+    return {"snapshots": snapshots, "duration_seconds": duration}
+
+
+def balance_at(user_id: str, at) -> dict:
+    """Wallet balance at a point in time: latest snapshot before it plus later entries up to it"""
+    conn = get_db()
+    try:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute("""
+            SELECT balance, last_entry_id, as_of FROM wallet_snapshots
+            WHERE user_id = %s AND as_of <= %s
+            ORDER BY last_entry_id DESC
+            LIMIT 1
+        """, (user_id, at))
+        snapshot = c.fetchone()
+        last_entry_id = snapshot['last_entry_id'] if snapshot else 0
+        c.execute("""
+            SELECT COALESCE(SUM(amount), 0) AS delta, COUNT(*) AS entries FROM ledger_entries
+            WHERE account = 'wallet' AND user_id = %s AND id > %s AND created_at <= %s
+        """, (user_id, last_entry_id, at))
+        delta = c.fetchone()
+    finally:
+        conn.close()
+
+    balance = (snapshot['balance'] if snapshot else 0) + delta['delta']
+    return {
+        "user_id": user_id,
+        "at": at.isoformat(),
+        "balance": float(balance),
+        "snapshot_as_of": snapshot['as_of'].isoformat() if snapshot else None,
+        "entries_after_snapshot": delta['entries'],
+    }
@@ -0,0 +1,144 @@
+"""
+Mail throughput benchmark (`python manage.py benchmark-mail`).
+
+Starts a stand-in SMTP server on localhost that accepts every message and,
+like a hosted provider, is slow to set a session up: it waits connect_delay
+before its greeting and auth_delay before accepting LOGIN (the TLS handshake
+and authentication). The same messages are then sent with one connection per
+message (how emails were sent before utils/mailer.py) and over reused
+SMTPSessions with each worker count, through the mailer's own _deliver().
+"""
+import queue
+import socketserver
+import threading
+import time
+from email.mime.text import MIMEText
+from utils.mailer import SMTPSession, _deliver
+
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        time.sleep(server.connect_delay)
+        self.wfile.write(b"220 stand-in ESMTP\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().upper()
+            if command.startswith(b"EHLO"):
+                self.wfile.write(b"250-stand-in\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif command.startswith(b"AUTH"):
+                time.sleep(server.auth_delay)
+                self.wfile.write(b"235 Authenticated\r\n")
+            elif command.startswith((b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP")):
+                self.wfile.write(b"250 OK\r\n")
+            elif command == b"DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with server.lock:
+                    server.received += 1
+                self.wfile.write(b"250 Queued\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"502 Not implemented\r\n")
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    """Accept-everything SMTP server on a free localhost port; `received` counts messages"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay: float, auth_delay: float):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.connect_delay = connect_delay
+        self.auth_delay = auth_delay
+        self.received = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name="smtp-stand-in", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def _messages(count: int):
+    messages = []
+    for i in range(count):
+        message = MIMEText(f"Benchmark message {i}", "plain")
+        message["Subject"] = f"Benchmark {i}"
+        message["From"] = "cafe@example.com"
+        message["To"] = f"customer{i}@example.com"
+        messages.append(message)
+    return messages
+
+
+def _session(port: int) -> SMTPSession:
+    return SMTPSession("127.0.0.1", port, "cafe@example.com", "benchmark", starttls=False)
+
+
+def _send_per_message(messages, port: int) -> int:
+    sent = 0
+    for message in messages:
+        session = _session(port)
+        sent += _deliver(session, message)
+        session.close()
+    return sent
+
+
+def _send_pooled(messages, port: int, workers: int) -> int:
+    pending = queue.Queue()
+    for message in messages:
+        pending.put(message)
+    sent = [0] * workers
+
+    def work(index):
+        session = _session(port)
+        while True:
+            try:
+                message = pending.get_nowait()
+            except queue.Empty:
+                break
+            sent[index] += _deliver(session, message)
+        session.close()
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(sent)
+
+
+def benchmark(messages: int = 500, worker_counts=(1, 2, 4), baseline_messages: int = 20,
+              connect_delay: float = 0.15, auth_delay: float = 0.15) -> dict:
+    """
+    Messages per second with one connection per message (baseline_messages of
+    them; 0 skips it) and over reused sessions with each worker count.
+    """
+    runs = []
+    with StandInSMTPServer(connect_delay, auth_delay) as server:
+        plans = [("per-message", None, baseline_messages)] if baseline_messages > 0 else []
+        plans += [("pooled", workers, messages) for workers in worker_counts]
+        for mode, workers, count in plans:
+            batch = _messages(count)
+            start = time.perf_counter()
+            if workers is None:
+                sent = _send_per_message(batch, server.port)
+            else:
+                sent = _send_pooled(batch, server.port, workers)
+            duration = time.perf_counter() - start
+            runs.append({"mode": mode, "workers": workers, "messages": count, "sent": sent,
+                         "seconds": round(duration, 2), "per_second": round(count / duration, 1)})
+        received = server.received
+    return {"connect_delay": connect_delay, "auth_delay": auth_delay, "runs": runs, "received": received}
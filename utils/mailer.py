@@ -0,0 +1,213 @@
+"""
+Email delivery: reused SMTP sessions fed by a bounded queue.
+
+Opening an SMTP connection (TCP, TLS, STARTTLS, LOGIN) costs 1-2 s against a
+hosted provider, so instead of one connection per message, MAIL_WORKERS
+threads each keep one authenticated session open and send queued messages
+over it. An idle session is kept alive with NOOP and closed after
+MAIL_SMTP_MAX_IDLE_SECONDS; sessions are also recycled after
+MAIL_SMTP_MAX_MESSAGES_PER_SESSION messages (providers cap them). A message
+that fails on a dropped session is retried once on a fresh one.
+
+submit() returns a Future resolving to True (sent) or False (failed). When
+the queue is full for MAIL_QUEUE_TIMEOUT_SECONDS the message is dropped
+(False) rather than holding up the caller.
+"""
+import os
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import Future
+from email.message import Message
+from dotenv import load_dotenv
+from utils import metrics
+
+load_dotenv()
+
+SMTP_HOST = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USER = os.getenv("SENDER_EMAIL", "")
+SMTP_PASSWORD = os.getenv("SENDER_PASSWORD", "")
+# Port 465 is implicit TLS; on other ports upgrade with STARTTLS unless turned off (local relays)
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", "30"))
+
+# Sending threads, each with its own SMTP session
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", "2"))
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "1000"))
+MAIL_QUEUE_TIMEOUT_SECONDS = float(os.getenv("MAIL_QUEUE_TIMEOUT_SECONDS", "1"))
+MAIL_SMTP_KEEPALIVE_SECONDS = float(os.getenv("MAIL_SMTP_KEEPALIVE_SECONDS", "30"))
+MAIL_SMTP_MAX_IDLE_SECONDS = float(os.getenv("MAIL_SMTP_MAX_IDLE_SECONDS", "300"))
+MAIL_SMTP_MAX_MESSAGES_PER_SESSION = int(os.getenv("MAIL_SMTP_MAX_MESSAGES_PER_SESSION", "100"))
+
+# The server refused this message or our login (SMTPException subclasses OSError, so
+# these are told apart from dropped connections first)
+_REJECTED_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException)
+
+_queue = queue.Queue(maxsize=MAIL_QUEUE_SIZE)
+_workers = []
+_workers_lock = threading.Lock()
+_STOP = object()
+
+
+class SMTPSession:
+    """One worker's SMTP connection, opened on demand and reused (server settings default to .env)"""
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, user: str = SMTP_USER,
+                 password: str = SMTP_PASSWORD, starttls: bool = SMTP_STARTTLS):
+        self.host, self.port, self.user, self.password, self.starttls = host, port, user, password, starttls
+        self._server = None
+        self.sent = 0
+        self.last_used = 0.0
+
+    def _connect(self):
+        start = time.perf_counter()
+        if self.port == 465:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT_SECONDS)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT_SECONDS)
+        try:
+            if self.port != 465 and self.starttls:
+                server.starttls()
+            if self.user and self.password:
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self.sent = 0
+        self.last_used = time.monotonic()
+        metrics.increment("mail.connections_opened")
+        metrics.observe("mail.connect_duration", time.perf_counter() - start)
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+
+    def discard(self):
+        """Drop a broken connection without a QUIT round trip"""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def send(self, message: Message):
+        """Send over the open session (opening one if needed); raises on failure"""
+        if self._server is None or self.sent >= MAIL_SMTP_MAX_MESSAGES_PER_SESSION:
+            self.close()
+            self._connect()
+        self._server.send_message(message)
+        self.sent += 1
+        self.last_used = time.monotonic()
+
+    def keepalive(self):
+        """NOOP a session idle for a while; close it once idle too long or dropped"""
+        idle = time.monotonic() - self.last_used
+        if self._server is None or idle < MAIL_SMTP_KEEPALIVE_SECONDS:
+            return
+        if idle >= MAIL_SMTP_MAX_IDLE_SECONDS:
+            self.close()
+            return
+        try:
+            if self._server.noop()[0] != 250:
+                self.close()
+        except OSError:
+            self.discard()
+
+
+def _deliver(session: SMTPSession, message: Message) -> bool:
+    start = time.perf_counter()
+    for attempt in range(2):
+        try:
+            session.send(message)
+            print(f"✅ Email sent to {message['To']}: {message['Subject']}")
+            metrics.increment("mail.sent")
+            metrics.observe("mail.send_duration", time.perf_counter() - start)
+            return True
+        except _REJECTED_ERRORS as e:
+            # Bad recipient, refused login, ...: retrying would not help
+            print(f"❌ Email error (SMTP): {e}")
+            break
+        except OSError as e:
+            # Dropped (possibly long idle) session or unreachable server: reconnect once
+            session.discard()
+            if attempt == 0:
+                metrics.increment("mail.reconnects")
+                continue
+            print(f"❌ Email error (SMTP): {e}")
+        except Exception as e:
+            session.discard()
+            print(f"❌ Email error (SMTP): {e}")
+            break
+    metrics.increment("mail.failed")
+    return False
+
+
+def _worker():
+    session = SMTPSession()
+    while True:
+        try:
+            item = _queue.get(timeout=MAIL_SMTP_KEEPALIVE_SECONDS)
+        except queue.Empty:
+            session.keepalive()
+            continue
+        if item is _STOP:
+            session.close()
+            return
+        message, future = item
+        metrics.set_gauge("mail.queue_depth", _queue.qsize())
+        if future.set_running_or_notify_cancel():
+            future.set_result(_deliver(session, message))
+
+
+def _start_workers():
+    with _workers_lock:
+        while len(_workers) < max(MAIL_WORKERS, 1):
+            worker = threading.Thread(target=_worker, name=f"mailer-{len(_workers)}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def submit(message: Message) -> Future:
+    """Queue a message (To/From taken from its headers); the Future resolves to True if sent"""
+    if not _workers:
+        _start_workers()
+    future = Future()
+    try:
+        _queue.put((message, future), timeout=MAIL_QUEUE_TIMEOUT_SECONDS)
+    except queue.Full:
+        metrics.increment("mail.dropped_queue_full")
+        print(f"⚠️ Mail queue full, dropping email to {message['To']}")
+        future.set_result(False)
+        return future
+    metrics.set_gauge("mail.queue_depth", _queue.qsize())
+    return future
+
+
+def send(message: Message, wait: bool = False) -> bool:
+    """
+    Queue message for delivery. Returns True once queued, or with wait=True
+    once actually sent; False if it was dropped or failed.
+    """
+    future = submit(message)
+    if wait or future.done():
+        return future.result()
+    return True
+
+
+def shutdown(timeout: float = 10.0):
+    """Send what is queued (within timeout), then close every session"""
+    with _workers_lock:
+        workers = list(_workers)
+        _workers.clear()
+    for _ in workers:
+        try:
+            _queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            break
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
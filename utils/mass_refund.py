@@ -0,0 +1,270 @@
+"""
+Mass cancellation: cancel and refund every open order matching a filter.
+
+Orders are processed in chunks, one transaction and one set-based statement
+per chunk: lock the chunk, cancel it, credit each user once, and write the
+refund transactions and ledger entries. Refund emails go into the outbox in
+the same transaction, so they are sent (by the outbox dispatchers) exactly
+for the chunks that commit, and survive restarts. Progress is kept in memory
+per job and exposed through the staff API and manage.py.
+"""
+import os
+import threading
+import time
+import uuid
+from database import get_db
+from utils import metrics, outbox
+from utils.ledger import SALES_ACCOUNT
+from utils.sales_rollups import record_orders_sale
+from utils.timezone import get_vietnam_time
+from utils.user_cache import publish_user_changes, invalidate
+
+MASS_CANCEL_BATCH_SIZE = int(os.getenv("MASS_CANCEL_BATCH_SIZE", "500"))
+
+# Orders that can still be cancelled, and those that were paid from the wallet
+OPEN_ORDER_STATUSES = ("pending_payment", "paid", "preparing", "in_transit")
+REFUNDABLE_STATUSES = ("paid", "preparing", "in_transit")
+
+# Optional filters -> SQL condition on orders
+_FILTERS = {
+    "created_after": "created_at >= %(created_after)s",
+    "created_before": "created_at < %(created_before)s",
+    "delivery_district": "delivery_district = %(delivery_district)s",
+    "payment_method": "payment_method = %(payment_method)s",
+}
+
+# One chunk in one statement. Users are credited once per chunk with the sum of
+# their refunds; each refund row's balance_after is the user's final balance
+# minus the refunds that come after it, in the same (created_at, id) order the
+# chunks are taken in, so the history reads as consecutive refunds.
+_CHUNK_SQL = """
+    WITH target AS (
+        SELECT id, user_id, total, status, payment_method, created_at FROM orders
+        WHERE {where}
+        ORDER BY created_at, id
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    ), cancelled AS (
+        UPDATE orders o
+        SET status = 'cancelled'
+        FROM target t
+        WHERE o.id = t.id
+        RETURNING o.id
+    ), refunds AS (
+        SELECT id AS order_id, user_id, total, created_at FROM target
+        WHERE payment_method = 'balance' AND status = ANY(%(refundable)s) AND total > 0
+    ), credited AS (
+        UPDATE users u
+        SET balance = u.balance + r.amount
+        FROM (SELECT user_id, SUM(total) AS amount FROM refunds GROUP BY user_id) r
+        WHERE u.id = r.user_id
+        RETURNING u.id, u.balance, u.email, u.full_name
+    ), refund_rows AS (
+        SELECT r.order_id, r.user_id, r.total, c.email, c.full_name,
+               c.balance - COALESCE(SUM(r.total) OVER (
+                   PARTITION BY r.user_id ORDER BY r.created_at, r.order_id
+                   ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+               ), 0) AS balance_after
+        FROM refunds r
+        JOIN credited c ON c.id = r.user_id
+    ), txns AS (
+        INSERT INTO transactions
+        (id, user_id, type, amount, balance_before, balance_after, order_id, description, created_at)
+        SELECT upper(left(gen_random_uuid()::text, 12)), user_id, 'refund', total,
+               balance_after - total, balance_after, order_id,
+               'Refund for cancelled Order #' || order_id, %(now)s
+        FROM refund_rows
+        RETURNING id, user_id, amount, order_id
+    ), ledger AS (
+        INSERT INTO ledger_entries (txn_id, account, user_id, amount, entry_type, order_id, created_at)
+        SELECT t.id, a.account,
+               CASE WHEN a.account = 'wallet' THEN t.user_id END,
+               CASE WHEN a.account = 'wallet' THEN t.amount ELSE -t.amount END,
+               'refund', t.order_id, %(now)s
+        FROM txns t
+        CROSS JOIN (VALUES ('wallet'), (%(counter_account)s)) AS a(account)
+    )
+    SELECT (SELECT COUNT(*) FROM cancelled) AS cancelled,
+           r.order_id, r.total, r.email, r.full_name, r.user_id
+    FROM (SELECT 1) one
+    LEFT JOIN refund_rows r ON TRUE
+"""
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+# job_id -> outbox ids of its refund emails (for wait_for_notifications)
+_job_notifications = {}
+
+
+def _build_where(filters: dict):
+    conditions = ["status = ANY(%(statuses)s)"]
+    # Closed orders are never touched, whatever the caller asks for
+    statuses = [s for s in filters.get("statuses") or OPEN_ORDER_STATUSES if s in OPEN_ORDER_STATUSES]
+    params = {"statuses": statuses}
+    for key, condition in _FILTERS.items():
+        if filters.get(key):
+            conditions.append(condition)
+            params[key] = filters[key]
+    return " AND ".join(conditions), params
+
+
+def _update(job_id: str, **changes):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        for key, value in changes.items():
+            if key.startswith("add_"):
+                key = key[4:]
+                job[key] = job[key] + value
+            else:
+                job[key] = value
+
+
+def get_job(job_id: str):
+    """Progress snapshot of one mass cancellation job (None if unknown)"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def run_mass_cancellation(job_id: str, filters: dict, batch_size: int = None):
+    """Process every matching order in chunks, updating the job's progress"""
+    batch_size = batch_size or MASS_CANCEL_BATCH_SIZE
+    where, params = _build_where(filters)
+    sql = _CHUNK_SQL.format(where=where)
+    params.update({
+        "batch_size": batch_size,
+        "refundable": list(REFUNDABLE_STATUSES),
+        "counter_account": SALES_ACCOUNT,
+    })
+    start = time.perf_counter()
+
+    try:
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            c.execute(f"SELECT COUNT(*) FROM orders WHERE {where}", params)
+            _update(job_id, total=c.fetchone()[0])
+        finally:
+            conn.close()
+
+        while True:
+            params["now"] = get_vietnam_time().isoformat()
+            conn = get_db()
+            try:
+                c = conn.cursor()
+                c.execute(sql, params)
+                rows = c.fetchall()
+                refunds = [row for row in rows if row[1] is not None]
+                # Refunded orders no longer count as sales
+                record_orders_sale(c, [row[1] for row in refunds], sign=-1)
+                credited_users = {row[5] for row in refunds}
+                publish_user_changes(c, credited_users)
+                # Refund notices commit (and are sent) together with the chunk
+                notification_ids = outbox.enqueue_many(c, "refund_email", [
+                    {"recipient_email": email, "recipient_name": name,
+                     "order_id": order_id, "refund_amount": float(amount)}
+                    for _, order_id, amount, email, name, _ in refunds if email
+                ])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            for user_id in credited_users:
+                invalidate(user_id)
+
+            cancelled = rows[0][0] if rows else 0
+            refunded_amount = sum(float(row[2]) for row in refunds)
+            _update(job_id, add_processed=cancelled, add_batches=1,
+                    add_refunded_orders=len(refunds), add_refunded_amount=refunded_amount,
+                    add_notifications_queued=len(notification_ids))
+            with _jobs_lock:
+                _job_notifications[job_id].extend(notification_ids)
+            metrics.increment("mass_cancel.orders_cancelled", cancelled)
+            metrics.increment("mass_cancel.orders_refunded", len(refunds))
+
+            if cancelled < batch_size:
+                break
+
+        # Orders a live request held locked (SKIP LOCKED) are reported, not waited for
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            c.execute(f"SELECT COUNT(*) FROM orders WHERE {where}", params)
+            remaining = c.fetchone()[0]
+        finally:
+            conn.close()
+
+        duration = time.perf_counter() - start
+        metrics.observe("mass_cancel.duration", duration)
+        _update(job_id, status="completed", remaining=remaining, duration_seconds=duration,
+                finished_at=get_vietnam_time().isoformat())
+        job = get_job(job_id)
+        print(f"🛑 Mass cancellation {job_id}: {job['processed']} orders cancelled, "
+              f"{job['refunded_orders']} refunded in {duration:.2f}s")
+    except Exception as e:
+        _update(job_id, status="failed", error=str(e), duration_seconds=time.perf_counter() - start,
+                finished_at=get_vietnam_time().isoformat())
+        print(f"❌ Mass cancellation {job_id} failed: {e}")
+
+
+def start_mass_cancellation(filters: dict, background: bool = True) -> str:
+    """Create a job and run it on a background thread (or inline). Returns the job ID."""
+    job_id = uuid.uuid4().hex[:12].upper()
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "job_id": job_id,
+            "status": "running",
+            "filters": {key: str(value) if value is not None else None for key, value in filters.items()},
+            "total": None,
+            "processed": 0,
+            "batches": 0,
+            "refunded_orders": 0,
+            "refunded_amount": 0.0,
+            "remaining": None,
+            "notifications_queued": 0,
+            "started_at": get_vietnam_time().isoformat(),
+            "finished_at": None,
+            "duration_seconds": None,
+            "error": None,
+        }
+        _job_notifications[job_id] = []
+    if background:
+        threading.Thread(target=run_mass_cancellation, args=(job_id, filters),
+                         name=f"mass-cancel-{job_id}", daemon=True).start()
+    else:
+        run_mass_cancellation(job_id, filters)
+    return job_id
+
+
+def notification_status(job_id: str) -> dict:
+    """Refund emails of a job by outbox state: sent (row deleted), failed (given up) or pending"""
+    with _jobs_lock:
+        ids = list(_job_notifications.get(job_id, []))
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT status, COUNT(*) FROM outbox WHERE id = ANY(%s) GROUP BY status", (ids,))
+        counts = dict(c.fetchall())
+    finally:
+        conn.close()
+    pending, failed = counts.get("pending", 0), counts.get("failed", 0)
+    return {"sent": len(ids) - pending - failed, "failed": failed, "pending": pending}
+
+
+def wait_for_notifications(job_id: str, timeout: float = 300.0, poll_seconds: float = 1.0) -> dict:
+    """
+    Send due outbox rows from this process (alongside any server dispatchers) until
+    the job's refund emails are all sent or given up, or timeout passes; returns
+    notification_status().
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        status = notification_status(job_id)
+        if not status["pending"] or time.monotonic() >= deadline:
+            return status
+        if not outbox.dispatch_due()["claimed"]:
+            # Leased by another dispatcher or waiting out a retry delay
+            time.sleep(poll_seconds)
@@ -154,13 +154,13 @@ def search_products(query: str):
     return [item for item in all_items if query in item["name"].lower()]
 
 
+# Product lookup by ID (menu is static, so build the index once)
+PRODUCTS_BY_ID = {item["id"]: item for category in MENU_PRODUCTS.values() for item in category}
+
+
 def get_product_by_id(product_id: str):
     """Get a single product by ID"""
-    all_items = get_all_products()
-    for item in all_items:
-        if item["id"] == product_id:
-            return item
-    return None
+    return PRODUCTS_BY_ID.get(product_id)
 
 
 def get_available_upsells(product_id: str):
@@ -236,3 +236,44 @@ def has_size_option(product_id: str):
     # Only beverages have size options
     category = product.get("category")
     return category in ["coffee", "tea", "juice"]
+
+
+def price_item(product_id: str, size: str = None, milk: str = None, upsells: list = None, toppings: list = None) -> float:
+    """
+    Server-side unit price for a customized product.
+
+    Mirrors the frontend modal: base price + size modifier + milk + upsells + toppings.
+    Raises ValueError with a user-facing message for unknown products or options.
+    """
+    product = get_product_by_id(product_id)
+    if not product:
+        raise ValueError(f"Unknown product '{product_id}'")
+
+    price = product["price"]
+
+    if size and size != "M":
+        if not has_size_option(product_id) or size not in SIZE_OPTIONS:
+            raise ValueError(f"Size '{size}' not available for {product['name']}")
+        price += SIZE_OPTIONS[size]["priceModifier"]
+
+    if milk:
+        milk_options = get_milk_options(product_id)
+        if milk not in milk_options:
+            raise ValueError(f"Milk '{milk}' not available for {product['name']}")
+        price += milk_options[milk]["price"]
+
+    if upsells:
+        available = get_available_upsells(product_id) or {}
+        for key in upsells:
+            if key not in available:
+                raise ValueError(f"Add-on '{key}' not available for {product['name']}")
+            price += available[key]["price"]
+
+    if toppings:
+        available = get_available_toppings(product_id) or {}
+        for key in toppings:
+            if key not in available:
+                raise ValueError(f"Topping '{key}' not available for {product['name']}")
+            price += available[key]["price"]
+
+    return price
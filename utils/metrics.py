@@ -0,0 +1,57 @@
+"""
+In-process metrics: counters, gauges and timings for background jobs and hot paths
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+def increment(name: str, value: float = 1):
+    """Add value to a monotonically increasing counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, seconds: float):
+    """Record one duration sample (count, total, max, last)"""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0}
+            _timings[name] = timing
+        timing["count"] += 1
+        timing["total_seconds"] += seconds
+        timing["last_seconds"] = seconds
+        if seconds > timing["max_seconds"]:
+            timing["max_seconds"] = seconds
+
+
+@contextmanager
+def timer(name: str):
+    """Context manager that records the duration of the wrapped block"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def snapshot() -> dict:
+    """Return a copy of all metrics for the /health/metrics endpoint"""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {name: dict(values) for name, values in _timings.items()},
+        }
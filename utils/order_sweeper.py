@@ -0,0 +1,108 @@
+"""
+Order sweeper: auto-cancel balance orders that never completed OTP payment
+"""
+import os
+import time
+from datetime import timedelta
+from database import get_db
+from utils import metrics
+from utils.timezone import get_vietnam_time
+
+# Unpaid balance orders older than this are cancelled
+PENDING_ORDER_TTL_MINUTES = int(os.getenv("PENDING_ORDER_TTL_MINUTES", "30"))
+# Orders cancelled per transaction - keeps row locks short
+ORDER_SWEEP_BATCH_SIZE = int(os.getenv("ORDER_SWEEP_BATCH_SIZE", "200"))
+# How often the background job runs
+ORDER_SWEEP_INTERVAL_SECONDS = int(os.getenv("ORDER_SWEEP_INTERVAL_SECONDS", "60"))
+
+
+# One batch in one statement: lock a chunk of stale orders (skipping rows a live
+# request is holding), cancel them, and give back the promo uses they consumed.
+# Checkout stores promo_code even when it was rejected, so only discounted orders count.
+_SWEEP_BATCH_SQL = """
+    WITH stale AS (
+        SELECT id FROM orders
+        WHERE status = 'pending_payment'
+          AND payment_method = 'balance'
+          AND created_at < %s
+        ORDER BY created_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), cancelled AS (
+        UPDATE orders o
+        SET status = 'cancelled'
+        FROM stale
+        WHERE o.id = stale.id
+        RETURNING o.id, o.promo_code, o.discount
+    ), promo_usage AS (
+        SELECT promo_code, COUNT(*) AS uses
+        FROM cancelled
+        WHERE promo_code IS NOT NULL AND discount > 0
+        GROUP BY promo_code
+    ), restored AS (
+        UPDATE promo_codes p
+        SET used_count = GREATEST(p.used_count - promo_usage.uses, 0)
+        FROM promo_usage
+        WHERE p.code = promo_usage.promo_code
+        RETURNING promo_usage.uses
+    )
+    SELECT
+        (SELECT COUNT(*) FROM cancelled) AS cancelled,
+        (SELECT COALESCE(SUM(uses), 0) FROM restored) AS promos_restored
+"""
+
+
+def sweep_stale_orders(max_age_minutes: int = None, batch_size: int = None) -> dict:
+    """
+    Cancel stale pending_payment balance orders in chunks.
+
+    Each chunk is its own short transaction so live checkouts and payments
+    are never blocked behind the sweeper. Returns counts for the run.
+    """
+    max_age_minutes = max_age_minutes or PENDING_ORDER_TTL_MINUTES
+    batch_size = batch_size or ORDER_SWEEP_BATCH_SIZE
+    # created_at is stored as naive Vietnam time
+    cutoff = get_vietnam_time().replace(tzinfo=None) - timedelta(minutes=max_age_minutes)
+
+    start = time.perf_counter()
+    total_cancelled = 0
+    total_promos = 0
+    batches = 0
+
+    while True:
+        batch_start = time.perf_counter()
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            c.execute(_SWEEP_BATCH_SQL, (cutoff, batch_size))
+            cancelled, promos_restored = c.fetchone()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        batches += 1
+        total_cancelled += cancelled
+        total_promos += int(promos_restored)
+        metrics.observe("order_sweeper.batch_duration", time.perf_counter() - batch_start)
+
+        if cancelled < batch_size:
+            break
+
+    duration = time.perf_counter() - start
+    metrics.increment("order_sweeper.orders_cancelled", total_cancelled)
+    metrics.increment("order_sweeper.promos_restored", total_promos)
+    metrics.set_gauge("order_sweeper.last_run_cancelled", total_cancelled)
+    metrics.observe("order_sweeper.run_duration", duration)
+
+    if total_cancelled:
+        print(f"🧹 Order sweeper cancelled {total_cancelled} stale orders in {batches} batches ({duration:.2f}s)")
+
+    return {
+        "cancelled": total_cancelled,
+        "promos_restored": total_promos,
+        "batches": batches,
+        "duration_seconds": duration,
+    }
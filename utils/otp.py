@@ -0,0 +1,229 @@
+"""
+One-time passwords for every flow: registration, password reset/change,
+email change and payment confirmation.
+
+Codes are never stored: a record keeps an HMAC of (purpose, subject, code),
+its expiry, a wrong-attempt counter and optional context (e.g. the new email
+address or the payment amount). Records live in a TTL store in process memory,
+or in Redis when OTP_STORE_URL is set so all workers share them. Nothing on
+the OTP path touches PostgreSQL.
+
+A subject has at most one live code per purpose; issuing a new one replaces
+it. Verification checks without consuming, so the caller can consume the code
+only once its own transaction has committed.
+"""
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from enum import Enum
+from fastapi import HTTPException
+from utils import metrics
+from utils.security import generate_otp
+
+OTP_TTL_SECONDS = int(os.getenv("OTP_TTL_SECONDS", "600"))
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
+# Expired and used records are kept this much longer so callers can say why a code failed
+OTP_RETAIN_SECONDS = int(os.getenv("OTP_RETAIN_SECONDS", "600"))
+# redis://host:6379/0 to share OTPs between workers (needs the `redis` package)
+OTP_STORE_URL = os.getenv("OTP_STORE_URL", "")
+# Key for hashing codes; must be set (and equal) on every worker when the store is shared
+OTP_SECRET = os.getenv("OTP_SECRET", "")
+OTP_MEMORY_MAX_ENTRIES = int(os.getenv("OTP_MEMORY_MAX_ENTRIES", "100000"))
+
+
+class OTPPurpose(str, Enum):
+    REGISTRATION = "registration"  # subject: email
+    PASSWORD_RESET = "password_reset"  # subject: email
+    PASSWORD_CHANGE = "password_change"  # subject: user ID
+    EMAIL_CHANGE = "email_change"  # subject: user ID, context: new_email
+    PAYMENT = "payment"  # subject: "<user_id>:<order_id>", context: amount
+
+
+class OTPError(Exception):
+    """Verification failed; reason is not_found, expired, used, invalid or too_many_attempts"""
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+# Default HTTP responses per failure reason; flows override wording where it differs
+OTP_HTTP_ERRORS = {
+    "not_found": (404, "No OTP found"),
+    "expired": (400, "OTP expired"),
+    "used": (400, "OTP already used"),
+    "invalid": (400, "Invalid OTP"),
+    "too_many_attempts": (429, "Too many invalid attempts. Please request a new OTP"),
+}
+
+
+def otp_http_error(error: OTPError, **overrides) -> HTTPException:
+    """HTTPException for a failed verification; overrides map reason -> (status, detail)"""
+    status_code, detail = overrides.get(error.reason, OTP_HTTP_ERRORS[error.reason])
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+class MemoryOTPStore:
+    """Per-process TTL store"""
+    def __init__(self, max_entries: int = OTP_MEMORY_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self._records = {}  # key -> (drop_at, record)
+        self._max_entries = max_entries
+
+    def _prune(self, now: float):
+        for key in [k for k, (drop_at, _) in self._records.items() if drop_at <= now]:
+            del self._records[key]
+
+    def put(self, key: str, record: dict, ttl: float):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._records) >= self._max_entries:
+                self._prune(now)
+            self._records[key] = (now + ttl, dict(record))
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._records[key]
+                return None
+            return dict(entry[1])
+
+    def add_attempt(self, key: str) -> int:
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is None:
+                return 0
+            entry[1]["attempts"] += 1
+            return entry[1]["attempts"]
+
+    def mark_used(self, key: str):
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None:
+                entry[1]["used"] = True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._records.pop(key, None)
+
+
+class RedisOTPStore:
+    """Shared store: one Redis hash per code, expired by Redis itself"""
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("OTP_STORE_URL is set but the 'redis' package is not installed")
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def put(self, key: str, record: dict, ttl: float):
+        pipe = self._redis.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={
+            "code_hash": record["code_hash"],
+            "expires_at": record["expires_at"],
+            "attempts": record["attempts"],
+            "used": int(record["used"]),
+            "context": json.dumps(record["context"]),
+        })
+        pipe.pexpire(key, int(ttl * 1000))
+        pipe.execute()
+
+    def get(self, key: str):
+        data = self._redis.hgetall(key)
+        if not data:
+            return None
+        return {
+            "code_hash": data["code_hash"],
+            "expires_at": float(data["expires_at"]),
+            "attempts": int(data["attempts"]),
+            "used": data["used"] == "1",
+            "context": json.loads(data["context"]),
+        }
+
+    def add_attempt(self, key: str) -> int:
+        # HINCRBY would recreate a key that just expired; only count existing codes
+        if not self._redis.exists(key):
+            return 0
+        return self._redis.hincrby(key, "attempts", 1)
+
+    def mark_used(self, key: str):
+        if self._redis.exists(key):
+            self._redis.hset(key, "used", 1)
+
+    def delete(self, key: str):
+        self._redis.delete(key)
+
+
+_store = RedisOTPStore(OTP_STORE_URL) if OTP_STORE_URL else MemoryOTPStore()
+if OTP_STORE_URL and not OTP_SECRET:
+    print("⚠️ OTP_STORE_URL is set without OTP_SECRET: codes issued by one worker will not verify on another")
+_secret = OTP_SECRET.encode() if OTP_SECRET else secrets.token_bytes(32)
+
+
+def _key(purpose: OTPPurpose, subject: str) -> str:
+    return f"otp:{OTPPurpose(purpose).value}:{subject}"
+
+
+def _hash(purpose: OTPPurpose, subject: str, code: str) -> str:
+    message = f"{OTPPurpose(purpose).value}\x00{subject}\x00{code}".encode()
+    return hmac.new(_secret, message, hashlib.sha256).hexdigest()
+
+
+def issue(purpose: OTPPurpose, subject: str, context: dict = None, ttl_seconds: int = OTP_TTL_SECONDS) -> str:
+    """Create a code for subject (replacing any earlier one) and return it for sending"""
+    code = generate_otp()
+    _store.put(_key(purpose, subject), {
+        "code_hash": _hash(purpose, subject, code),
+        "expires_at": time.time() + ttl_seconds,
+        "attempts": 0,
+        "used": False,
+        "context": context or {},
+    }, ttl_seconds + OTP_RETAIN_SECONDS)
+    metrics.increment(f"otp.{OTPPurpose(purpose).value}.issued")
+    return code
+
+
+def verify(purpose: OTPPurpose, subject: str, code: str) -> dict:
+    """
+    Check a code without consuming it and return its context.
+
+    Raises OTPError. Every wrong code counts as an attempt; after
+    OTP_MAX_ATTEMPTS the code is burned and a new one must be requested.
+    """
+    key = _key(purpose, subject)
+    record = _store.get(key)
+    try:
+        if record is None:
+            raise OTPError("not_found")
+        if record["used"]:
+            raise OTPError("used")
+        if time.time() > record["expires_at"]:
+            raise OTPError("expired")
+        if record["attempts"] >= OTP_MAX_ATTEMPTS:
+            raise OTPError("too_many_attempts")
+        if not hmac.compare_digest(record["code_hash"], _hash(purpose, subject, (code or "").strip())):
+            if _store.add_attempt(key) >= OTP_MAX_ATTEMPTS:
+                raise OTPError("too_many_attempts")
+            raise OTPError("invalid")
+    except OTPError as e:
+        metrics.increment(f"otp.{OTPPurpose(purpose).value}.failed_{e.reason}")
+        raise
+    metrics.increment(f"otp.{OTPPurpose(purpose).value}.verified")
+    return record["context"]
+
+
+def consume(purpose: OTPPurpose, subject: str):
+    """Mark the code used so it cannot be replayed (kept briefly to report 'already used')"""
+    _store.mark_used(_key(purpose, subject))
+
+
+def revoke(purpose: OTPPurpose, subject: str):
+    """Drop any live code for subject"""
+    _store.delete(_key(purpose, subject))
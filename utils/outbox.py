@@ -0,0 +1,230 @@
+"""
+Transactional outbox for notifications.
+
+Write paths insert the notification into `outbox` with enqueue(), in the same
+transaction as the change it reports: it is sent if and only if the change
+commits, and it survives worker restarts. Notifications that report no DB
+change (OTP codes) go through submit(), which commits the row on its own.
+
+A dispatcher thread per worker claims due rows in batches with FOR UPDATE SKIP
+LOCKED (so workers never claim the same row) and pushes their next attempt
+OUTBOX_LEASE_SECONDS out before sending; if the worker dies mid-send, the row
+comes due again once the lease runs out. Sent rows are deleted. Failed sends
+are retried with exponential backoff up to OUTBOX_MAX_ATTEMPTS, then kept as
+'failed' until the retention job purges them. Rows past their expires_at (an
+OTP email once the code has expired) are dropped instead of sent.
+
+Each enqueue also notifies the outbox channel, so dispatchers wake when the
+transaction commits rather than on their next poll.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+import psycopg2.extras
+from database import get_db
+from utils import metrics
+from utils.email_service import send_refund_email, send_simple_email
+from utils.mailer import MAIL_WORKERS
+from utils.security import send_email
+from utils.timezone import get_vietnam_time
+from utils.user_cache import subscribe
+
+OUTBOX_DISPATCHER_ENABLED = os.getenv("OUTBOX_DISPATCHER_ENABLED", "1") == "1"
+# Fallback poll for retries and missed wake-ups
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Retry n waits base * 2^(n-1) seconds, capped
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "10"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "3600"))
+# How long a claimed row stays invisible to other dispatchers
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+# Rows of one batch sent at once (each waits on one mailer session)
+OUTBOX_SEND_CONCURRENCY = int(os.getenv("OUTBOX_SEND_CONCURRENCY", str(MAIL_WORKERS)))
+
+NOTIFY_CHANNEL = "outbox"
+
+# kind -> sender called with the payload as keyword arguments; returns True once sent
+HANDLERS = {
+    "email": lambda payload: send_email(**payload, wait=True),
+    "simple_email": lambda payload: send_simple_email(**payload, wait=True),
+    "refund_email": lambda payload: send_refund_email(**payload, wait=True),
+}
+
+# Lock a batch of due rows (skipping rows another dispatcher holds) and lease them
+_CLAIM_SQL = """
+    UPDATE outbox SET attempts = attempts + 1, available_at = %(lease_until)s
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE status = 'pending' AND available_at <= %(now)s
+        ORDER BY available_at
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload, attempts, expires_at
+"""
+
+_wake = threading.Event()
+_stop = threading.Event()
+_dispatcher = None
+_senders = None
+
+
+def _now() -> datetime:
+    return get_vietnam_time().replace(tzinfo=None)
+
+
+def enqueue(cursor, kind: str, payload: dict, expires_at: Optional[datetime] = None) -> int:
+    """Queue a notification in the caller's transaction (payload: the sender's keyword arguments); returns its id"""
+    return enqueue_many(cursor, kind, [payload], expires_at)[0]
+
+
+def enqueue_many(cursor, kind: str, payloads: list, expires_at: Optional[datetime] = None) -> list:
+    """enqueue() for a batch in one INSERT (bulk jobs); returns the ids in payload order"""
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown outbox kind: {kind}")
+    if not payloads:
+        return []
+    now = _now()
+    rows = psycopg2.extras.execute_values(cursor, """
+        INSERT INTO outbox (kind, payload, available_at, expires_at, created_at)
+        VALUES %s
+        RETURNING id
+    """, [(kind, psycopg2.extras.Json(payload), now, expires_at, now) for payload in payloads],
+        page_size=len(payloads), fetch=True)
+    cursor.execute("SELECT pg_notify(%s, '')", (NOTIFY_CHANNEL,))
+    metrics.increment(f"outbox.{kind}.enqueued", len(payloads))
+    return [row[0] if isinstance(row, tuple) else row["id"] for row in rows]
+
+
+def submit(kind: str, payload: dict, expires_in_seconds: Optional[float] = None):
+    """enqueue() in a transaction of its own, for notifications that report no DB change"""
+    expires_at = _now() + timedelta(seconds=expires_in_seconds) if expires_in_seconds else None
+    conn = get_db()
+    try:
+        enqueue(conn.cursor(), kind, payload, expires_at)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS)
+
+
+def _send(row: dict):
+    """(row, error or None)"""
+    try:
+        if HANDLERS[row["kind"]](row["payload"]):
+            return row, None
+        return row, "send failed"
+    except Exception as e:
+        return row, str(e) or type(e).__name__
+
+
+def dispatch_due(batch_size: int = None) -> dict:
+    """Claim one batch of due notifications, send them and record the outcome"""
+    global _senders
+    batch_size = batch_size or OUTBOX_BATCH_SIZE
+    now = _now()
+    conn = get_db()
+    try:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute(_CLAIM_SQL, {"now": now, "batch_size": batch_size,
+                               "lease_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)})
+        rows = c.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if not rows:
+        return {"claimed": 0, "sent": 0, "retried": 0, "failed": 0, "expired": 0}
+
+    expired = [row for row in rows if row["expires_at"] is not None and row["expires_at"] <= now]
+    expired_ids = {row["id"] for row in expired}
+    due = [row for row in rows if row["id"] not in expired_ids]
+    if _senders is None:
+        _senders = ThreadPoolExecutor(max_workers=max(OUTBOX_SEND_CONCURRENCY, 1), thread_name_prefix="outbox-send")
+    results = list(_senders.map(_send, due))
+
+    sent = [row["id"] for row, error in results if error is None] + list(expired_ids)
+    retries = [(row, error) for row, error in results if error is not None]
+    failed = 0
+    now = _now()
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        if sent:
+            c.execute("DELETE FROM outbox WHERE id = ANY(%s)", (sent,))
+        for row, error in retries:
+            gave_up = row["attempts"] >= OUTBOX_MAX_ATTEMPTS
+            failed += gave_up
+            c.execute("""
+                UPDATE outbox SET status = %s, available_at = %s, last_error = %s
+                WHERE id = %s
+            """, ("failed" if gave_up else "pending",
+                  now + timedelta(seconds=_retry_delay(row["attempts"])), error, row["id"]))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    metrics.increment("outbox.sent", len(sent) - len(expired))
+    metrics.increment("outbox.retried", len(retries) - failed)
+    metrics.increment("outbox.failed", failed)
+    metrics.increment("outbox.expired", len(expired))
+    if failed:
+        print(f"⚠️ Outbox gave up on {failed} notification(s) after {OUTBOX_MAX_ATTEMPTS} attempts")
+    return {"claimed": len(rows), "sent": len(sent) - len(expired), "retried": len(retries) - failed,
+            "failed": failed, "expired": len(expired)}
+
+
+def wake():
+    """Run the dispatcher now instead of at its next poll"""
+    _wake.set()
+
+
+def _dispatch_loop():
+    while not _stop.is_set():
+        _wake.clear()
+        try:
+            # Keep going while batches come back full
+            while not _stop.is_set() and dispatch_due()["claimed"] >= OUTBOX_BATCH_SIZE:
+                pass
+        except Exception as e:
+            metrics.increment("outbox.dispatch_errors")
+            print(f"⚠️ Outbox dispatch failed: {e}")
+        _wake.wait(OUTBOX_POLL_SECONDS)
+
+
+def start_dispatcher():
+    global _dispatcher
+    if not OUTBOX_DISPATCHER_ENABLED or _dispatcher is not None:
+        return
+    _stop.clear()
+    _dispatcher = threading.Thread(target=_dispatch_loop, name="outbox-dispatcher", daemon=True)
+    _dispatcher.start()
+
+
+def stop_dispatcher(timeout: float = 10.0):
+    global _dispatcher
+    _stop.set()
+    _wake.set()
+    if _dispatcher is not None:
+        _dispatcher.join(timeout)
+        _dispatcher = None
+
+
+if OUTBOX_DISPATCHER_ENABLED:
+    # Committed enqueues on any worker wake this worker's dispatcher (and so does a
+    # listener reconnect, in case one was missed)
+    subscribe(NOTIFY_CHANNEL, lambda payload: wake(), wake)
@@ -0,0 +1,190 @@
+"""
+Password hashing service.
+
+Passwords are hashed with scrypt (memory-hard, in the standard library) in a
+dedicated process pool, so the ~50-100 ms of CPU per hash never runs on a
+request thread or holds the GIL. At most PASSWORD_HASH_MAX_PENDING hashes may
+be queued or running; beyond that callers get 503 instead of piling up.
+
+Stored hashes carry their scheme and parameters:
+
+    scrypt$n=16384,r=8,p=1$<salt b64>$<hash b64>
+
+Bare 64-character hex strings are legacy unsalted SHA-256 hashes. They still
+verify, and needs_rehash() tells login to replace them (and hashes with
+outdated cost parameters) once the password is known.
+
+Login calls verify_dummy() for identifiers with no account, so an unknown
+identifier costs the same scrypt run as a wrong password and response time
+does not reveal which accounts exist.
+"""
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+from utils import metrics
+
+# scrypt cost: N (CPU/memory, power of 2), r (block size), p (parallelism).
+# Memory per hash is 128 * N * r bytes (16 MiB at the defaults).
+# `python manage.py calibrate-passwords` picks N for a target latency.
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", "16384"))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+# Worker processes for hashing; 0 hashes in the calling thread (scripts)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hashes queued or running at once before new requests are turned away
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+# How long a request waits for a queue slot before 503
+PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS", "2"))
+
+SCHEME = "scrypt"
+LEGACY_SCHEME = "sha256"
+_SALT_BYTES = 16
+_KEY_BYTES = 32
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+
+def _scrypt(password: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
+    """Runs in a pool worker"""
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                          maxmem=128 * n * r * p + 128 * n * r + 1024 * 1024, dklen=_KEY_BYTES)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the server process has DB pool and listener threads
+            _pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _replace_broken_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is not broken:
+            return  # Another request already replaced it
+        _pool = None
+    metrics.increment("passwords.pool_restarts")
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_kdf(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    if PASSWORD_HASH_WORKERS <= 0:
+        return _scrypt(password.encode(), salt, n, r, p)
+    if not _slots.acquire(timeout=PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS):
+        metrics.increment("passwords.rejected_busy")
+        raise HTTPException(status_code=503, detail="Server busy, please try again",
+                            headers={"Retry-After": "1"})
+    try:
+        with metrics.timer("passwords.kdf_duration"):
+            pool = _get_pool()
+            try:
+                return pool.submit(_scrypt, password.encode(), salt, n, r, p).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed): start a fresh pool and retry once
+                _replace_broken_pool(pool)
+                return _get_pool().submit(_scrypt, password.encode(), salt, n, r, p).result()
+    finally:
+        _slots.release()
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _parse(password_hash: str):
+    """(scheme, params, salt, key); legacy SHA-256 hex -> ('sha256', None, None, hex)"""
+    if password_hash.startswith(SCHEME + "$"):
+        _, params, salt, key = password_hash.split("$")
+        params = {name: int(value) for name, value in (item.split("=") for item in params.split(","))}
+        return SCHEME, params, _unb64(salt), _unb64(key)
+    return LEGACY_SCHEME, None, None, password_hash
+
+
+def hash_password(password: str) -> str:
+    """Hash with the current scrypt parameters and a random salt"""
+    n, r, p = PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+    salt = secrets.token_bytes(_SALT_BYTES)
+    key = _run_kdf(password, salt, n, r, p)
+    metrics.increment("passwords.hashed")
+    return f"{SCHEME}$n={n},r={r},p={p}${_b64(salt)}${_b64(key)}"
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Check password against a stored hash of any supported format"""
+    if not password_hash:
+        return False
+    scheme, params, salt, key = _parse(password_hash)
+    if scheme == LEGACY_SCHEME:
+        candidate = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(candidate, key)
+    candidate = _run_kdf(password, salt, params["n"], params["r"], params["p"])
+    return hmac.compare_digest(candidate, key)
+
+
+def verify_dummy(password: str) -> bool:
+    """Spend a verify_password() against a fixed hash with the current parameters; always False"""
+    verify_password(password, _DUMMY_HASH)
+    return False
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """True for legacy SHA-256 hashes and scrypt hashes with outdated parameters"""
+    scheme, params, _, _ = _parse(password_hash or "")
+    if scheme != SCHEME:
+        return True
+    return params != {"n": PASSWORD_SCRYPT_N, "r": PASSWORD_SCRYPT_R, "p": PASSWORD_SCRYPT_P}
+
+
+# Fixed salt and a key no password produces: only the cost matters
+_DUMMY_HASH = (f"{SCHEME}$n={PASSWORD_SCRYPT_N},r={PASSWORD_SCRYPT_R},p={PASSWORD_SCRYPT_P}"
+               f"${_b64(bytes(_SALT_BYTES))}${_b64(bytes(_KEY_BYTES))}")
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def calibrate(target_ms: float = 100.0, r: int = PASSWORD_SCRYPT_R, p: int = PASSWORD_SCRYPT_P,
+              rounds: int = 5, max_log_n: int = 20) -> dict:
+    """
+    Time scrypt for increasing N on this machine and pick the largest N whose
+    median hash time stays within target_ms. Runs in the calling process.
+    """
+    timings = []
+    chosen = None
+    for log_n in range(10, max_log_n + 1):
+        n = 1 << log_n
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            _scrypt(b"calibration-password", secrets.token_bytes(_SALT_BYTES), n, r, p)
+            samples.append((time.perf_counter() - start) * 1000)
+        median_ms = statistics.median(samples)
+        timings.append({"n": n, "r": r, "p": p, "median_ms": round(median_ms, 1),
+                        "memory_mib": round(128 * n * r / (1024 * 1024), 1)})
+        if median_ms > target_ms:
+            break
+        chosen = n
+    return {"target_ms": target_ms, "n": chosen, "r": r, "p": p, "timings": timings}
@@ -0,0 +1,247 @@
+"""
+Rate limiting for abuse-prone routes (OTP sending, login, payment verification,
+availability checks).
+
+Each route has a set of limits keyed by request attributes (client IP, email,
+user, login identifier). A limit is either a token bucket ("bucket:N/S": bursts
+of N, refilled at N per S seconds) or a sliding-window counter ("sliding:N/S":
+at most N per rolling S seconds, estimated from the current and previous
+fixed windows). Limits are checked at the top of the route, before any DB
+query or SMTP job. Limits that should only count some outcomes (failed logins)
+are checked with count=False up front and counted once the outcome is known.
+
+Counters live in process memory, spread over shards with one lock each so
+concurrent requests for different keys rarely contend. Set
+RATE_LIMIT_STORE_URL to keep them in Redis and enforce limits across workers.
+"""
+import json
+import math
+import os
+import threading
+import time
+import zlib
+from fastapi import HTTPException, Request
+from utils import metrics
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# redis://host:6379/0 to share counters between workers (needs the `redis` package)
+RATE_LIMIT_STORE_URL = os.getenv("RATE_LIMIT_STORE_URL", "")
+# Use the first X-Forwarded-For address as the client IP (only behind a trusted proxy)
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "32"))
+RATE_LIMIT_MAX_KEYS_PER_SHARD = int(os.getenv("RATE_LIMIT_MAX_KEYS_PER_SHARD", "10000"))
+
+# Per-route limits: key name -> spec. Key names are the keyword arguments passed
+# to check_rate_limit(); "ip" is taken from the request.
+RATE_LIMITS = {
+    "send_otp": {"ip": "bucket:10/600", "email": "sliding:3/600"},
+    "send_reset_otp": {"ip": "bucket:10/600", "email": "sliding:3/600"},
+    "send_payment_otp": {"ip": "bucket:20/600", "user": "sliding:5/600"},
+    "verify_payment_otp": {"ip": "bucket:30/600", "user": "sliding:10/600"},
+    "login": {"ip": "bucket:30/300"},
+    # Counted only when the password check fails, so nobody can lock an account
+    # out with attempts of their own and the owner's logins do not use it up
+    "login_failure": {"identifier": "sliding:10/900"},
+    "availability": {"ip": "bucket:120/60"},
+}
+# e.g. RATE_LIMITS_JSON='{"login_failure": {"identifier": "sliding:5/900"}}'
+for _route, _limits in json.loads(os.getenv("RATE_LIMITS_JSON", "{}")).items():
+    RATE_LIMITS.setdefault(_route, {}).update(_limits)
+
+
+class Limit:
+    """Parsed limit spec: kind is 'bucket' or 'sliding', `limit` events per `window` seconds"""
+    def __init__(self, spec: str):
+        kind, _, rate = spec.partition(":")
+        limit, _, window = rate.partition("/")
+        if kind not in ("bucket", "sliding"):
+            raise ValueError(f"Unknown rate limit kind in {spec!r}")
+        self.spec = spec
+        self.kind = kind
+        self.limit = int(limit)
+        self.window = float(window)
+        self.rate = self.limit / self.window  # bucket refill per second
+
+
+_PARSED = {route: {key: Limit(spec) for key, spec in limits.items()} for route, limits in RATE_LIMITS.items()}
+
+
+def _sliding_retry_after(limit: Limit, elapsed: float, current: int, previous: int) -> float:
+    """Seconds until previous * (1 - elapsed) + current + 1 <= limit again"""
+    if current + 1 <= limit.limit and previous > 0:
+        # Still in this window, once enough of the previous one has slid out
+        return (1 - (limit.limit - 1 - current) / previous - elapsed) * limit.window
+    # Next window, where this window's count becomes the sliding "previous"
+    fraction = 1 - (limit.limit - 1) / current if current else 0.0
+    return (1 - elapsed + max(fraction, 0.0)) * limit.window
+
+
+class MemoryRateLimitBackend:
+    """Counters in this process, sharded by key with one lock per shard"""
+    def __init__(self, shards: int = RATE_LIMIT_SHARDS):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def _shard(self, key: str):
+        return self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+
+    @staticmethod
+    def _prune(entries: dict, now: float):
+        # Drop state that has fully recovered (full bucket / both windows past)
+        for key in [k for k, (horizon, _) in entries.items() if horizon <= now]:
+            del entries[key]
+
+    def hit(self, key: str, limit: Limit, now: float, record: bool = True) -> float:
+        """Record one event (unless record=False); return 0 if allowed, else seconds until it would be"""
+        entries, lock = self._shard(key)
+        with lock:
+            if len(entries) >= RATE_LIMIT_MAX_KEYS_PER_SHARD:
+                self._prune(entries, now)
+            entry = entries.get(key)
+            state = entry[1] if entry else None
+
+            if limit.kind == "bucket":
+                tokens, last = state if state else (float(limit.limit), now)
+                tokens = min(float(limit.limit), tokens + (now - last) * limit.rate)
+                if not record:
+                    return 0.0 if tokens >= 1 else (1 - tokens) / limit.rate
+                retry_after = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    retry_after = (1 - tokens) / limit.rate
+                horizon = now + (limit.limit - tokens) / limit.rate
+                entries[key] = (horizon, (tokens, now))
+                return retry_after
+
+            index = int(now // limit.window)
+            current_index, current, previous = state if state else (index, 0, 0)
+            if index != current_index:
+                previous = current if index == current_index + 1 else 0
+                current = 0
+            elapsed = (now % limit.window) / limit.window
+            if previous * (1 - elapsed) + current + 1 > limit.limit:
+                if record:
+                    entries[key] = ((index + 2) * limit.window, (index, current, previous))
+                return _sliding_retry_after(limit, elapsed, current, previous)
+            if not record:
+                return 0.0
+            entries[key] = ((index + 2) * limit.window, (index, current + 1, previous))
+            return 0.0
+
+
+# Atomic token bucket: refill, try to take one token, store, return [allowed, tokens]
+_BUCKET_LUA = """
+local cap = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(state[1]) or cap
+local ts = tonumber(state[2]) or now
+tokens = math.min(cap, tokens + math.max(now - ts, 0) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(cap / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisRateLimitBackend:
+    """Counters shared by every worker"""
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_STORE_URL is set but the 'redis' package is not installed")
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._bucket = self._redis.register_script(_BUCKET_LUA)
+
+    def hit(self, key: str, limit: Limit, now: float, record: bool = True) -> float:
+        if not record:
+            return self._peek(key, limit, now)
+        if limit.kind == "bucket":
+            allowed, tokens = self._bucket(keys=[f"rl:{key}"], args=[limit.limit, limit.rate, now])
+            return 0.0 if int(allowed) else (1 - float(tokens)) / limit.rate
+
+        index = int(now // limit.window)
+        pipe = self._redis.pipeline()
+        pipe.incr(f"rl:{key}:{index}")
+        pipe.expire(f"rl:{key}:{index}", int(limit.window * 2) + 1)
+        pipe.get(f"rl:{key}:{index - 1}")
+        current, _, previous = pipe.execute()
+        elapsed = (now % limit.window) / limit.window
+        # current already includes this request
+        if int(previous or 0) * (1 - elapsed) + current > limit.limit:
+            return _sliding_retry_after(limit, elapsed, current - 1, int(previous or 0))
+        return 0.0
+
+
+    def _peek(self, key: str, limit: Limit, now: float) -> float:
+        """hit() without recording the event"""
+        if limit.kind == "bucket":
+            tokens, ts = self._redis.hmget(f"rl:{key}", "t", "ts")
+            if tokens is None:
+                return 0.0
+            tokens = min(float(limit.limit), float(tokens) + max(now - float(ts), 0) * limit.rate)
+            return 0.0 if tokens >= 1 else (1 - tokens) / limit.rate
+
+        index = int(now // limit.window)
+        current, previous = self._redis.mget(f"rl:{key}:{index}", f"rl:{key}:{index - 1}")
+        current, previous = int(current or 0), int(previous or 0)
+        elapsed = (now % limit.window) / limit.window
+        if previous * (1 - elapsed) + current + 1 > limit.limit:
+            return _sliding_retry_after(limit, elapsed, current, previous)
+        return 0.0
+
+
+_backend = RedisRateLimitBackend(RATE_LIMIT_STORE_URL) if RATE_LIMIT_STORE_URL else MemoryRateLimitBackend()
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def check_rate_limit(route: str, request: Request, count: bool = True, **keys):
+    """
+    Count one request against every limit configured for route; raise 429 with
+    Retry-After if any is exceeded. keys: values for the route's key names
+    (e.g. email=..., user=...); the client IP is added automatically.
+    count=False only checks that one more event would be allowed.
+    """
+    limits = _PARSED.get(route)
+    if not RATE_LIMIT_ENABLED or not limits:
+        return
+    keys = {"ip": client_ip(request), **keys}
+    now = time.time()
+    retry_after = 0.0
+    exceeded = None
+    for key_name, limit in limits.items():
+        value = keys.get(key_name)
+        if value is None or value == "":
+            continue
+        try:
+            wait = _backend.hit(f"{route}:{key_name}:{str(value).lower()}", limit, now, record=count)
+        except Exception as e:
+            # A broken shared store must not take logins and payments down with it
+            metrics.increment("rate_limit.backend_errors")
+            print(f"⚠️ Rate limit backend error: {e}")
+            return
+        if wait > retry_after:
+            retry_after, exceeded = wait, key_name
+
+    if exceeded:
+        metrics.increment(f"rate_limit.{route}.limited_{exceeded}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please try again later.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+    if count:
+        metrics.increment(f"rate_limit.{route}.allowed")
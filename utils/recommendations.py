@@ -0,0 +1,138 @@
+"""
+"Frequently bought together" recommendations from a product co-occurrence matrix.
+
+The matrix is kept in memory, one sparse row per menu product (indexed like
+MENU_PRODUCTS), and counts how many received orders contained each pair of
+products. It is built from the orders table at startup, updated when an order
+is marked received, and rebuilt periodically so every worker converges.
+"""
+import json
+import os
+import threading
+import time
+from database import get_db
+from utils import metrics
+from utils.menu_data import PRODUCTS_BY_ID
+
+# Full rebuild interval - picks up orders received through other workers
+RECOMMENDATIONS_REBUILD_SECONDS = int(os.getenv("RECOMMENDATIONS_REBUILD_SECONDS", "3600"))
+RECOMMENDATIONS_MAX_LIMIT = 10
+
+# Orders the customer has confirmed as received
+RECEIVED_ORDER_STATUSES = ("delivered", "completed")
+
+PRODUCT_IDS = list(PRODUCTS_BY_ID)
+PRODUCT_INDEX = {product_id: i for i, product_id in enumerate(PRODUCT_IDS)}
+
+
+def _order_product_indexes(items) -> list:
+    """Distinct menu product indexes in an order's items (unknown products are ignored)"""
+    if isinstance(items, str):
+        items = json.loads(items)
+    indexes = set()
+    for item in items or []:
+        if isinstance(item, dict):
+            index = PRODUCT_INDEX.get(item.get("product_id"))
+            if index is not None:
+                indexes.add(index)
+    return sorted(indexes)
+
+
+class CoOccurrenceMatrix:
+    """Sparse symmetric product x product counts plus per-product order counts"""
+    def __init__(self, size: int):
+        self.rows = [{} for _ in range(size)]
+        self.order_counts = [0] * size
+        self.orders = 0
+        self._lock = threading.Lock()
+
+    def add_order(self, indexes: list):
+        with self._lock:
+            self.orders += 1
+            for i in indexes:
+                self.order_counts[i] += 1
+                row = self.rows[i]
+                for j in indexes:
+                    if j != i:
+                        row[j] = row.get(j, 0) + 1
+
+    def top_k(self, cart: list, k: int) -> list:
+        """
+        Rank products by the summed confidence P(product | cart item) over the cart,
+        breaking ties by overall popularity. Items already in the cart are excluded.
+        """
+        scores = {}
+        with self._lock:
+            for i in cart:
+                count = self.order_counts[i]
+                if not count:
+                    continue
+                for j, together in self.rows[i].items():
+                    scores[j] = scores.get(j, 0.0) + together / count
+            exclude = set(cart)
+            ranked = sorted(
+                ((score, self.order_counts[j], j) for j, score in scores.items() if j not in exclude),
+                reverse=True,
+            )
+        return [(j, score) for score, _, j in ranked[:k]]
+
+
+_matrix = CoOccurrenceMatrix(len(PRODUCT_IDS))
+
+
+def rebuild_matrix() -> dict:
+    """Rebuild the matrix from every received order and swap it in"""
+    global _matrix
+    start = time.perf_counter()
+    matrix = CoOccurrenceMatrix(len(PRODUCT_IDS))
+    conn = get_db()
+    try:
+        # Named (server-side) cursor streams orders instead of loading them all
+        c = conn.cursor(name="recommendations_rebuild")
+        c.itersize = 5000
+        c.execute("SELECT items FROM orders WHERE status = ANY(%s)", (list(RECEIVED_ORDER_STATUSES),))
+        for (items,) in c:
+            try:
+                matrix.add_order(_order_product_indexes(items))
+            except (ValueError, TypeError):
+                continue
+        c.close()
+    finally:
+        conn.rollback()
+        conn.close()
+
+    _matrix = matrix
+    duration = time.perf_counter() - start
+    metrics.observe("recommendations.rebuild_duration", duration)
+    metrics.set_gauge("recommendations.orders", matrix.orders)
+    return {"orders": matrix.orders, "duration_seconds": duration}
+
+
+def record_received_order(items):
+    """Add one newly received order to the in-memory matrix"""
+    try:
+        _matrix.add_order(_order_product_indexes(items))
+        metrics.increment("recommendations.incremental_updates")
+    except (ValueError, TypeError) as e:
+        print(f"⚠️ Error updating recommendations: {e}")
+
+
+def recommend_for_cart(product_ids: list, limit: int = 3) -> list:
+    """Top products bought together with the given cart, as menu product dicts with a score"""
+    cart = [PRODUCT_INDEX[pid] for pid in product_ids if pid in PRODUCT_INDEX]
+    limit = max(1, min(limit, RECOMMENDATIONS_MAX_LIMIT))
+    with metrics.timer("recommendations.lookup"):
+        ranked = _matrix.top_k(cart, limit)
+
+    results = []
+    for index, score in ranked:
+        product = PRODUCTS_BY_ID[PRODUCT_IDS[index]]
+        results.append({
+            "product_id": product["id"],
+            "product_name": product["name"],
+            "icon": product["icon"],
+            "image": product.get("image"),
+            "price": product["price"],
+            "score": round(score, 4),
+        })
+    return results
@@ -0,0 +1,191 @@
+"""
+Retention: purge rows of ephemeral tables once they are no longer useful.
+
+Each table has a declarative policy (which rows are expired, in SQL). A run
+deletes expired rows in small batches, one short transaction per batch, with a
+pause between batches. Runs stay out of peak hours and stop after a time
+budget; whatever is left is picked up by the next run, since expired rows are
+found by the policy condition itself. Rows purged and time spent are reported
+per policy in /health/metrics.
+"""
+import os
+import time
+from datetime import timedelta
+from database import get_db
+from utils import metrics
+from utils.timezone import get_vietnam_time
+
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+# Pause between batches so vacuum and replicas keep up
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.2"))
+# Time budget per run; the rest waits for the next run
+RETENTION_MAX_RUN_SECONDS = float(os.getenv("RETENTION_MAX_RUN_SECONDS", "120"))
+# Vietnam-time hour ranges [start, end) when purging does not run, e.g. "7-9,11-14,17-20"
+RETENTION_PEAK_HOURS = os.getenv("RETENTION_PEAK_HOURS", "7-9,11-14,17-21")
+
+OTP_RETENTION_DAYS = int(os.getenv("OTP_RETENTION_DAYS", "1"))
+CART_RETENTION_DAYS = int(os.getenv("CART_RETENTION_DAYS", "30"))
+FREQUENT_ITEMS_RETENTION_DAYS = int(os.getenv("FREQUENT_ITEMS_RETENTION_DAYS", "180"))
+OUTBOX_FAILED_RETENTION_DAYS = int(os.getenv("OUTBOX_FAILED_RETENTION_DAYS", "7"))
+
+
+class RetentionPolicy:
+    """Rows of `table` matching `condition` (with %(cutoff)s = now - max_age) are deleted"""
+    def __init__(self, name: str, table: str, condition: str, max_age: timedelta, order_by: str,
+                 description: str):
+        self.name = name
+        self.table = table
+        self.condition = condition
+        self.max_age = max_age
+        # Indexed column the batches walk, oldest first
+        self.order_by = order_by
+        self.description = description
+
+
+# Every OTP expires 10 minutes after it is issued, so "expired for a day" covers
+# verified and unused codes alike. Timestamps are naive Vietnam time.
+RETENTION_POLICIES = [
+    RetentionPolicy("otp_codes", "otp_codes", "expires_at < %(cutoff)s",
+                    timedelta(days=OTP_RETENTION_DAYS), "expires_at",
+                    f"verified or expired registration/reset OTPs after {OTP_RETENTION_DAYS} day(s)"),
+    RetentionPolicy("payment_otp", "payment_otp", "expires_at < %(cutoff)s",
+                    timedelta(days=OTP_RETENTION_DAYS), "expires_at",
+                    f"verified or expired payment OTPs after {OTP_RETENTION_DAYS} day(s)"),
+    RetentionPolicy("cart", "cart", "updated_at < %(cutoff)s",
+                    timedelta(days=CART_RETENTION_DAYS), "updated_at",
+                    f"carts idle for {CART_RETENTION_DAYS} days"),
+    RetentionPolicy("frequent_items", "frequent_items", "last_ordered_at < %(cutoff)s",
+                    timedelta(days=FREQUENT_ITEMS_RETENTION_DAYS), "last_ordered_at",
+                    f"frequent items not ordered for {FREQUENT_ITEMS_RETENTION_DAYS} days"),
+    # A revocation is only needed until the tokens it covers have expired
+    RetentionPolicy("session_revocations", "session_revocations", "expires_at < %(cutoff)s",
+                    timedelta(0), "expires_at", "session revocations past their tokens' expiry"),
+    # Sent notifications are deleted by the dispatcher; only given-up ones remain
+    RetentionPolicy("outbox", "outbox", "status = 'failed' AND created_at < %(cutoff)s",
+                    timedelta(days=OUTBOX_FAILED_RETENTION_DAYS), "created_at",
+                    f"notifications that failed every attempt, after {OUTBOX_FAILED_RETENTION_DAYS} days"),
+]
+POLICIES_BY_NAME = {policy.name: policy for policy in RETENTION_POLICIES}
+
+# Lock a batch of expired rows (skipping rows a live request holds) and delete them
+_PURGE_BATCH_SQL = """
+    DELETE FROM {table}
+    WHERE id IN (
+        SELECT id FROM {table}
+        WHERE {condition}
+        ORDER BY {order_by}
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+def _parse_peak_hours(spec: str):
+    ranges = []
+    for part in spec.split(","):
+        if part.strip():
+            start, end = part.split("-")
+            ranges.append((int(start), int(end)))
+    return ranges
+
+
+PEAK_HOURS = _parse_peak_hours(RETENTION_PEAK_HOURS)
+
+
+def in_peak_hours(now=None) -> bool:
+    hour = (now or get_vietnam_time()).hour
+    return any(start <= hour < end for start, end in PEAK_HOURS)
+
+
+def count_expired(policy: RetentionPolicy) -> int:
+    """Rows the policy would delete right now"""
+    cutoff = get_vietnam_time().replace(tzinfo=None) - policy.max_age
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) FROM {policy.table} WHERE {policy.condition}", {"cutoff": cutoff})
+        return c.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def purge_policy(policy: RetentionPolicy, deadline: float, batch_size: int = None,
+                 respect_peak_hours: bool = True) -> dict:
+    """Delete one policy's expired rows in batches until done, out of time, or peak hours begin"""
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    cutoff = get_vietnam_time().replace(tzinfo=None) - policy.max_age
+    sql = _PURGE_BATCH_SQL.format(table=policy.table, condition=policy.condition, order_by=policy.order_by)
+    start = time.perf_counter()
+    purged = 0
+    batches = 0
+    complete = False
+
+    while True:
+        batch_start = time.perf_counter()
+        conn = get_db()
+        try:
+            c = conn.cursor()
+            c.execute(sql, {"cutoff": cutoff, "batch_size": batch_size})
+            deleted = c.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        batches += 1
+        purged += deleted
+        metrics.observe(f"retention.{policy.name}.batch_duration", time.perf_counter() - batch_start)
+
+        if deleted < batch_size:
+            complete = True
+            break
+        if time.monotonic() >= deadline or (respect_peak_hours and in_peak_hours()):
+            break
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+    duration = time.perf_counter() - start
+    metrics.increment(f"retention.{policy.name}.rows_purged", purged)
+    metrics.set_gauge(f"retention.{policy.name}.last_run_rows", purged)
+    metrics.set_gauge(f"retention.{policy.name}.backlog", 0 if complete else 1)
+    metrics.observe(f"retention.{policy.name}.run_duration", duration)
+    return {"policy": policy.name, "purged": purged, "batches": batches,
+            "complete": complete, "duration_seconds": duration}
+
+
+def run_retention(policies=None, force: bool = False, max_run_seconds: float = None) -> dict:
+    """
+    Purge every policy (or the given ones) within one time budget.
+
+    Outside peak hours only, unless force. Returns per-policy results.
+    """
+    if not force and in_peak_hours():
+        metrics.increment("retention.skipped_peak_hours")
+        return {"skipped": "peak_hours", "results": []}
+
+    policies = policies or RETENTION_POLICIES
+    deadline = time.monotonic() + (max_run_seconds or RETENTION_MAX_RUN_SECONDS)
+    start = time.perf_counter()
+    results = []
+    for policy in policies:
+        if time.monotonic() >= deadline or (not force and in_peak_hours()):
+            results.append({"policy": policy.name, "purged": 0, "batches": 0,
+                            "complete": False, "duration_seconds": 0.0})
+            continue
+        try:
+            results.append(purge_policy(policy, deadline, respect_peak_hours=not force))
+        except Exception as e:
+            metrics.increment(f"retention.{policy.name}.errors")
+            print(f"⚠️ Retention policy '{policy.name}' failed: {e}")
+            results.append({"policy": policy.name, "purged": 0, "batches": 0, "complete": False,
+                            "duration_seconds": 0.0, "error": str(e)})
+
+    duration = time.perf_counter() - start
+    total = sum(result["purged"] for result in results)
+    metrics.observe("retention.run_duration", duration)
+    if total:
+        print(f"🧹 Retention purged {total} rows in {duration:.2f}s: "
+              + ", ".join(f"{r['policy']} {r['purged']}" for r in results if r["purged"]))
+    return {"skipped": None, "results": results, "duration_seconds": duration}
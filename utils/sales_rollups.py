@@ -0,0 +1,169 @@
+"""
+Sales rollups: hourly/daily aggregates per product, district, payment method and promo.
+
+Rollups are updated incrementally in the same transaction as the order state
+change (paid, COD delivered, refunded) and can be rebuilt from scratch with
+`python manage.py rebuild-rollups`. Analytics endpoints read only these tables.
+"""
+import time
+import psycopg2.extras
+from database import get_db
+from utils import metrics
+
+ROLLUP_TABLES = {
+    "hour": "sales_rollup_hourly",
+    "day": "sales_rollup_daily",
+}
+
+DIMENSIONS = ("total", "product", "district", "payment_method", "promo")
+
+# An order counts as a sale once money is in: balance orders after OTP payment,
+# any order once delivered (COD is paid on delivery). Refunded orders are 'cancelled'.
+SOLD_ORDER_CONDITION = """
+    (o.status IN ('delivered', 'completed')
+     OR (o.payment_method = 'balance' AND o.status IN ('paid', 'preparing', 'in_transit')))
+"""
+
+# One row per (order, dimension, key); {order_filter} selects which orders to explode
+_FACTS_SQL = """
+    SELECT o.id AS order_id, o.created_at, 'total' AS dimension, 'all' AS dimension_key,
+           0 AS item_quantity, o.total AS revenue, COALESCE(o.discount, 0) AS discount_total
+    FROM orders o WHERE {order_filter}
+    UNION ALL
+    SELECT o.id, o.created_at, 'district', COALESCE(NULLIF(o.delivery_district, ''), 'unknown'),
+           0, o.total, COALESCE(o.discount, 0)
+    FROM orders o WHERE {order_filter}
+    UNION ALL
+    SELECT o.id, o.created_at, 'payment_method', COALESCE(o.payment_method, 'unknown'),
+           0, o.total, COALESCE(o.discount, 0)
+    FROM orders o WHERE {order_filter}
+    UNION ALL
+    SELECT o.id, o.created_at, 'promo', o.promo_code,
+           0, o.total, o.discount
+    FROM orders o WHERE {order_filter} AND o.promo_code IS NOT NULL AND o.discount > 0
+    UNION ALL
+    SELECT o.id, o.created_at, 'product', COALESCE(item->>'product_id', item->>'id', 'unknown'),
+           COALESCE((item->>'quantity')::numeric, 1),
+           COALESCE((item->>'price')::numeric, 0) * COALESCE((item->>'quantity')::numeric, 1),
+           0
+    FROM orders o, jsonb_array_elements(o.items) AS item
+    WHERE {order_filter} AND jsonb_typeof(o.items) = 'array'
+"""
+
+_AGGREGATE_SQL = """
+    SELECT date_trunc(%(grain)s, f.created_at) AS bucket_start, f.dimension, f.dimension_key,
+           COUNT(DISTINCT f.order_id) * %(sign)s AS order_count,
+           SUM(f.item_quantity) * %(sign)s AS item_quantity,
+           SUM(f.revenue) * %(sign)s AS revenue,
+           SUM(f.discount_total) * %(sign)s AS discount_total
+    FROM ({facts}) f
+    GROUP BY 1, 2, 3
+"""
+
+_UPSERT_SQL = """
+    INSERT INTO {table} (bucket_start, dimension, dimension_key, order_count, item_quantity, revenue, discount_total)
+    {aggregate}
+    ON CONFLICT (bucket_start, dimension, dimension_key) DO UPDATE SET
+        order_count = {table}.order_count + EXCLUDED.order_count,
+        item_quantity = {table}.item_quantity + EXCLUDED.item_quantity,
+        revenue = {table}.revenue + EXCLUDED.revenue,
+        discount_total = {table}.discount_total + EXCLUDED.discount_total
+"""
+
+
+def _upsert_statement(grain: str, order_filter: str) -> str:
+    facts = _FACTS_SQL.format(order_filter=order_filter)
+    aggregate = _AGGREGATE_SQL.format(facts=facts)
+    return _UPSERT_SQL.format(table=ROLLUP_TABLES[grain], aggregate=aggregate)
+
+
+def record_order_sale(cursor, order_id: str, sign: int = 1):
+    """
+    Add (sign=1) or remove (sign=-1, refund) one order from every rollup.
+
+    Must be called with the cursor of the transaction that changes the order
+    status. Runs under a savepoint so a rollup failure never fails the payment;
+    drift is fixed by the next rebuild.
+    """
+    record_orders_sale(cursor, [order_id], sign)
+
+
+def record_orders_sale(cursor, order_ids: list, sign: int = 1):
+    """Set-based record_order_sale for many orders in one statement per grain"""
+    if not order_ids:
+        return
+    cursor.execute("SAVEPOINT sales_rollup")
+    try:
+        for grain in ROLLUP_TABLES:
+            cursor.execute(
+                _upsert_statement(grain, "o.id = ANY(%(order_ids)s)"),
+                {"grain": grain, "sign": sign, "order_ids": list(order_ids)},
+            )
+        cursor.execute("RELEASE SAVEPOINT sales_rollup")
+        metrics.increment("sales_rollups.incremental_updates", len(order_ids))
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT sales_rollup")
+        metrics.increment("sales_rollups.incremental_errors")
+        print(f"⚠️ Error updating sales rollups for {len(order_ids)} order(s): {e}")
+
+
+def rebuild_rollups() -> dict:
+    """Recompute every rollup table from the orders table in one transaction"""
+    start = time.perf_counter()
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        rows = {}
+        for grain, table in ROLLUP_TABLES.items():
+            # DELETE rather than TRUNCATE so dashboards keep reading during a rebuild
+            c.execute(f"DELETE FROM {table}")
+            c.execute(
+                _upsert_statement(grain, SOLD_ORDER_CONDITION),
+                {"grain": grain, "sign": 1},
+            )
+            rows[table] = c.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    duration = time.perf_counter() - start
+    metrics.observe("sales_rollups.rebuild_duration", duration)
+    return {"rows": rows, "duration_seconds": duration}
+
+
+def query_rollups(grain: str, dimension: str, start, end, order_by_revenue: bool = False, limit: int = None):
+    """Read rollup rows for one dimension between start (inclusive) and end (exclusive)"""
+    table = ROLLUP_TABLES[grain]
+    if order_by_revenue:
+        # Collapse buckets - one row per key ranked by revenue
+        sql = f"""
+            SELECT dimension_key, SUM(order_count) AS order_count, SUM(item_quantity) AS item_quantity,
+                   SUM(revenue) AS revenue, SUM(discount_total) AS discount_total
+            FROM {table}
+            WHERE dimension = %s AND bucket_start >= %s AND bucket_start < %s
+            GROUP BY dimension_key
+            HAVING SUM(order_count) > 0
+            ORDER BY SUM(revenue) DESC, dimension_key
+        """
+    else:
+        sql = f"""
+            SELECT bucket_start, dimension_key, order_count, item_quantity, revenue, discount_total
+            FROM {table}
+            WHERE dimension = %s AND bucket_start >= %s AND bucket_start < %s
+            ORDER BY bucket_start, dimension_key
+        """
+    params = [dimension, start, end]
+    if limit:
+        sql += " LIMIT %s"
+        params.append(limit)
+
+    conn = get_db()
+    try:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute(sql, params)
+        return c.fetchall()
+    finally:
+        conn.close()
@@ -0,0 +1,72 @@
+"""
+Background job scheduler: run periodic maintenance jobs on daemon threads
+"""
+import os
+import threading
+from utils import metrics
+
+# Set BACKGROUND_JOBS_ENABLED=0 to run the API without any periodic jobs
+BACKGROUND_JOBS_ENABLED = os.getenv("BACKGROUND_JOBS_ENABLED", "1") == "1"
+
+
+class PeriodicJob:
+    """Run func every interval_seconds until stopped"""
+    def __init__(self, name: str, interval_seconds: float, func):
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.func = func
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """Run the job a single time, recording duration and failures"""
+        try:
+            with metrics.timer(f"job.{self.name}.duration"):
+                self.func()
+            metrics.increment(f"job.{self.name}.runs")
+        except Exception as e:
+            metrics.increment(f"job.{self.name}.errors")
+            print(f"⚠️ Background job '{self.name}' failed: {e}")
+
+    def _loop(self):
+        # Wait first so startup is not slowed down by maintenance work
+        while not self._stop.wait(self.interval_seconds):
+            self.run_once()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name=f"job-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+_jobs = {}
+
+
+def register_job(name: str, interval_seconds: float, func) -> PeriodicJob:
+    """Register a periodic job (replaces any job with the same name)"""
+    job = PeriodicJob(name, interval_seconds, func)
+    _jobs[name] = job
+    return job
+
+
+def start_jobs():
+    """Start every registered job"""
+    if not BACKGROUND_JOBS_ENABLED:
+        print("ℹ️  Background jobs disabled (BACKGROUND_JOBS_ENABLED=0)")
+        return
+    for job in _jobs.values():
+        job.start()
+        print(f"✅ Background job '{job.name}' started (every {job.interval_seconds:g}s)")
+
+
+def stop_jobs():
+    """Stop every registered job"""
+    for job in _jobs.values():
+        job.stop()
@@ -1,13 +1,15 @@
 """
-Security utilities: password hashing, OTP generation, email sending
+Security utilities: staff access, OTP generation, email sending
+(password hashing lives in utils/passwords.py)
 """
-import hashlib
+import hmac
 import secrets
-import smtplib
 import os
+from fastapi import Header, HTTPException
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
+from utils import mailer
 
 load_dotenv()
 
@@ -18,15 +20,22 @@ SMTP_USER = os.getenv("SENDER_EMAIL", "")  # Changed from SMTP_USER
 SMTP_PASSWORD = os.getenv("SENDER_PASSWORD", "")  # Changed from SMTP_PASSWORD
 SMTP_FROM_EMAIL = os.getenv("SENDER_EMAIL", SMTP_USER or "")  # Use SENDER_EMAIL
 
+# Shared secret for staff-only endpoints (order search, exports, bulk refunds)
+STAFF_API_KEY = os.getenv("STAFF_API_KEY", "").strip()
+# Example/guessable values, refused so a copied .env cannot unlock staff endpoints
+_PLACEHOLDER_STAFF_KEYS = {"change-me", "changeme", "change_me", "secret", "staff", "password", "admin"}
+if STAFF_API_KEY.lower() in _PLACEHOLDER_STAFF_KEYS:
+    print("⚠️ STAFF_API_KEY is a placeholder value - staff endpoints stay disabled until it is changed")
+    STAFF_API_KEY = ""
 
-def hash_password(password: str) -> str:
-    """Hash password using SHA256"""
-    return hashlib.sha256(password.encode()).hexdigest()
 
-
-def verify_password(password: str, password_hash: str) -> bool:
-    """Verify password against hash"""
-    return hash_password(password) == password_hash
+def require_staff(x_staff_key: str = Header(default="")):
+    """FastAPI dependency: allow the request only with a valid X-Staff-Key header"""
+    if not STAFF_API_KEY:
+        raise HTTPException(status_code=503, detail="Staff access is not configured")
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str
+    if not hmac.compare_digest(x_staff_key.encode(), STAFF_API_KEY.encode()):
+        raise HTTPException(status_code=403, detail="Staff access required")
 
 
 def generate_otp() -> str:
@@ -34,9 +43,10 @@ def generate_otp() -> str:
     return ''.join([str(secrets.randbelow(10)) for _ in range(6)])
 
 
-def send_email(to_email: str, subject: str, html_body: str) -> bool:
+def send_email(to_email: str, subject: str, html_body: str, wait: bool = False) -> bool:
     """
-    Send email via generic SMTP server.
+    Send email via generic SMTP server (queued on the shared SMTP sessions in
+    utils/mailer.py; wait=True blocks until it is actually sent).
     
     This uses simple username/password SMTP (e.g. Gmail SMTP with App Password,
     Mailtrap, Outlook, or any other provider) and does NOT require
@@ -71,23 +81,7 @@ def send_email(to_email: str, subject: str, html_body: str) -> bool:
         part_html = MIMEText(html_body, "html")
         msg.attach(part_html)
 
-        # Use SSL for Gmail (port 465) or TLS for others (port 587)
-        if SMTP_PORT == 465:
-            # Gmail with SSL
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30) as server:
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.sendmail(SMTP_FROM_EMAIL, [to_email], msg.as_string())
-        else:
-            # Other SMTP with STARTTLS
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as server:
-                server.starttls()
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.sendmail(SMTP_FROM_EMAIL, [to_email], msg.as_string())
-
-        print(f"✅ Email sent to {to_email}")
-        return True
+        return mailer.send(msg, wait=wait)
     except Exception as e:
         print(f"❌ Email error (SMTP): {e}")
-        import traceback
-        traceback.print_exc()
         return False
@@ -0,0 +1,247 @@
+"""
+Signed session tokens.
+
+login and verify-otp issue an HMAC-signed token carrying the user ID, a
+session ID and issue/expiry times. Clients send it as
+`Authorization: Bearer <token>`. Checking it needs no DB access: the
+signature and expiry are checked locally (and remembered for repeat requests),
+and revoked sessions are looked up in an in-memory copy of the
+session_revocations table, which a background job reloads every
+SESSION_REVOCATION_REFRESH_SECONDS. Revocations made by this worker apply at
+once.
+
+User-scoped routers depend on check_session: a user_id claimed in the query,
+path or JSON body must match the token. While SESSION_TOKENS_REQUIRED is off,
+requests without a token are still accepted on the claimed user_id, so older
+clients keep working during the rollout.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+from fastapi import Depends, Header, HTTPException, Request
+from database import get_db
+from utils import metrics
+from utils.timezone import get_vietnam_time, VIETNAM_TZ
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+# Key for signing tokens; must be set (and equal) on every worker
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+# Reject user-scoped requests that carry no token (turn on once all clients send one)
+SESSION_TOKENS_REQUIRED = os.getenv("SESSION_TOKENS_REQUIRED", "0") == "1"
+SESSION_REVOCATION_REFRESH_SECONDS = int(os.getenv("SESSION_REVOCATION_REFRESH_SECONDS", "15"))
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "10000"))
+
+TOKEN_VERSION = "v1"
+# user_id of a revocation covering every user (dev database reset)
+ALL_USERS = "*"
+
+if not SESSION_SECRET:
+    print("⚠️ SESSION_SECRET is not set: session tokens are valid on this worker only, until it restarts")
+_secret = SESSION_SECRET.encode() if SESSION_SECRET else secrets.token_bytes(32)
+
+_lock = threading.Lock()
+_verified = OrderedDict()  # token -> claims, for tokens whose signature already checked out
+_revoked_sessions = {}  # session_id -> expires_at (epoch)
+_revoked_before = {}  # user_id -> epoch; that user's tokens issued earlier are revoked
+# Revocations applied by this worker: (applied_at, session_id or None, user_id, epoch),
+# kept until a reload that started after them has picked them up from the table
+_applied_locally = []
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(message: str) -> str:
+    return _b64(hmac.new(_secret, message.encode(), hashlib.sha256).digest())
+
+
+def _epoch(value: datetime) -> float:
+    """Epoch seconds for a naive Vietnam-time timestamp from the DB"""
+    return VIETNAM_TZ.localize(value).timestamp() if value.tzinfo is None else value.timestamp()
+
+
+def _naive(epoch: float) -> datetime:
+    return datetime.fromtimestamp(epoch, VIETNAM_TZ).replace(tzinfo=None)
+
+
+def issue_session(user_id: str) -> dict:
+    """New token for user_id: {"session_token", "session_expires_at"}"""
+    now = time.time()
+    claims = {"sub": str(user_id), "sid": secrets.token_hex(8), "iat": now, "exp": now + SESSION_TTL_SECONDS}
+    body = f"{TOKEN_VERSION}.{_b64(json.dumps(claims, separators=(',', ':')).encode())}"
+    metrics.increment("sessions.issued")
+    return {"session_token": f"{body}.{_sign(body)}", "session_expires_at": _naive(claims["exp"])}
+
+
+def _decode(token: str) -> Optional[dict]:
+    try:
+        version, payload, signature = token.split(".")
+    except ValueError:
+        return None
+    if version != TOKEN_VERSION or not hmac.compare_digest(signature, _sign(f"{version}.{payload}")):
+        return None
+    try:
+        return json.loads(_unb64(payload))
+    except ValueError:
+        return None
+
+
+def verify_session(token: str) -> dict:
+    """Claims of a valid token; raises 401 if it is malformed, forged, expired or revoked"""
+    now = time.time()
+    with _lock:
+        claims = _verified.get(token)
+        if claims is not None:
+            _verified.move_to_end(token)
+    if claims is None:
+        claims = _decode(token)
+        if claims is None:
+            metrics.increment("sessions.rejected_invalid")
+            raise HTTPException(status_code=401, detail="Invalid session token")
+        with _lock:
+            _verified[token] = claims
+            while len(_verified) > SESSION_CACHE_MAX_ENTRIES:
+                _verified.popitem(last=False)
+
+    if claims["exp"] <= now:
+        metrics.increment("sessions.rejected_expired")
+        raise HTTPException(status_code=401, detail="Session expired, please log in again")
+    with _lock:
+        revoked_before = max(_revoked_before.get(claims["sub"], 0), _revoked_before.get(ALL_USERS, 0))
+        revoked = claims["sid"] in _revoked_sessions or claims["iat"] <= revoked_before
+    if revoked:
+        metrics.increment("sessions.rejected_revoked")
+        raise HTTPException(status_code=401, detail="Session revoked, please log in again")
+    return claims
+
+
+# ---- FastAPI dependencies ----
+
+def session_user(authorization: str = Header(default="")) -> Optional[str]:
+    """User ID of the request's session token; None when no token was sent"""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return verify_session(token.strip())["sub"]
+
+
+async def check_session(request: Request, session_user_id: Optional[str] = Depends(session_user)) -> Optional[str]:
+    """
+    Router dependency: every user_id the request claims (query, path or JSON
+    body) must be the token's user. Returns that user, or None for a request
+    without a token (accepted only while SESSION_TOKENS_REQUIRED is off).
+    """
+    claimed = {request.query_params.get("user_id"), request.path_params.get("user_id")}
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            claimed.add(body.get("user_id"))
+    claimed = {str(value) for value in claimed if value not in (None, "")}
+
+    if session_user_id is None:
+        if claimed and SESSION_TOKENS_REQUIRED:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        return None
+    if claimed - {session_user_id}:
+        metrics.increment("sessions.rejected_mismatch")
+        raise HTTPException(status_code=403, detail="Session does not belong to this user")
+    return session_user_id
+
+
+# ---- Revocation ----
+
+def _record_revocation(cursor, user_id: str, session_id: Optional[str], revoked_at: float, expires_at: float):
+    cursor.execute("""
+        INSERT INTO session_revocations (user_id, session_id, revoked_at, expires_at)
+        VALUES (%s, %s, %s, %s)
+    """, (user_id, session_id, _naive(revoked_at), _naive(expires_at)))
+
+
+def revoke_session(token: str):
+    """Log one session out (its token stays rejected until it would have expired)"""
+    claims = verify_session(token)
+    conn = get_db()
+    try:
+        _record_revocation(conn.cursor(), claims["sub"], claims["sid"], time.time(), claims["exp"])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    with _lock:
+        _revoked_sessions[claims["sid"]] = claims["exp"]
+        _applied_locally.append((time.time(), claims["sid"], claims["sub"], claims["exp"]))
+    metrics.increment("sessions.revoked")
+
+
+def revoke_user_sessions(cursor, user_id: str):
+    """
+    Revoke every session issued to user_id (or ALL_USERS) so far, in the
+    caller's transaction (password reset/change, account deletion). Call apply_user_revocation()
+    after commit to apply it on this worker at once.
+    """
+    now = time.time()
+    _record_revocation(cursor, user_id, None, now, now + SESSION_TTL_SECONDS)
+    return now
+
+
+def apply_user_revocation(user_id: str, revoked_at: float):
+    with _lock:
+        _revoked_before[user_id] = max(_revoked_before.get(user_id, 0), revoked_at)
+        _applied_locally.append((time.time(), None, user_id, revoked_at))
+    metrics.increment("sessions.revoked")
+
+
+def refresh_revocations() -> dict:
+    """Reload the unexpired revocations (background job and startup)"""
+    started = time.time()
+    now_naive = get_vietnam_time().replace(tzinfo=None)
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            SELECT user_id, session_id, revoked_at, expires_at
+            FROM session_revocations
+            WHERE expires_at > %s
+        """, (now_naive,))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+
+    sessions = {}
+    users = {}
+    for user_id, session_id, revoked_at, expires_at in rows:
+        if session_id:
+            sessions[session_id] = _epoch(expires_at)
+        else:
+            users[user_id] = max(users.get(user_id, 0), _epoch(revoked_at))
+    global _revoked_sessions, _revoked_before, _applied_locally
+    with _lock:
+        # Local revocations may have committed after the SELECT read its snapshot
+        _applied_locally = [entry for entry in _applied_locally if entry[0] >= started - 1]
+        for _, session_id, user_id, epoch in _applied_locally:
+            if session_id:
+                sessions[session_id] = epoch
+            else:
+                users[user_id] = max(users.get(user_id, 0), epoch)
+        _revoked_sessions = sessions
+        _revoked_before = users
+    metrics.set_gauge("sessions.revocations_cached", len(sessions) + len(users))
+    return {"sessions": len(sessions), "users": len(users)}
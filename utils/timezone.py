@@ -2,6 +2,7 @@
 Timezone utilities
 """
 from datetime import datetime
+from typing import Optional
 import pytz
 
 VIETNAM_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
@@ -10,3 +11,10 @@ VIETNAM_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
 def get_vietnam_time():
     """Get current time in Vietnam timezone (UTC+7)"""
     return datetime.now(VIETNAM_TZ)
+
+
+def to_vietnam_naive(value: Optional[datetime]):
+    """Aware datetimes -> naive Vietnam time, as timestamps are stored; naive ones are assumed to be already"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(VIETNAM_TZ).replace(tzinfo=None)
+    return value
@@ -0,0 +1,157 @@
+"""
+Trending products: exponentially time-decayed order counts held in memory.
+
+Scores live in one array indexed like MENU_PRODUCTS. Updates use forward decay:
+an event at time t adds weight * e^(λ(t - t_ref)), so nothing has to be decayed
+on write; reads scale by e^(-λ(now - t_ref)). The array is rebuilt from recent
+orders at startup and periodically, so /api/menu/trending never touches the DB.
+"""
+import math
+import os
+import threading
+import time
+from array import array
+from datetime import timedelta
+from database import get_db
+from utils import metrics
+from utils.menu_data import PRODUCTS_BY_ID
+from utils.timezone import get_vietnam_time
+
+# A product's score halves after this many hours without orders
+TRENDING_HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+# Orders older than this are ignored when rebuilding (contribution < 1%)
+TRENDING_WINDOW_DAYS = int(os.getenv("TRENDING_WINDOW_DAYS", "7"))
+TRENDING_REBUILD_SECONDS = int(os.getenv("TRENDING_REBUILD_SECONDS", "3600"))
+TRENDING_MAX_LIMIT = 20
+
+# Checkout is demand; a confirmed delivery adds a smaller bonus on top
+CHECKOUT_WEIGHT = 1.0
+DELIVERY_WEIGHT = 0.5
+
+DECAY_RATE = math.log(2) / (TRENDING_HALF_LIFE_HOURS * 3600)
+# Rebase the forward-decay reference before e^(λΔt) gets large
+_MAX_EXPONENT = 50.0
+
+PRODUCT_IDS = list(PRODUCTS_BY_ID)
+PRODUCT_INDEX = {product_id: i for i, product_id in enumerate(PRODUCT_IDS)}
+
+_lock = threading.Lock()
+_scores = array("d", [0.0] * len(PRODUCT_IDS))
+_reference_time = time.time()
+
+
+def _rebase(now: float):
+    """Fold the decay so far into the scores and move the reference to now (lock held)"""
+    global _reference_time
+    factor = math.exp(-DECAY_RATE * (now - _reference_time))
+    for i in range(len(_scores)):
+        _scores[i] *= factor
+    _reference_time = now
+
+
+def record_items(items, weight: float = CHECKOUT_WEIGHT):
+    """Add an order's items (quantity x weight) to the trending scores"""
+    now = time.time()
+    with _lock:
+        exponent = DECAY_RATE * (now - _reference_time)
+        if exponent > _MAX_EXPONENT:
+            _rebase(now)
+            exponent = 0.0
+        boost = weight * math.exp(exponent)
+        for item in items or []:
+            if not isinstance(item, dict):
+                continue
+            index = PRODUCT_INDEX.get(item.get("product_id"))
+            if index is None:
+                continue
+            try:
+                quantity = float(item.get("quantity") or 1)
+            except (TypeError, ValueError):
+                quantity = 1.0
+            _scores[index] += quantity * boost
+    metrics.increment("trending.events")
+
+
+def record_checkout(items):
+    record_items(items, CHECKOUT_WEIGHT)
+
+
+def record_delivery(items):
+    record_items(items, DELIVERY_WEIGHT)
+
+
+# Decayed weight of every checkout and delivery in the window, per product.
+# created_at/delivered_at are naive Vietnam time, like %(now)s.
+_REBUILD_SQL = """
+    WITH events AS (
+        SELECT o.items, o.created_at AS event_time, %(checkout_weight)s AS weight
+        FROM orders o
+        WHERE o.created_at >= %(since)s AND o.status != 'cancelled'
+        UNION ALL
+        SELECT o.items, o.delivered_at, %(delivery_weight)s
+        FROM orders o
+        WHERE o.delivered_at >= %(since)s AND o.status IN ('delivered', 'completed')
+    )
+    SELECT item->>'product_id' AS product_id,
+           SUM(COALESCE((item->>'quantity')::numeric, 1) * e.weight
+               * exp(-%(decay_rate)s * GREATEST(EXTRACT(EPOCH FROM (%(now)s - e.event_time)), 0))) AS score
+    FROM events e, jsonb_array_elements(e.items) AS item
+    WHERE jsonb_typeof(e.items) = 'array'
+    GROUP BY 1
+"""
+
+
+def rebuild_scores() -> dict:
+    """Recompute the scores from the last TRENDING_WINDOW_DAYS of orders"""
+    global _scores, _reference_time
+    start = time.perf_counter()
+    now = get_vietnam_time().replace(tzinfo=None)
+    conn = get_db()
+    try:
+        c = conn.cursor()
+        c.execute(_REBUILD_SQL, {
+            "now": now,
+            "since": now - timedelta(days=TRENDING_WINDOW_DAYS),
+            "checkout_weight": CHECKOUT_WEIGHT,
+            "delivery_weight": DELIVERY_WEIGHT,
+            "decay_rate": DECAY_RATE,
+        })
+        rows = c.fetchall()
+    finally:
+        conn.close()
+
+    scores = array("d", [0.0] * len(PRODUCT_IDS))
+    for product_id, score in rows:
+        index = PRODUCT_INDEX.get(product_id)
+        if index is not None:
+            scores[index] = float(score)
+
+    with _lock:
+        _scores = scores
+        _reference_time = time.time()
+
+    duration = time.perf_counter() - start
+    metrics.observe("trending.rebuild_duration", duration)
+    return {"products": sum(1 for s in scores if s > 0), "duration_seconds": duration}
+
+
+def get_trending(category: str = None, limit: int = 10) -> list:
+    """Top products by current decayed score, optionally within one category"""
+    limit = max(1, min(limit, TRENDING_MAX_LIMIT))
+    with _lock:
+        factor = math.exp(-DECAY_RATE * (time.time() - _reference_time))
+        # Ties keep menu order
+        ranked = sorted(
+            ((score, i) for i, score in enumerate(_scores) if score > 0),
+            key=lambda entry: (-entry[0], entry[1]),
+        )
+
+    results = []
+    for score, index in ranked:
+        product = PRODUCTS_BY_ID[PRODUCT_IDS[index]]
+        if category and product["category"] != category:
+            continue
+        results.append({**product, "trending_score": round(score * factor, 4)})
+        if len(results) >= limit:
+            break
+    return results
@@ -0,0 +1,253 @@
+"""
+Per-user cache for the balance and profile fields polled by the frontend.
+
+/api/user/balance and /api/auth/me read from here instead of checking out a
+pool connection on every poll. Entries expire after short TTLs (balance
+sooner than profile fields). Write paths publish a change with pg_notify in
+the same transaction, so every worker evicts the user exactly when the write
+commits; the writing worker then updates or evicts its own entry in place.
+A listener thread per worker receives the notifications; while it is
+disconnected the cache is bypassed, so no worker serves values it could not
+have been told about. Other modules can subscribe() to further channels on the
+same listener connection.
+"""
+import os
+import select
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import psycopg2
+import psycopg2.extras
+from database import get_db, DB_CONFIG
+from utils import metrics
+
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "1") == "1"
+USER_CACHE_BALANCE_TTL_SECONDS = float(os.getenv("USER_CACHE_BALANCE_TTL_SECONDS", "5"))
+USER_CACHE_PROFILE_TTL_SECONDS = float(os.getenv("USER_CACHE_PROFILE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+
+NOTIFY_CHANNEL = "user_cache"
+# Payload "<worker>:<user_id>"; user_id "*" means every user
+_WORKER_ID = uuid.uuid4().hex[:8]
+ALL_USERS = "*"
+
+_PROFILE_FIELDS = "id, email, full_name, phone, balance, username"
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # user_id -> {"row", "profile_at", "balance_at"}
+# Invalidation sequence: a load that started before a user's last invalidation
+# must not store what it read
+_sequence = 0
+_invalidated = {}  # user_id -> sequence of the last invalidation
+_invalidated_floor = 0  # sequence at which _invalidated was last pruned
+_hits = 0
+_misses = 0
+
+_listening = threading.Event()
+_stop = threading.Event()
+_listener = None
+_subscribers = {}  # channel -> (handler(payload), on_connect())
+
+
+def _record(hit: bool):
+    global _hits, _misses
+    with _lock:
+        if hit:
+            _hits += 1
+        else:
+            _misses += 1
+        total = _hits + _misses
+        ratio = _hits / total
+    metrics.increment("user_cache.hits" if hit else "user_cache.misses")
+    metrics.set_gauge("user_cache.hit_ratio", round(ratio, 4))
+
+
+def _lookup(user_id: str, need_profile: bool):
+    """Cached row if fresh enough, else None"""
+    if not USER_CACHE_ENABLED or not _listening.is_set():
+        return None
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is None:
+            return None
+        if now - entry["balance_at"] > USER_CACHE_BALANCE_TTL_SECONDS:
+            return None
+        if need_profile and now - entry["profile_at"] > USER_CACHE_PROFILE_TTL_SECONDS:
+            return None
+        _entries.move_to_end(user_id)
+        return dict(entry["row"])
+
+
+def _load(user_id: str):
+    """Read the user's row and cache it unless it was invalidated meanwhile"""
+    with _lock:
+        started = _sequence
+    conn = get_db()
+    try:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute(f"SELECT {_PROFILE_FIELDS} FROM users WHERE id = %s", (user_id,))
+        row = c.fetchone()
+    finally:
+        conn.close()
+
+    if row is None or not USER_CACHE_ENABLED or not _listening.is_set():
+        return row
+    now = time.monotonic()
+    with _lock:
+        if _invalidated.get(user_id, _invalidated_floor) > started:
+            return row
+        _entries[user_id] = {"row": dict(row), "profile_at": now, "balance_at": now}
+        _entries.move_to_end(user_id)
+        while len(_entries) > USER_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+        size = len(_entries)
+    metrics.set_gauge("user_cache.size", size)
+    return row
+
+
+def get_profile(user_id: str):
+    """id, email, full_name, phone, balance and username (None if the user does not exist)"""
+    row = _lookup(user_id, need_profile=True)
+    _record(row is not None)
+    return row if row is not None else _load(user_id)
+
+
+def get_balance(user_id: str):
+    """Current balance (None if the user does not exist)"""
+    row = _lookup(user_id, need_profile=False)
+    _record(row is not None)
+    if row is None:
+        row = _load(user_id)
+    return row["balance"] if row else None
+
+
+# ---- Write paths ----
+
+def publish_user_change(cursor, user_id: str):
+    """Tell every worker to drop user_id when the caller's transaction commits"""
+    cursor.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, f"{_WORKER_ID}:{user_id}"))
+
+
+def publish_user_changes(cursor, user_ids):
+    """publish_user_change for many users in one statement"""
+    if user_ids:
+        cursor.execute(
+            "SELECT pg_notify(%s, %s || ':' || user_id) FROM unnest(%s::text[]) AS user_id",
+            (NOTIFY_CHANNEL, _WORKER_ID, list(user_ids)),
+        )
+
+
+def invalidate(user_id: str):
+    """Drop the local entry (after the writing transaction commits)"""
+    global _sequence, _invalidated_floor
+    with _lock:
+        _sequence += 1
+        if user_id == ALL_USERS:
+            _entries.clear()
+            _invalidated.clear()
+            _invalidated_floor = _sequence
+        else:
+            _entries.pop(user_id, None)
+            _invalidated[user_id] = _sequence
+            if len(_invalidated) > USER_CACHE_MAX_ENTRIES:
+                # Forget individual invalidations; loads older than this are all discarded
+                _invalidated.clear()
+                _invalidated_floor = _sequence
+        size = len(_entries)
+    metrics.increment("user_cache.invalidations")
+    metrics.set_gauge("user_cache.size", size)
+
+
+def set_balance(user_id: str, balance):
+    """Write-through: update the local entry's balance after the transaction commits"""
+    global _sequence
+    with _lock:
+        # Loads that started before this write must not overwrite it
+        _sequence += 1
+        _invalidated[user_id] = _sequence
+        entry = _entries.get(user_id)
+        if entry is not None:
+            entry["row"]["balance"] = balance
+            entry["balance_at"] = time.monotonic()
+
+
+# ---- Cross-worker invalidation ----
+
+def _handle(payload: str):
+    worker, _, user_id = payload.partition(":")
+    if worker == _WORKER_ID:
+        return  # Already applied in place by the writer
+    invalidate(user_id)
+    metrics.increment("user_cache.remote_invalidations")
+
+
+def subscribe(channel: str, handler, on_connect=None):
+    """
+    Deliver channel's notification payloads to handler on the listener thread.
+    on_connect runs after every (re)connect, once LISTEN is active, so it can
+    reload whatever notifications were missed. Call before start_listener().
+    """
+    _subscribers[channel] = (handler, on_connect)
+
+
+def is_listening() -> bool:
+    return _listening.is_set()
+
+
+def _listen_loop():
+    delay = 1.0
+    while not _stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_CONFIG)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            for channel in (NOTIFY_CHANNEL, *_subscribers):
+                conn.cursor().execute(f"LISTEN {channel}")
+            # Anything may have changed while we were not listening
+            invalidate(ALL_USERS)
+            _listening.set()
+            for _, on_connect in _subscribers.values():
+                if on_connect is not None:
+                    on_connect()
+            delay = 1.0
+            while not _stop.is_set():
+                if select.select([conn], [], [], 5.0)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        if notify.channel == NOTIFY_CHANNEL:
+                            _handle(notify.payload)
+                        else:
+                            _subscribers[notify.channel][0](notify.payload)
+        except Exception as e:
+            metrics.increment("user_cache.listener_errors")
+            print(f"⚠️ User cache listener disconnected: {e}")
+        finally:
+            _listening.clear()
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        _stop.wait(delay)
+        delay = min(delay * 2, 30.0)
+
+
+def start_listener():
+    """Start this worker's invalidation listener (the cache stays bypassed until it connects)"""
+    global _listener
+    if not (USER_CACHE_ENABLED or _subscribers) or _listener is not None:
+        return
+    _stop.clear()
+    _listener = threading.Thread(target=_listen_loop, name="user-cache-listener", daemon=True)
+    _listener.start()
+
+
+def stop_listener(timeout: float = 5.0):
+    global _listener
+    _stop.set()
+    if _listener is not None:
+        _listener.join(timeout)
+        _listener = None